@@ -19,4 +19,5 @@ admin.site.register(TestAnswer)
 admin.site.register(StudentAnswer)
 admin.site.register(TelegramMessage)
 admin.site.register(StudentTheoryTopic)
-admin.site.register(City)
\ No newline at end of file
+admin.site.register(City)
+admin.site.register(StudentProgress)
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+from django.db.models import Count, Min
+from .models import Student, StudentTheoryTopic, TheoryTopic
+from .progress import rebuild_progress
+
+LOG = logging.getLogger(__name__)
+
+
+def assign_topic(topic_id: int, branch_id: int, chunk_size: int = 1000,
+                 progress: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Create missing StudentTheoryTopic rows of topic for all students of branch,
+    by chunks of students with bulk insert ignoring rows created concurrently,
+    progress summaries of students are rebuilt with every chunk
+    :param topic_id: TheoryTopic pk
+    :param branch_id: RestaurantBranch pk
+    :param chunk_size: students per insert
+    :param progress: function called with count of assigned students after every chunk
+    :return: count of assigned students
+    """
+    assigned = 0
+    last_pk = 0
+    while True:
+        student_ids = list(Student.objects.filter(staff__restaurant_branch_id=branch_id, pk__gt=last_pk)
+                           .exclude(studenttheorytopic__theory_topic_id=topic_id)
+                           .order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not student_ids:
+            return assigned
+        last_pk = student_ids[-1]
+        with transaction.atomic():
+            StudentTheoryTopic.objects.bulk_create((StudentTheoryTopic(student_id=student_id, theory_topic_id=topic_id)
+                                                    for student_id in student_ids), ignore_conflicts=True)
+            rebuild_progress(student_ids)
+        assigned += len(student_ids)
+        if progress:
+            progress(assigned)
+
+
+class AssignmentJobs:
+    """
+    Background assignment of new topics with progress of every job
+    """
+
+    def __init__(self, chunk_size: int = 1000, keep: int = 100):
+        """
+        :param chunk_size: students per insert
+        :param keep: count of finished jobs kept for stats
+        """
+        self.chunk_size = chunk_size
+        self.keep = keep
+        self._jobs: Dict[int, dict] = {}
+        self._lock = threading.Lock()
+
+    def start(self, topic_id: int, branch_id: int) -> threading.Thread:
+        """
+        Assign topic in background thread
+        :param topic_id: TheoryTopic pk
+        :param branch_id: RestaurantBranch pk
+        :return: thread of job
+        """
+        job = {'topic': topic_id, 'branch': branch_id, 'assigned': 0, 'started': time.time(),
+               'finished': None, 'error': None}
+        with self._lock:
+            self._jobs[topic_id] = job
+            finished = [key for key, value in self._jobs.items() if value['finished']]
+            for key in finished[:max(len(finished) - self.keep, 0)]:
+                del self._jobs[key]
+        thread = threading.Thread(target=self._run, args=(job,), name=f'assign-topic-{topic_id}', daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self) -> list:
+        with self._lock:
+            return [dict(job) for job in self._jobs.values()]
+
+    def _run(self, job: dict) -> None:
+        def progress(assigned: int) -> None:
+            job['assigned'] = assigned
+
+        close_old_connections()
+        try:
+            assign_topic(job['topic'], job['branch'], self.chunk_size, progress)
+        except Exception as err:
+            job['error'] = str(err)
+            LOG.exception(err)
+        finally:
+            job['finished'] = time.time()
+            close_old_connections()
+
+
+assignment_jobs = AssignmentJobs(chunk_size=settings.BOT_ASSIGN_CHUNK_SIZE)
+
+
+def remove_duplicate_assignments(dry_run: bool = False, using: str = DEFAULT_DB_ALIAS) -> int:
+    """
+    Delete duplicate StudentTheoryTopic rows, first row of student and topic is kept
+    :param dry_run: only count rows
+    :param using: alias of Data Base
+    :return: count of duplicate rows
+    """
+    duplicates = 0
+    student_topics = StudentTheoryTopic.objects.using(using)
+    groups = student_topics.values('student_id', 'theory_topic_id').annotate(
+        count=Count('pk'), first=Min('pk')).filter(count__gt=1).order_by()
+    for group in groups:
+        duplicates += group['count'] - 1
+        if not dry_run:
+            student_topics.filter(student_id=group['student_id'], theory_topic_id=group['theory_topic_id']) \
+                .exclude(pk=group['first']).delete()
+    return duplicates
+
+
+def needs_assignment_dedupe(using: str = DEFAULT_DB_ALIAS) -> bool:
+    """
+    :param using: alias of Data Base
+    :return: True if StudentTheoryTopic table exists without unique constraint of student and topic
+    """
+    connection = connections[using]
+    table = StudentTheoryTopic._meta.db_table
+    with connection.cursor() as cursor:
+        if table not in connection.introspection.table_names(cursor):
+            return False
+        constraints = connection.introspection.get_constraints(cursor, table)
+    return not any(constraint['unique'] and constraint['columns'] == ['student_id', 'theory_topic_id']
+                   for constraint in constraints.values())
+
+
+def count_missing_assignments(topic: TheoryTopic) -> int:
+    return Student.objects.filter(staff__restaurant_branch_id=topic.restaurant_id) \
+        .exclude(studenttheorytopic__theory_topic_id=topic.pk).count()
@@ -0,0 +1,112 @@
+from typing import Dict, Optional, Tuple
+
+# bump when format of callback data changes, buttons of previous version are rejected
+VERSION = '1'
+SEPARATOR = '.'
+# telegram limit of callback_data
+MAX_LENGTH = 64
+
+
+class Route:
+    """
+    Callback route: name used in code, short code used in callback data,
+    types of arguments and StudentLogic method which handles callback
+    """
+    __slots__ = ('name', 'code', 'arg_types', 'method', 'parts', 'parse')
+
+    def __init__(self, name: str, code: str, arg_types: tuple, method: str):
+        self.name = name
+        self.code = code
+        self.arg_types = arg_types
+        self.method = method
+        # count of parts in split callback data
+        self.parts = len(arg_types) + 1
+        # parser of split callback data to arguments tuple
+        self.parse = _make_parser(arg_types)
+
+
+def _make_parser(arg_types: tuple):
+    if len(arg_types) == 1:
+        first, = arg_types
+        return lambda parts: (first(parts[1]),)
+    if len(arg_types) == 2:
+        first, second = arg_types
+        return lambda parts: (first(parts[1]), second(parts[2]))
+    if len(arg_types) == 3:
+        first, second, third = arg_types
+        return lambda parts: (first(parts[1]), second(parts[2]), third(parts[3]))
+    return lambda parts: tuple(arg_type(arg) for arg_type, arg in zip(arg_types, parts[1:]))
+
+
+class CallbackRouter:
+    """
+    Router of inline keyboard callbacks
+
+    Callback data is `<version><code>[.<arg>]*`, e.g. `1o.12.0` for route `topic` with args 12, 0.
+    """
+
+    def __init__(self, *routes: Route, version: str = VERSION):
+        self.version = version
+        # routes by head of callback data: version and code
+        self._by_head: Dict[str, Route] = {}
+        # resolved routes without arguments by callback data
+        self._static: Dict[str, Tuple[Route, tuple]] = {}
+        self._by_name: Dict[str, Route] = {}
+        for route in routes:
+            head = version + route.code
+            if head in self._by_head or route.name in self._by_name or SEPARATOR in route.code:
+                raise ValueError(f'invalid route {route.name}')
+            self._by_head[head] = route
+            self._by_name[route.name] = route
+            if not route.arg_types:
+                self._static[head] = (route, ())
+
+    def encode(self, name: str, *args) -> str:
+        """
+        Make callback data for route
+        :param name: route name
+        :param args: route arguments
+        :return: callback data
+        """
+        route = self._by_name[name]
+        if len(args) != len(route.arg_types):
+            raise ValueError(f'route {name} takes {len(route.arg_types)} arguments')
+        data = self.version + route.code
+        if args:
+            data += SEPARATOR + SEPARATOR.join(str(arg) for arg in args)
+        if len(data.encode('utf-8')) > MAX_LENGTH:
+            raise ValueError(f'callback data of route {name} is longer than {MAX_LENGTH} bytes')
+        return data
+
+    def resolve(self, data: str) -> Optional[Tuple[Route, tuple]]:
+        """
+        Find route of callback data and parse its arguments
+        :param data: callback data
+        :return: (route, args) or None if data is unknown, stale or broken
+        """
+        resolved = self._static.get(data)
+        if resolved is not None:
+            return resolved
+        if not data or len(data) > MAX_LENGTH:
+            return None
+        parts = data.split(SEPARATOR)
+        route = self._by_head.get(parts[0])
+        if route is None or len(parts) != route.parts:
+            return None
+        try:
+            return route, route.parse(parts)
+        except ValueError:
+            return None
+
+
+callback_router = CallbackRouter(
+    Route('main_menu', 'm', (), 'main_menu'),
+    Route('studding', 's', (), 'studding'),
+    Route('progress', 'p', (), 'progress'),
+    Route('topic', 'o', (int, int), 'view_topic'),
+    Route('completetopic', 'c', (int,), 'complete_topic'),
+    Route('test', 't', (int, int), 'view_test'),
+    Route('answer', 'a', (int, int, int), 'select_answer'),
+)
+
+encode = callback_router.encode
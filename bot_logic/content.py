@@ -0,0 +1,172 @@
+import itertools
+import threading
+import time
+from types import MappingProxyType
+from typing import Dict, NamedTuple, Optional, Tuple
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from .models import TheoryTopic, TheoryBlock, TheoryTest, TestQuestion, TestAnswer
+from .versions import SharedVersion
+
+
+class AnswerSnapshot(NamedTuple):
+    id: int
+    answer: str
+    is_right: bool
+
+
+class QuestionSnapshot(NamedTuple):
+    id: int
+    question: str
+    is_opened: bool
+    is_multiple: bool
+    answers: Tuple[AnswerSnapshot, ...]
+    right_answers: frozenset
+
+
+class TestSnapshot(NamedTuple):
+    id: int
+    name: str
+    topic_id: int
+    questions: Tuple[QuestionSnapshot, ...]
+    # question pk -> position in questions
+    question_index: MappingProxyType
+
+
+class BlockSnapshot(NamedTuple):
+    id: int
+    name: str
+    text: str
+
+
+class TopicSnapshot(NamedTuple):
+    id: int
+    name: str
+    text: str
+    blocks: Tuple[BlockSnapshot, ...]
+    test_id: Optional[int]
+
+
+class BranchContent(NamedTuple):
+    """
+    Read-only course content of restaurant branch: topics -> blocks -> test -> questions -> answers
+    """
+    branch_id: int
+    version: int
+    topics: Tuple[TopicSnapshot, ...]
+    topics_by_id: MappingProxyType
+    tests_by_id: MappingProxyType
+
+
+def order_questions(test: TheoryTest) -> list:
+    """
+    Questions of test in persisted order, questions missing in the order go last by pk
+    :param test: TheoryTest with questions prefetched in pk order
+    :return: list of TestQuestion
+    """
+    positions = {question_id: i for i, question_id in enumerate(test.get_question_order())}
+    return sorted(test.questions.all(), key=lambda question: positions.get(question.pk, len(positions)))
+
+
+def build_branch_content(branch_id: int, version: int = 0) -> BranchContent:
+    """
+    Load course content of branch by 4 queries: topics with tests, blocks, questions, answers.
+    Questions of test are in persisted order of test, so their positions are the same in all workers
+    :param branch_id: RestaurantBranch pk
+    :param version: version of snapshot, unique in process
+    :return: BranchContent
+    """
+    topics_qs = TheoryTopic.objects.filter(restaurant_id=branch_id).select_related('test').order_by('pk').prefetch_related(
+        Prefetch('blocks', queryset=TheoryBlock.objects.order_by('pk')),
+        Prefetch('test__questions', queryset=TestQuestion.objects.order_by('pk').prefetch_related(
+            Prefetch('answers', queryset=TestAnswer.objects.order_by('pk')))),
+    )
+    topics = []
+    tests = {}
+    for topic in topics_qs:
+        test_id = None
+        if topic.test:
+            test_id = topic.test.pk
+            questions = tuple(
+                QuestionSnapshot(question.pk, question.question, question.is_opened, question.is_multiple,
+                                 tuple(AnswerSnapshot(answer.pk, answer.answer, answer.is_right)
+                                       for answer in question.answers.all()),
+                                 frozenset(answer.pk for answer in question.answers.all() if answer.is_right))
+                for question in order_questions(topic.test))
+            tests[test_id] = TestSnapshot(test_id, topic.test.name, topic.pk, questions,
+                                          MappingProxyType({question.id: i for i, question in enumerate(questions)}))
+        blocks = tuple(BlockSnapshot(block.pk, block.name, block.text) for block in topic.blocks.all())
+        topics.append(TopicSnapshot(topic.pk, topic.name, topic.text, blocks, test_id))
+
+    return BranchContent(branch_id, version, tuple(topics),
+                         MappingProxyType({topic.id: topic for topic in topics}),
+                         MappingProxyType(tests))
+
+
+class ContentCache:
+    """
+    Snapshots of branch content, rebuilt on first use after any content change
+
+    Snapshot is immutable, so workers keep using old snapshot while new one is built
+    and swapped in. Content changes are seen by all processes through shared version
+    (see SharedVersion), snapshot is also rebuilt after BOT_CONTENT_TTL seconds.
+    Version of snapshot is unique in process, so screens rendered from old snapshot are not reused.
+    """
+
+    def __init__(self):
+        # branch pk -> (snapshot, shared version, time of build)
+        self._snapshots: Dict[int, Tuple[BranchContent, int, float]] = {}
+        self._versions = itertools.count(1)
+        self.shared_version = SharedVersion('content')
+        self._lock = threading.Lock()
+
+    def get(self, branch_id: int) -> BranchContent:
+        """
+        Get content snapshot of branch
+        :param branch_id: RestaurantBranch pk
+        :return: BranchContent
+        """
+        version = self.shared_version.get()
+        entry = self._snapshots.get(branch_id)
+        if entry is not None:
+            snapshot, snapshot_version, built = entry
+            if snapshot_version == version and time.monotonic() - built < settings.BOT_CONTENT_TTL:
+                return snapshot
+        built = time.monotonic()
+        snapshot = build_branch_content(branch_id, next(self._versions))
+        with self._lock:
+            snapshots = dict(self._snapshots)
+            snapshots[branch_id] = (snapshot, version, built)
+            self._snapshots = snapshots
+        return snapshot
+
+    def invalidate(self) -> None:
+        """
+        Drop snapshots of process and change shared version after commit
+        """
+        with self._lock:
+            self._snapshots = {}
+        transaction.on_commit(self.shared_version.bump)
+
+
+content_cache = ContentCache()
+
+
+@receiver(post_save, sender=TheoryTopic)
+@receiver(post_save, sender=TheoryBlock)
+@receiver(post_save, sender=TheoryTest)
+@receiver(post_save, sender=TestQuestion)
+@receiver(post_save, sender=TestAnswer)
+@receiver(post_delete, sender=TheoryTopic)
+@receiver(post_delete, sender=TheoryBlock)
+@receiver(post_delete, sender=TheoryTest)
+@receiver(post_delete, sender=TestQuestion)
+@receiver(post_delete, sender=TestAnswer)
+@receiver(m2m_changed, sender=TheoryTopic.blocks.through)
+@receiver(m2m_changed, sender=TheoryTest.questions.through)
+@receiver(m2m_changed, sender=TestQuestion.answers.through)
+def invalidate_content_cache(sender, **kwargs):
+    content_cache.invalidate()
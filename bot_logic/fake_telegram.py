@@ -0,0 +1,127 @@
+import json
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+
+class FakeTelegramServer:
+    """
+    Local stand-in for telegram Bot API, for tests and benchmarks
+
+    Answers every method with successful result after `latency` seconds,
+    every `flood_every`-th call is answered with 429 and retry_after.
+
+    usage:
+        with FakeTelegramServer(latency=0.05) as server:
+            configure_api(api_url=server.api_url)
+            ...
+            server.calls['sendMessage']
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 flood_every: int = 0, retry_after: int = 1, keep_requests: int = 1000):
+        """
+        :param host: host to listen
+        :param port: port to listen, 0 for any free port
+        :param latency: seconds before answer
+        :param flood_every: answer 429 on every n-th call, 0 for never
+        :param retry_after: retry_after of 429 answers
+        :param keep_requests: count of last requests kept in `requests`, 0 for none
+        """
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.calls = Counter()
+        # last (method, params), older ones are dropped, so long benchmarks do not grow memory
+        self.requests = deque(maxlen=keep_requests)
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def api_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bot{{0}}/{{1}}'
+
+    def start(self) -> 'FakeTelegramServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-telegram', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.requests.clear()
+
+    def __enter__(self) -> 'FakeTelegramServer':
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def _answer(self, method: str, params: dict):
+        with self._lock:
+            self.calls[method] += 1
+            self.requests.append((method, params))
+            total = sum(self.calls.values())
+            self._message_id += 1
+            message_id = self._message_id
+        if self.latency:
+            time.sleep(self.latency)
+        if self.flood_every and total % self.flood_every == 0:
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f'Too Many Requests: retry after {self.retry_after}',
+                         'parameters': {'retry_after': self.retry_after}}
+        chat_id = params.get('chat_id', 0)
+        try:
+            chat_id = int(chat_id)
+        except ValueError:
+            pass
+        result = {'message_id': int(params.get('message_id') or message_id), 'date': int(time.time()),
+                  'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        return 200, {'ok': True, 'result': result}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately, without it every answer waits for delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    params.update(parse_qsl(self.rfile.read(length).decode('utf-8')))
+                status, answer = server._answer(method, params)
+                body = json.dumps(answer).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,215 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+from django.db import close_old_connections
+
+LOG = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def get_update_chat_id(update: Dict) -> int:
+    """
+    Get chat id of raw telegram update
+    :param update: update dict from telegram
+    :return: chat id or update id if update is not bound to chat
+    """
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update:
+            return update[key]['chat']['id']
+    callback_query = update.get('callback_query')
+    if callback_query:
+        if callback_query.get('message'):
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+    return update.get('update_id', 0)
+
+
+class Lane:
+    """
+    Serial lane, one thread handles its updates in order of arrival
+    """
+
+    def __init__(self, number: int, maxsize: int):
+        self.number = number
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread: Optional[threading.Thread] = None
+        self.processed = 0
+        self.max_depth = 0
+
+
+class UpdateDispatcher:
+    """
+    In-process dispatcher of raw telegram updates
+
+    Updates are sharded by chat id onto fixed set of serial lanes,
+    so updates of one chat never reorder or interleave while different chats are handled in parallel.
+    Webhook only puts update to lane and answers telegram at once,
+    when lane is full put() returns False and webhook asks telegram to retry later.
+    """
+
+    def __init__(self, process: Callable[[str, Dict], None], maxsize: int = 1000, lanes: int = 4):
+        """
+        :param process: function (token, update dict) which handle one update
+        :param maxsize: max updates waiting in all lanes
+        :param lanes: count of lanes, each lane has one thread
+        """
+        self._process = process
+        self._lanes = [Lane(i, max(maxsize // lanes, 1)) for i in range(lanes)]
+        self._started = False
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._accepting = True
+        self._pending_chats = Counter()
+        self._stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'processed': 0,
+            'failed': 0,
+            'busy_seconds': 0.0,
+        }
+
+    def start(self) -> None:
+        """
+        Start lane threads if they are not started yet
+        :return:
+        """
+        with self._lock:
+            if self._started:
+                return
+            for lane in self._lanes:
+                lane.thread = threading.Thread(target=self._work, args=(lane,), name=f'update-lane-{lane.number}',
+                                               daemon=True)
+                lane.thread.start()
+            self._started = True
+
+    def put(self, token: str, update: Dict) -> bool:
+        """
+        Put update to lane of its chat without blocking
+        :param token: telegram bot token
+        :param update: update dict from telegram
+        :return: False if lane is full or dispatcher is stopped
+        """
+        if not self._accepting:
+            self._incr('rejected')
+            return False
+        if not self._started:
+            self.start()
+        chat_id = get_update_chat_id(update)
+        lane = self._lanes[chat_id % len(self._lanes)]
+        try:
+            lane.queue.put_nowait((token, chat_id, update))
+        except queue.Full:
+            self._incr('rejected')
+            return False
+        depth = lane.queue.qsize()
+        with self._stats_lock:
+            self._stats['accepted'] += 1
+            self._pending_chats[chat_id] += 1
+            if depth > lane.max_depth:
+                lane.max_depth = depth
+        return True
+
+    def stats(self, top: int = 10) -> Dict:
+        """
+        Backpressure metrics of dispatcher
+        :param top: count of busiest chats to report
+        :return: dict with counters, lanes depth and chats with most pending updates
+        """
+        with self._stats_lock:
+            result = dict(self._stats)
+            result['busiest_chats'] = [{'chat_id': chat_id, 'pending': pending}
+                                       for chat_id, pending in self._pending_chats.most_common(top)]
+        result['lanes'] = [{'lane': lane.number,
+                            'depth': lane.queue.qsize(),
+                            'max_depth': lane.max_depth,
+                            'processed': lane.processed} for lane in self._lanes]
+        result['depth'] = sum(lane['depth'] for lane in result['lanes'])
+        result['capacity'] = sum(lane.queue.maxsize for lane in self._lanes)
+        result['accepting'] = self._accepting
+        return result
+
+    def shutdown(self, timeout: Optional[float] = None) -> bool:
+        """
+        Stop accepting new updates and wait while lanes drain
+        :param timeout: max seconds to wait
+        :return: True if all lanes were drained
+        """
+        self._accepting = False
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            started = self._started
+            self._started = False
+        if not started:
+            return True
+        stopping = []
+        for lane in self._lanes:
+            try:
+                lane.queue.put(_STOP, timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                # lane is still full when timeout is over, its thread is left running
+                continue
+            stopping.append(lane)
+        for lane in stopping:
+            lane.thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        drained = len(stopping) == len(self._lanes) and not any(lane.thread.is_alive() for lane in self._lanes)
+        if not drained:
+            LOG.error(f'update dispatcher is not drained, '
+                      f'{sum(lane.queue.qsize() for lane in self._lanes)} updates left')
+        return drained
+
+    def join(self) -> None:
+        """
+        Block until all queued updates are handled
+        :return:
+        """
+        for lane in self._lanes:
+            lane.queue.join()
+
+    def _work(self, lane: Lane) -> None:
+        while True:
+            item = lane.queue.get()
+            if item is _STOP:
+                lane.queue.task_done()
+                return
+            token, chat_id, update = item
+            started = time.monotonic()
+            close_old_connections()
+            try:
+                self._process(token, update)
+                self._incr('processed')
+            except Exception as err:
+                self._incr('failed')
+                LOG.exception(err)
+            finally:
+                close_old_connections()
+                with self._stats_lock:
+                    self._stats['busy_seconds'] += time.monotonic() - started
+                    lane.processed += 1
+                    self._pending_chats[chat_id] -= 1
+                    if self._pending_chats[chat_id] <= 0:
+                        del self._pending_chats[chat_id]
+                lane.queue.task_done()
+
+    def _incr(self, key: str, value=1) -> None:
+        with self._stats_lock:
+            self._stats[key] += value
+
+
+def create_update_dispatcher(process: Callable[[str, Dict], None], maxsize: int, lanes: int,
+                             drain_timeout: float) -> UpdateDispatcher:
+    """
+    Create update dispatcher which is drained on interpreter shutdown
+    :param process: function (token, update dict) which handle one update
+    :param maxsize: max updates waiting in all lanes
+    :param lanes: count of serial lanes
+    :param drain_timeout: seconds to wait for drain on shutdown
+    :return: UpdateDispatcher
+    """
+    dispatcher = UpdateDispatcher(process, maxsize=maxsize, lanes=lanes)
+    atexit.register(dispatcher.shutdown, drain_timeout)
+    return dispatcher
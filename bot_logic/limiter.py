@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Hashable
+from django.conf import settings
+
+
+class AttemptLimiter:
+    """
+    In-memory sliding window limiter of failed attempts, e.g. token login by (bot, chat)
+    """
+
+    def __init__(self, max_attempts: int = 5, window: float = 900.0):
+        """
+        :param max_attempts: failed attempts allowed in window
+        :param window: seconds of window
+        """
+        self.max_attempts = max_attempts
+        self.window = window
+        self._attempts: Dict[Hashable, Deque[float]] = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + window
+
+    def attempts_left(self, key: Hashable) -> int:
+        """
+        :param key: limited key
+        :return: count of attempts left in window, 0 if key is blocked
+        """
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if not attempts:
+                return self.max_attempts
+            self._expire(attempts, now)
+            return max(self.max_attempts - len(attempts), 0)
+
+    def fail(self, key: Hashable) -> int:
+        """
+        Count failed attempt
+        :param key: limited key
+        :return: count of attempts left in window
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            attempts = self._attempts.setdefault(key, deque())
+            self._expire(attempts, now)
+            attempts.append(now)
+            return max(self.max_attempts - len(attempts), 0)
+
+    def reset(self, key: Hashable) -> None:
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def _expire(self, attempts: Deque[float], now: float) -> None:
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+
+    def _sweep(self, now: float) -> None:
+        # drop keys without attempts in window, so memory is bounded by active keys
+        expired = [key for key, attempts in self._attempts.items() if not attempts or attempts[-1] <= now - self.window]
+        for key in expired:
+            del self._attempts[key]
+        self._next_sweep = now + self.window
+
+
+login_limiter = AttemptLimiter(max_attempts=settings.BOT_LOGIN_ATTEMPTS, window=settings.BOT_LOGIN_WINDOW)
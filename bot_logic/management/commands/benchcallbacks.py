@@ -0,0 +1,56 @@
+import timeit
+from django.core.management.base import BaseCommand
+from bot_logic.callback_router import callback_router, encode
+
+
+def legacy_resolve(data: str):
+    """
+    Callback parsing as it was done by chain of conditions in inline_logic
+    """
+    if data == "main_menu":
+        return 'main_menu', ()
+    elif data == "studding":
+        return 'studding', ()
+    elif data == "progress":
+        return 'progress', ()
+    elif 'topic_' in data:
+        try:
+            param = data.split('_')
+            return 'view_topic', (int(param[1]), int(param[2]))
+        except Exception:
+            return None
+    elif 'test_' in data:
+        try:
+            param = data.split('_')
+            return 'view_test', (int(param[1]), int(param[2]))
+        except Exception:
+            return None
+    elif 'answer_' in data:
+        try:
+            param = data.split('_')
+            return 'select_answer', (int(param[1]), int(param[2]), int(param[3]))
+        except Exception:
+            return None
+    return None
+
+
+class Command(BaseCommand):
+    help = 'Compare callback router with legacy chain of conditions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=200000, help='resolves per payload set')
+
+    def handle(self, *args, **options):
+        number = options['number']
+        legacy = ['main_menu', 'studding', 'progress', 'topic_1234_5', 'test_321_-1', 'test_321_7',
+                  'answer_98765_3_45678', 'answer_broken', 'unknown']
+        routed = [encode('main_menu'), encode('studding'), encode('progress'), encode('topic', 1234, 5),
+                  encode('test', 321, -1), encode('test', 321, 7), encode('answer', 98765, 3, 45678),
+                  '1a.broken', 'unknown']
+
+        for name, resolve, payloads in (('legacy chain', legacy_resolve, legacy),
+                                        ('callback router', callback_router.resolve, routed)):
+            seconds = timeit.timeit(lambda: [resolve(data) for data in payloads], number=number // len(payloads))
+            per_call = seconds / (number // len(payloads) * len(payloads)) * 1e9
+            self.stdout.write(f'{name:16} {per_call:8.0f} ns/callback')
+        self.stdout.write(f'longest callback data: {max(len(data) for data in routed)} bytes')
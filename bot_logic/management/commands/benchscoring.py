@@ -0,0 +1,99 @@
+import random
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from bot_logic.models import *
+from bot_logic.scoring import load_answer_key, rescore_test, score
+
+
+class Command(BaseCommand):
+    help = 'Measure throughput of test scoring: in memory and bulk re-scoring of finished attempts ' \
+           'on test Data Base'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--attempts', type=int, default=100000)
+        parser.add_argument('--students', type=int, default=10000)
+        parser.add_argument('--questions', type=int, default=10)
+        parser.add_argument('--answers', type=int, default=4, help='answer variants per question')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            started = time.monotonic()
+            test_id, submissions = self.create_dataset(options)
+            self.stdout.write(f'dataset: {options["attempts"]} attempts in {time.monotonic() - started:.1f}s')
+
+            key = load_answer_key(test_id)
+            started = time.perf_counter()
+            for selected in submissions:
+                score(key, selected)
+            seconds = time.perf_counter() - started
+            self.stdout.write(f'in memory: {len(submissions) / seconds:,.0f} attempts/s')
+
+            # fix answer key: second variant of first question is right too
+            question = TestQuestion.objects.filter(theorytest=test_id).order_by('pk').first()
+            answer = question.answers.order_by('pk')[1]
+            TestAnswer.objects.filter(pk=answer.pk).update(is_right=True)
+            started = time.perf_counter()
+            attempts, changed = rescore_test(test_id, batch_size=options['batch_size'])
+            seconds = time.perf_counter() - started
+            self.stdout.write(f'bulk re-scoring: {attempts} attempts, {changed} changed, {seconds:.1f}s, '
+                              f'{attempts / seconds:,.0f} attempts/s')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def create_dataset(self, options):
+        """
+        Create test and finished attempts with explicit pks
+        :return: test pk, selected answers of attempts
+        """
+        rnd = random.Random(options['seed'])
+        telegram_bot = TelegramBot.objects.create(name='bench', token='bench')
+        branch = RestaurantBranch.objects.create(main_restaurant=Restaurant.objects.create(name='bench', bot=telegram_bot),
+                                                 name='bench', address='bench')
+        staff = Staff.objects.create(restaurant_branch=branch, user=User.objects.create(username='bench'))
+        test = TheoryTest.objects.create(name='bench')
+        questions = []
+        for question_number in range(options['questions']):
+            question = TestQuestion.objects.create(question=f'question {question_number}')
+            TestAnswer.objects.bulk_create(TestAnswer(answer=f'answer {i}', is_right=i == 0)
+                                           for i in range(options['answers']))
+            answers = list(TestAnswer.objects.order_by('-pk').values_list('pk', flat=True)[:options['answers']])[::-1]
+            question.answers.add(*answers)
+            questions.append((question.pk, answers))
+        test.questions.add(*(question_id for question_id, _ in questions))
+        TheoryTopic.objects.create(restaurant=branch, creator=staff, name='bench', text='bench', test=test)
+
+        with transaction.atomic():
+            Student.objects.bulk_create((Student(pk=i + 1, staff=staff, telegram_bot=telegram_bot)
+                                         for i in range(options['students'])), batch_size=500)
+            StudentTheoryTopic.objects.bulk_create(
+                (StudentTheoryTopic(student_id=i + 1, theory_topic=test.theorytopic, blocked=False)
+                 for i in range(options['students'])), batch_size=500)
+
+            submissions = []
+            student_tests = []
+            student_answers = []
+            links = []
+            through = StudentTest.answers.through
+            for attempt in range(1, options['attempts'] + 1):
+                student_id = rnd.randrange(options['students']) + 1
+                student_test = StudentTest(pk=attempt, test=test, student_id=student_id, is_finished=True,
+                                           max_points=len(questions))
+                student_tests.append(student_test)
+                selected = {}
+                for question_id, answers in questions:
+                    answer_id = rnd.choice(answers)
+                    student_test.points += answer_id == answers[0]
+                    selected[question_id] = {answer_id}
+                    student_answers.append(StudentAnswer(pk=len(student_answers) + 1, student_id=student_id,
+                                                         question_id=question_id, answer_id=answer_id))
+                    links.append(through(studenttest_id=attempt, studentanswer_id=len(student_answers)))
+                submissions.append(selected)
+            StudentTest.objects.bulk_create(student_tests, batch_size=500)
+            StudentAnswer.objects.bulk_create(student_answers, batch_size=500)
+            through.objects.bulk_create(links, batch_size=500)
+        return test.pk, submissions
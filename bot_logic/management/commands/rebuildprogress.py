@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from bot_logic.models import Student
+from bot_logic.progress import rebuild_progress
+
+
+class Command(BaseCommand):
+    help = 'Rebuild progress summaries of students from StudentTheoryTopic and StudentTest, ' \
+           'or only check them for drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='report drifted summaries without writing')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        checked = drifted = 0
+        last_pk = 0
+        while True:
+            student_ids = list(Student.objects.filter(pk__gt=last_pk).order_by('pk')
+                               .values_list('pk', flat=True)[:options['batch_size']])
+            if not student_ids:
+                break
+            last_pk = student_ids[-1]
+            drifted += rebuild_progress(student_ids, write=not options['check'])
+            checked += len(student_ids)
+
+        if options['check']:
+            if drifted:
+                raise CommandError(f'{drifted} of {checked} progress summaries are missing or drifted')
+            self.stdout.write(f'{checked} progress summaries are up to date')
+        else:
+            self.stdout.write(f'{drifted} of {checked} progress summaries rebuilt')
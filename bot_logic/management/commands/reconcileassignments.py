@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from bot_logic.assignments import assign_topic, count_missing_assignments, remove_duplicate_assignments
+from bot_logic.models import TheoryTopic
+
+
+class Command(BaseCommand):
+    help = 'Create missing StudentTheoryTopic rows of all topics in all branches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='only count missing rows')
+        parser.add_argument('--dedupe', action='store_true',
+                            help='delete duplicate rows of student and topic, migrate does it before adding unique constraint')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['dedupe']:
+            duplicates = remove_duplicate_assignments(dry_run=options['dry_run'])
+            self.stdout.write(f'duplicate rows: {duplicates}')
+
+        total = 0
+        for topic in TheoryTopic.objects.order_by('pk').only('pk', 'restaurant_id'):
+            if options['dry_run']:
+                missing = count_missing_assignments(topic)
+            else:
+                missing = assign_topic(topic.pk, topic.restaurant_id, options['chunk_size'])
+            if missing:
+                self.stdout.write(f'topic {topic.pk}: {missing} students')
+            total += missing
+        self.stdout.write(f'{"missing" if options["dry_run"] else "created"} rows: {total}')
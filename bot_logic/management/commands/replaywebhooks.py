@@ -0,0 +1,282 @@
+import json
+import random
+import time
+from collections import defaultdict
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from bot_logic.models import *
+from bot_logic.callback_router import encode
+from bot_logic.fake_telegram import FakeTelegramServer
+from bot_logic.telegram_client import configure_api
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    Nearest-rank percentile
+    :param values: sorted values
+    :param percent: 0..100
+    :return: value
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))]
+
+
+class QueryCounter:
+    """
+    Execute wrapper of connection which counts SQL queries
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = 'Replay synthetic telegram updates through webhook view on test Data Base and fake Bot API, ' \
+           'report latency, SQL queries and telegram calls per update type'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bots', type=int, default=2, help='bots, every bot has one restaurant branch')
+        parser.add_argument('--students', type=int, default=2000, help='students per bot')
+        parser.add_argument('--active', type=int, default=100, help='students per bot who pass the course')
+        parser.add_argument('--topics', type=int, default=3, help='topics per branch')
+        parser.add_argument('--blocks', type=int, default=3, help='theory blocks per topic')
+        parser.add_argument('--questions', type=int, default=5, help='test questions per topic')
+        parser.add_argument('--answers', type=int, default=4, help='answer variants per question')
+        parser.add_argument('--latency', type=float, default=0.0, help='seconds of fake Bot API answer')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', help='save results as baseline JSON file')
+        parser.add_argument('--compare', help='baseline JSON file, fail if queries or latency exceed it')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='allowed relative growth of p95 latency over baseline')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with FakeTelegramServer(latency=options['latency']) as server, \
+                    override_settings(BOT_UPDATE_MODE='sync', TELEGRAM_GLOBAL_RATE=1e9,
+                                      TELEGRAM_CHAT_RATE=1e9, TELEGRAM_CHAT_BURST=1e9):
+                configure_api(api_url=server.api_url)
+                started = time.monotonic()
+                streams = self.create_dataset(options)
+                self.stdout.write(f'dataset: {time.monotonic() - started:.1f}s, {len(streams)} active chats')
+                results = self.replay(streams, server, random.Random(options['seed']))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results['config'] = {name: options[name] for name in ('bots', 'students', 'active', 'topics', 'blocks',
+                                                              'questions', 'answers', 'latency', 'seed')}
+        self.report(results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            self.stdout.write(f'baseline saved to {options["output"]}')
+        if baseline:
+            self.compare(results, baseline, options['tolerance'])
+
+    def create_dataset(self, options) -> list:
+        """
+        Create bots, branches, course content and students
+        :return: update streams of active students
+        """
+        rnd = random.Random(options['seed'])
+        city = City.objects.create()
+        streams = []
+        student_id = 0
+        for bot_number in range(options['bots']):
+            telegram_bot = TelegramBot.objects.create(name=f'bench {bot_number}', token=f'{bot_number}:bench')
+            restaurant = Restaurant.objects.create(name=f'bench {bot_number}', bot=telegram_bot)
+            branch = RestaurantBranch.objects.create(main_restaurant=restaurant, name='bench', city=city,
+                                                     address='bench')
+            staff = Staff.objects.create(restaurant_branch=branch, user=User.objects.create(username=f'bench{bot_number}'),
+                                         first_name='bench', second_name='bench')
+
+            topics = []
+            for topic_number in range(options['topics']):
+                last_topic = topic_number == options['topics'] - 1
+                test = TheoryTest.objects.create(name=f'test {topic_number}')
+                questions = []
+                for question_number in range(options['questions']):
+                    # open question in last test only, so every topic can be passed
+                    is_opened = last_topic and question_number == options['questions'] - 1
+                    question = TestQuestion.objects.create(question=f'question {question_number}', is_opened=is_opened)
+                    answers = []
+                    if not is_opened:
+                        TestAnswer.objects.bulk_create(
+                            TestAnswer(answer=f'answer {i}', is_right=i == 0) for i in range(options['answers']))
+                        answers = list(TestAnswer.objects.order_by('-pk')[:options['answers']])[::-1]
+                        question.answers.add(*answers)
+                    test.questions.add(question)
+                    questions.append((question, [answer.pk for answer in answers]))
+                topic = TheoryTopic.objects.create(restaurant=branch, creator=staff, name=f'topic {topic_number}',
+                                                   text='text', test=test)
+                TheoryBlock.objects.bulk_create(TheoryBlock(name=f'block {i}', text='text ' * 50)
+                                                for i in range(options['blocks']))
+                topic.blocks.add(*TheoryBlock.objects.order_by('-pk')[:options['blocks']])
+                topics.append((topic, questions))
+
+            # students by bulk insert with explicit pk, post_save handlers are not called
+            students = [Student(pk=student_id + i + 1, staff=staff, telegram_bot=telegram_bot)
+                        for i in range(options['students'])]
+            student_id += len(students)
+            Student.objects.bulk_create(students, batch_size=500)
+            StudentInfo.objects.bulk_create((StudentInfo(student=student) for student in students), batch_size=500)
+            settings = []
+            for student in students:
+                student_settings = StudentSettings(student=student)
+                student_settings.create_token()
+                settings.append(student_settings)
+            StudentSettings.objects.bulk_create(settings, batch_size=500)
+            StudentTheoryTopic.objects.bulk_create(
+                (StudentTheoryTopic(student=student, theory_topic=topic, blocked=i != 0)
+                 for student in students for i, (topic, _) in enumerate(topics)), batch_size=500)
+
+            for student_settings in rnd.sample(settings, min(options['active'], len(settings))):
+                streams.append(self.student_stream(telegram_bot.token, student_settings.student_id,
+                                                   1000000 + student_settings.student_id, student_settings.token,
+                                                   topics, options['blocks'], rnd))
+        return streams
+
+    def student_stream(self, token: str, student_id: int, chat_id: int, student_token: str, topics: list,
+                       blocks: int, rnd: random.Random):
+        """
+        Updates of one student passing the course
+        :return: generator of (update type, bot token, update)
+        """
+        update_id = chat_id * 1000
+
+        def message(text: str) -> dict:
+            nonlocal update_id
+            update_id += 1
+            data = {'message_id': update_id, 'date': 0, 'text': text,
+                    'chat': {'id': chat_id, 'type': 'private'},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'}}
+            if text.startswith('/'):
+                data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+            return {'update_id': update_id, 'message': data}
+
+        def callback(data: str) -> dict:
+            nonlocal update_id
+            update_id += 1
+            return {'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'chat_instance': str(chat_id), 'data': data,
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+                'message': {'message_id': 1, 'date': 0, 'text': 'bench', 'chat': {'id': chat_id, 'type': 'private'}}}}
+
+        yield 'start', token, message('/start')
+        yield 'login', token, message(student_token)
+        yield 'studding', token, callback(encode('studding'))
+        for topic, questions in topics:
+            for block_id in range(blocks):
+                yield 'topic', token, callback(encode('topic', topic.pk, block_id))
+            yield 'test_start', token, callback(encode('test', topic.test_id, -1))
+            student_test_id = None
+            for question_id, (question, answers) in enumerate(questions):
+                yield 'question', token, callback(encode('test', topic.test_id, question_id))
+                if question.is_opened:
+                    yield 'open_answer', token, message('open answer')
+                    continue
+                if student_test_id is None:
+                    student_test_id = StudentTest.objects.filter(student_id=student_id, test_id=topic.test_id,
+                                                                 is_finished=False).values_list('pk', flat=True).first()
+                yield 'answer', token, callback(encode('answer', student_test_id, question_id, rnd.choice(answers)))
+            yield 'finish', token, callback(encode('test', topic.test_id, len(questions)))
+        yield 'progress', token, callback(encode('progress'))
+        yield 'main_menu', token, callback(encode('main_menu'))
+
+    def replay(self, streams: list, server: FakeTelegramServer, rnd: random.Random) -> dict:
+        """
+        Send updates of interleaved student streams to webhook view one by one
+        :return: results
+        """
+        from bot_logic.views import get_web_hook, bot_registry, student_sessions
+
+        bot_registry.clear()
+        student_sessions.clear()
+        factory = RequestFactory()
+        counter = QueryCounter()
+        latencies = defaultdict(list)
+        queries = defaultdict(list)
+        calls = defaultdict(list)
+        streams = list(streams)
+        started = time.monotonic()
+        with connection.execute_wrapper(counter):
+            while streams:
+                i = rnd.randrange(len(streams))
+                try:
+                    update_type, token, update = next(streams[i])
+                except StopIteration:
+                    streams[i] = streams[-1]
+                    streams.pop()
+                    continue
+                request = factory.post('/', data=json.dumps(update), content_type='application/json')
+                counter.count = 0
+                calls_before = sum(server.calls.values())
+                update_started = time.perf_counter()
+                response = get_web_hook(request, token)
+                latencies[update_type].append(time.perf_counter() - update_started)
+                queries[update_type].append(counter.count)
+                calls[update_type].append(sum(server.calls.values()) - calls_before)
+                if response.status_code != 200:
+                    raise CommandError(f'{update_type} update answered {response.status_code}')
+        seconds = time.monotonic() - started
+        student_sessions.flush()
+
+        types = {}
+        for update_type, values in latencies.items():
+            values.sort()
+            types[update_type] = {
+                'count': len(values),
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'queries_mean': sum(queries[update_type]) / len(values),
+                'queries_max': max(queries[update_type]),
+                'telegram_calls_mean': sum(calls[update_type]) / len(values),
+            }
+        total = sum(len(values) for values in latencies.values())
+        return {'types': types, 'total': {'updates': total, 'seconds': seconds,
+                                          'updates_per_second': total / seconds if seconds else 0.0}}
+
+    def report(self, results: dict) -> None:
+        self.stdout.write(f'{"update":12} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+                          f'{"queries":>8} {"max q":>6} {"tg calls":>8}')
+        for update_type, row in sorted(results['types'].items()):
+            self.stdout.write(f'{update_type:12} {row["count"]:6} {row["p50_ms"]:8.2f} {row["p95_ms"]:8.2f} '
+                              f'{row["p99_ms"]:8.2f} {row["queries_mean"]:8.2f} {row["queries_max"]:6} '
+                              f'{row["telegram_calls_mean"]:8.2f}')
+        total = results['total']
+        self.stdout.write(f'{total["updates"]} updates in {total["seconds"]:.2f}s, '
+                          f'{total["updates_per_second"]:.0f} updates/s')
+
+    def compare(self, results: dict, baseline: dict, tolerance: float) -> None:
+        """
+        Check results against baseline budgets: max queries of update type must not grow,
+        p95 latency must not grow more than tolerance
+        """
+        if results['config'] != baseline.get('config'):
+            self.stdout.write(self.style.WARNING('baseline was made with other dataset options'))
+        failed = []
+        for update_type, row in sorted(results['types'].items()):
+            base = baseline['types'].get(update_type)
+            if not base:
+                continue
+            if row['queries_max'] > base['queries_max']:
+                failed.append(f'{update_type}: {row["queries_max"]} queries, budget {base["queries_max"]}')
+            if row['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+                failed.append(f'{update_type}: p95 {row["p95_ms"]:.2f} ms, baseline {base["p95_ms"]:.2f} ms')
+        if failed:
+            raise CommandError('performance regression:\n' + '\n'.join(failed))
+        self.stdout.write(self.style.SUCCESS('within baseline budgets'))
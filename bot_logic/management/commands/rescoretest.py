@@ -0,0 +1,21 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from bot_logic.models import TheoryTest
+from bot_logic.scoring import rescore_test
+
+
+class Command(BaseCommand):
+    help = 'Re-score finished attempts of tests with current answer key, use after fixing right answers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('test_ids', nargs='+', type=int, help='TheoryTest pks')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for test_id in options['test_ids']:
+            if not TheoryTest.objects.filter(pk=test_id).exists():
+                raise CommandError(f'test {test_id} not found')
+            started = time.monotonic()
+            attempts, changed = rescore_test(test_id, batch_size=options['batch_size'])
+            self.stdout.write(f'test {test_id}: {changed} of {attempts} attempts changed '
+                              f'in {time.monotonic() - started:.1f}s')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from bot_logic.fake_telegram import FakeTelegramServer
+
+
+class Command(BaseCommand):
+    help = 'Run local stand-in of telegram Bot API, use printed url as TELEGRAM_API_URL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--latency', type=float, default=0.0, help='seconds before every answer')
+        parser.add_argument('--flood-every', type=int, default=0, help='answer 429 on every n-th call')
+
+    def handle(self, *args, **options):
+        server = FakeTelegramServer(port=options['port'], latency=options['latency'],
+                                    flood_every=options['flood_every'])
+        self.stdout.write(f'fake telegram API: {server.api_url}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.stop()
@@ -1,10 +1,15 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.fields.files import FieldFile
 from django.contrib.auth.models import User
 from django.utils.timezone import now
-from django.db.models.signals import post_save
+from django.db.models import Count, Q
+from django.db.models.signals import post_save, pre_migrate, post_migrate, m2m_changed
 from django.dispatch import receiver
+import json
 import string
-import random
+import secrets
+from typing import Optional
 
 
 # Create your models here.
@@ -17,6 +22,45 @@ class NonStrippingTextField(models.TextField):
         return super(NonStrippingTextField, self).formfield(**kwargs)
 
 
+class DirtyFieldsMixin:
+    """
+    Tracks values of fields loaded from Data Base or saved last time,
+    save() of existing row without update_fields writes changed columns only and skips saving if nothing changed
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # field_names are attnames of loaded fields, deferred fields are not tracked
+        instance._saved_values = dict(zip(field_names, values))
+        return instance
+
+    def _field_value(self, field):
+        value = getattr(self, field.attname)
+        return value.name if isinstance(value, FieldFile) else value
+
+    def get_dirty_fields(self) -> Optional[list]:
+        """
+        :return: attnames of changed fields or None if values of Data Base are unknown
+        """
+        saved = getattr(self, '_saved_values', None)
+        if saved is None:
+            return None
+        return [field.attname for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname in saved and self._field_value(field) != saved[field.attname]]
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is None and not force_insert and not self._state.adding:
+            update_fields = self.get_dirty_fields()
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+        saved = getattr(self, '_saved_values', None)
+        if update_fields is None or saved is None:
+            self._saved_values = {field.attname: self._field_value(field) for field in self._meta.concrete_fields}
+        else:
+            saved.update({field.attname: self._field_value(field) for field in self._meta.concrete_fields
+                          if field.attname in update_fields or field.name in update_fields})
+
+
 def create_user_file_path(instance, filename):
     """
     create path for user avatars
@@ -76,7 +120,7 @@ class Staff(models.Model):
         return f"{self.pk} {self.first_name} {self.second_name} "
 
 
-class Student(models.Model):
+class Student(DirtyFieldsMixin, models.Model):
     """
     Simple worker in restaurant, work with Telegram
     """
@@ -88,26 +132,33 @@ class Student(models.Model):
     current_open_question = models.IntegerField(null=True, blank=True, default=None)
 
 
-class StudentSettings(models.Model):
+# length of student login token
+TOKEN_LENGTH = 16
+
+
+class StudentSettings(DirtyFieldsMixin, models.Model):
     """
     Student settings for change business logic
     """
     student = models.OneToOneField(Student, on_delete=models.CASCADE)
-    token = models.CharField(max_length=16, default=None, null=True)
+    token = models.CharField(max_length=TOKEN_LENGTH, default=None, null=True, unique=True)
     language = models.CharField(max_length=4, default='ru')
 
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
         if not self.token:
             self.create_token()
-        super(StudentSettings, self).save()
+            if update_fields is not None:
+                update_fields = set(update_fields) | {'token'}
+        super(StudentSettings, self).save(force_insert=force_insert, force_update=force_update, using=using,
+                                          update_fields=update_fields)
 
     def create_token(self):
         letters = string.ascii_lowercase
-        self.token = ''.join(random.choice(letters) for i in range(32))
+        self.token = ''.join(secrets.choice(letters) for i in range(TOKEN_LENGTH))
 
 
-class StudentInfo(models.Model):
+class StudentInfo(DirtyFieldsMixin, models.Model):
     """
     Student Info for staff interface
     """
@@ -148,6 +199,8 @@ class TestQuestion(models.Model):
     """
     question = NonStrippingTextField()
     is_opened = models.BooleanField(default=False)
+    # student may select several answers, tap on selected answer unselects it
+    is_multiple = models.BooleanField(default=False)
     answers = models.ManyToManyField(TestAnswer, blank=True)
 
 
@@ -157,6 +210,19 @@ class TheoryTest(models.Model):
     """
     name = models.CharField(max_length=255)
     questions = models.ManyToManyField(TestQuestion)
+    # JSON list of question pks in order of test, questions missing in it go last by pk
+    question_order = models.TextField(default='[]', blank=True)
+
+    def get_question_order(self) -> list:
+        return json.loads(self.question_order or '[]')
+
+    def set_question_order(self, question_ids: list) -> None:
+        """
+        Write order of questions by one UPDATE
+        :param question_ids: question pks in order of test
+        """
+        self.question_order = json.dumps(question_ids)
+        TheoryTest.objects.filter(pk=self.pk).update(question_order=self.question_order)
 
 
 class TheoryBlock(models.Model):
@@ -188,6 +254,9 @@ class StudentTheoryTopic(models.Model):
     finished = models.BooleanField(default=False)
     blocked = models.BooleanField(default=True)
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['student', 'theory_topic'], name='unique_student_theory_topic')]
+
 
 class StudentAnswer(models.Model):
     """
@@ -212,25 +281,132 @@ class StudentTest(models.Model):
     max_points = models.PositiveSmallIntegerField(default=0, null=True, blank=True)
     opened_questions = models.PositiveSmallIntegerField(default=0, null=True, blank=True)
     max_opened_questions = models.PositiveSmallIntegerField(default=0, null=True, blank=True)
+    # answers of test in progress, answers are written to StudentAnswer when test is finished
+    draft = models.TextField(default=None, null=True, blank=True)
+
+    def get_draft(self) -> dict:
+        """
+        Answers of test in progress
+        :return: {str question pk: [selected answer pks] or open answer text}
+        """
+        if self.draft is not None:
+            return json.loads(self.draft)
+        # test started before drafts
+        draft = {}
+        for question_id, answer_id, text in self.answers.values_list('question_id', 'answer_id', 'text'):
+            if answer_id:
+                draft.setdefault(str(question_id), []).append(answer_id)
+            elif text:
+                draft[str(question_id)] = text
+        return draft
+
+    def save_draft(self, draft: dict) -> None:
+        """
+        Write answers of test in progress by one UPDATE
+        :param draft: see get_draft()
+        """
+        self.draft = json.dumps(draft, separators=(',', ':'))
+        StudentTest.objects.filter(pk=self.pk).update(draft=self.draft)
+
+
+class StudentProgress(models.Model):
+    """
+    Denormalized progress of student, maintained by bot_logic.progress.sync_progress
+    topics: JSON {theory topic pk: state of StudentTheoryTopic}
+    scores: JSON {test pk: result of last finished StudentTest}
+    """
+    student = models.OneToOneField(Student, on_delete=models.CASCADE, related_name='progress')
+    topics_total = models.PositiveIntegerField(default=0)
+    topics_unlocked = models.PositiveIntegerField(default=0)
+    topics_finished = models.PositiveIntegerField(default=0)
+    pending_reviews = models.PositiveIntegerField(default=0)
+    topics = models.TextField(default='{}')
+    scores = models.TextField(default='{}')
+    last_activity = models.DateTimeField(default=None, null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def get_topics(self) -> dict:
+        return json.loads(self.topics)
+
+    def get_scores(self) -> dict:
+        return json.loads(self.scores)
+
+
+@receiver(m2m_changed, sender=TheoryTest.questions.through)
+def keep_question_order(sender, instance, action: str, reverse: bool, pk_set: set, **kwargs):
+    """
+    Append added questions to the end of test question order, drop removed ones
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear', 'post_clear'):
+        return
+    if not reverse:
+        tests = [instance]
+        question_ids = pk_set or set()
+    elif action == 'pre_clear':
+        # tests of question are unknown after clear
+        instance._cleared_tests = list(instance.theorytest_set.all())
+        return
+    else:
+        tests = getattr(instance, '_cleared_tests', []) if action == 'post_clear' else \
+            TheoryTest.objects.filter(pk__in=pk_set)
+        question_ids = {instance.pk}
+
+    for test in tests:
+        order = test.get_question_order()
+        if action == 'post_add':
+            order += sorted(question_ids - set(order))
+        elif action == 'post_remove' or reverse:
+            order = [question_id for question_id in order if question_id not in question_ids]
+        elif action == 'post_clear':
+            order = []
+        else:
+            continue
+        test.set_question_order(order)
+
+
+@receiver(pre_migrate)
+def dedupe_student_topics(sender, using: str, **kwargs):
+    """
+    Delete duplicate StudentTheoryTopic rows before migration adds unique constraint of student and topic
+    """
+    if sender.name != 'bot_logic':
+        return
+    from .assignments import needs_assignment_dedupe, remove_duplicate_assignments
+    if needs_assignment_dedupe(using):
+        remove_duplicate_assignments(using=using)
+
+
+@receiver(post_migrate)
+def mark_multiple_answer_questions(sender, using: str, **kwargs):
+    """
+    Questions with several right answers are answered only by several selected answers,
+    so they are multiple answer questions, also the ones created before is_multiple
+    """
+    if sender.name != 'bot_logic':
+        return
+    question_ids = list(TestQuestion.objects.using(using).filter(is_multiple=False).annotate(
+        right_answers=Count('answers', filter=Q(answers__is_right=True))).filter(
+        right_answers__gt=1).values_list('pk', flat=True))
+    if question_ids:
+        TestQuestion.objects.using(using).filter(pk__in=question_ids).update(is_multiple=True)
 
 
 @receiver(post_save, sender=TheoryTopic)
 def create_student_topic(sender, instance, created, **kwargs):
     if created:
-        staffs = Staff.objects.filter(restaurant_branch=instance.restaurant).all()
-        for staff in staffs:
-            students = Student.objects.filter(staff=staff).all()
-            for student in students:
-                StudentTheoryTopic.objects.create(student=student, theory_topic=instance)
+        from .assignments import assign_topic, assignment_jobs
+        if settings.BOT_ASSIGN_IN_BACKGROUND:
+            transaction.on_commit(lambda: assignment_jobs.start(instance.pk, instance.restaurant_id))
+        else:
+            assign_topic(instance.pk, instance.restaurant_id, settings.BOT_ASSIGN_CHUNK_SIZE)
 
 
 @receiver(post_save, sender=Student)
 def create_student_additional_tables(sender: Student, instance: Student, created: bool, **kwargs):
     if created:
         StudentInfo.objects.create(student=instance)
-        student_settings = StudentSettings.objects.create(student=instance)
-        student_settings.create_token()
-        student_settings.save()
+        # token is created on save
+        StudentSettings.objects.create(student=instance)
         # topics = TheoryTopic.objects.filter(restaurant__staff=instance.staff).all()
         # for topic in topics:
         #    StudentTheoryTopic.objects.create(student=instance, theory_topic=topic)
@@ -238,7 +414,11 @@ def create_student_additional_tables(sender: Student, instance: Student, created
 
 @receiver(post_save, sender=Student)
 def save_student_additional_tables(sender: Student, instance: Student, **kwargs):
-    instance.studentinfo.save()
-    instance.studentsettings.save()
+    # only loaded and changed satellite rows
+    for descriptor in (Student.studentinfo, Student.studentsettings):
+        if descriptor.related.is_cached(instance):
+            satellite = descriptor.related.get_cached_value(instance)
+            if satellite is not None and satellite.get_dirty_fields() != []:
+                satellite.save()
 
 
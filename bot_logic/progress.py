@@ -0,0 +1,115 @@
+import json
+from typing import Dict, Iterable
+from django.db.models import QuerySet
+from django.utils.timezone import now
+from .models import StudentTheoryTopic, StudentTest, StudentProgress
+
+# fields of StudentProgress computed from StudentTheoryTopic and StudentTest
+PROGRESS_FIELDS = ('topics_total', 'topics_unlocked', 'topics_finished', 'pending_reviews', 'topics', 'scores')
+
+
+def build_progress(student_ids: Iterable[int]) -> Dict[int, dict]:
+    """
+    Compute progress summary of students by 2 queries
+    :param student_ids: Student pks
+    :return: {student pk: {field of StudentProgress: value}}
+    """
+    student_ids = list(student_ids)
+    results = {student_id: {'topics_total': 0, 'topics_unlocked': 0, 'topics_finished': 0, 'pending_reviews': 0,
+                            'topics': {}, 'scores': {}} for student_id in student_ids}
+
+    for row in StudentTheoryTopic.objects.filter(student_id__in=student_ids).order_by('pk').values(
+            'pk', 'student_id', 'theory_topic_id', 'blocked', 'finished', 'complete_theory', 'complete_test',
+            'complete_opened_questions'):
+        progress = results[row['student_id']]
+        # first row of topic wins, as in StudentLogic
+        if str(row['theory_topic_id']) in progress['topics']:
+            continue
+        progress['topics'][str(row['theory_topic_id'])] = {
+            'student_topic': row['pk'], 'blocked': row['blocked'], 'finished': row['finished'],
+            'complete_theory': row['complete_theory'], 'complete_test': row['complete_test'],
+            'complete_opened_questions': row['complete_opened_questions']}
+        progress['topics_total'] += 1
+        progress['topics_unlocked'] += not row['blocked']
+        progress['topics_finished'] += row['finished']
+
+    for row in StudentTest.objects.filter(student_id__in=student_ids, is_finished=True).order_by('pk').values(
+            'pk', 'student_id', 'test_id', 'points', 'max_points', 'opened_questions', 'max_opened_questions',
+            'is_check_staff'):
+        progress = results[row['student_id']]
+        # last finished attempt wins
+        progress['scores'][str(row['test_id'])] = {
+            'student_test': row['pk'], 'points': row['points'], 'max_points': row['max_points'],
+            'opened_questions': row['opened_questions'], 'max_opened_questions': row['max_opened_questions']}
+        progress['pending_reviews'] += not row['is_check_staff']
+
+    for progress in results.values():
+        progress['topics'] = json.dumps(progress['topics'], sort_keys=True)
+        progress['scores'] = json.dumps(progress['scores'], sort_keys=True)
+    return results
+
+
+def sync_progress(student_id: int, activity: bool = True) -> StudentProgress:
+    """
+    Recompute progress summary of student, call in transaction of the change
+    :param student_id: Student pk
+    :param activity: change is made by student, update last_activity
+    :return: StudentProgress
+    """
+    fields = build_progress([student_id])[student_id]
+    if activity:
+        fields['last_activity'] = now()
+    fields['updated'] = now()
+    if not StudentProgress.objects.filter(student_id=student_id).update(**fields):
+        StudentProgress.objects.create(student_id=student_id, **fields)
+    return StudentProgress(student_id=student_id, **fields)
+
+
+def get_progress(student_id: int) -> StudentProgress:
+    """
+    Get progress summary of student, build it on first use
+    :param student_id: Student pk
+    :return: StudentProgress
+    """
+    progress = StudentProgress.objects.filter(student_id=student_id).first()
+    if progress is None:
+        progress = sync_progress(student_id, activity=False)
+    return progress
+
+
+def rebuild_progress(student_ids: Iterable[int], write: bool = True) -> int:
+    """
+    Compare progress summaries of students with computed ones and fix them
+    :param student_ids: Student pks
+    :param write: write fixed summaries, else only count them
+    :return: count of missing or drifted summaries
+    """
+    built = build_progress(student_ids)
+    stored = {progress.student_id: progress for progress in StudentProgress.objects.filter(student_id__in=list(built))}
+    changed = []
+    created = []
+    for student_id, fields in built.items():
+        progress = stored.get(student_id)
+        if progress is None:
+            created.append(StudentProgress(student_id=student_id, **fields))
+        elif any(getattr(progress, field) != fields[field] for field in PROGRESS_FIELDS):
+            for field in PROGRESS_FIELDS:
+                setattr(progress, field, fields[field])
+            changed.append(progress)
+    if write:
+        # summary can be created by concurrent request meanwhile
+        StudentProgress.objects.bulk_create(created, ignore_conflicts=True)
+        StudentProgress.objects.bulk_update(changed, PROGRESS_FIELDS)
+    return len(created) + len(changed)
+
+
+def ensure_progress(students: QuerySet) -> int:
+    """
+    Build missing progress summaries, e.g. of students created before summaries, by one query if nothing is missing
+    :param students: queryset of Student
+    :return: count of built summaries
+    """
+    missing = list(students.filter(progress__isnull=True).values_list('pk', flat=True))
+    if missing:
+        rebuild_progress(missing)
+    return len(missing)
@@ -0,0 +1,83 @@
+import logging
+import threading
+from typing import Callable, Dict, Optional
+from django.db.models.signals import post_save, post_delete
+from telebot import TeleBot
+from .models import TelegramBot
+
+LOG = logging.getLogger(__name__)
+
+
+class BotEntry:
+    """
+    Long-lived bot client together with resolved TelegramBot row
+    """
+    __slots__ = ('bot', 'telegram_bot')
+
+    def __init__(self, bot: TeleBot, telegram_bot: TelegramBot):
+        """
+        :param bot: TeleBot object with registered handlers
+        :param telegram_bot: TelegramBot object for this token
+        """
+        self.bot = bot
+        self.telegram_bot = telegram_bot
+
+
+class BotRegistry:
+    """
+    Keeps one TeleBot object per TelegramBot row, keyed by token
+
+    Entries are created on first use and dropped when any TelegramBot is saved or deleted,
+    so a warm registry dispatches updates without queries for resolving bot.
+    """
+
+    def __init__(self, setup_handlers: Callable[[TeleBot, TelegramBot], None],
+                 create_bot: Callable[[str], TeleBot] = None):
+        """
+        :param setup_handlers: function registering handlers on new TeleBot object
+        :param create_bot: function creating TeleBot object for token
+        """
+        self._setup_handlers = setup_handlers
+        self._create_bot = create_bot or (lambda token: TeleBot(token, threaded=False))
+        self._entries: Dict[str, BotEntry] = {}
+        self._lock = threading.Lock()
+        post_save.connect(self._invalidate, sender=TelegramBot, weak=False, dispatch_uid=f'bot_registry_save_{id(self)}')
+        post_delete.connect(self._invalidate, sender=TelegramBot, weak=False, dispatch_uid=f'bot_registry_delete_{id(self)}')
+
+    def get(self, token: str) -> Optional[BotEntry]:
+        """
+        Get bot entry for token, create it if bot exists in Data Base
+        :param token: telegram bot token from webhook url
+        :return: BotEntry or None if bot does not exist
+        """
+        entry = self._entries.get(token)
+        if entry is not None:
+            return entry
+
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is not None:
+                return entry
+            telegram_bot = TelegramBot.objects.filter(token=token).first()
+            if not telegram_bot:
+                return None
+            bot = self._create_bot(telegram_bot.token)
+            self._setup_handlers(bot, telegram_bot)
+            entry = BotEntry(bot, telegram_bot)
+            # copy on write, readers never see half-filled dict
+            entries = dict(self._entries)
+            entries[token] = entry
+            self._entries = entries
+        return entry
+
+    def clear(self) -> None:
+        """
+        Drop all bot entries
+        :return:
+        """
+        with self._lock:
+            self._entries = {}
+
+    def _invalidate(self, sender, instance: TelegramBot, **kwargs) -> None:
+        LOG.debug(f'invalidate bot registry, bot {instance.pk} changed')
+        self.clear()
@@ -0,0 +1,181 @@
+import json
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from typing import Callable, Dict, Hashable, NamedTuple, Sequence, Tuple
+from .callback_router import encode
+from .content import BranchContent, TopicSnapshot, TestSnapshot
+
+# markers of topic state in studding menu
+TOPIC_FINISHED = '✅'
+TOPIC_OPENED = '🔓'
+TOPIC_BLOCKED = '🔒'
+
+
+class RenderCache:
+    """
+    LRU cache of rendered screen parts
+
+    Keys of content screens contain version of content snapshot, so parts of old content
+    are never served and are pushed out by new ones.
+    """
+
+    def __init__(self, maxsize: int = 2048):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, build: Callable):
+        """
+        Get cached value or build and cache it
+        :param key: cache key
+        :param build: function without arguments which builds value
+        :return: value
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+        value = build()
+        with self._lock:
+            self.misses += 1
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+
+render_cache = RenderCache(maxsize=settings.BOT_RENDER_CACHE_SIZE)
+
+
+def _button(text: str, callback_data: str) -> str:
+    return json.dumps({'text': text, 'callback_data': callback_data})
+
+
+def _keyboard(rows: Sequence[Sequence[str]]) -> str:
+    return '{"inline_keyboard": [' + ', '.join('[' + ', '.join(row) + ']' for row in rows) + ']}'
+
+
+def render_main_menu() -> str:
+    """
+    :return: reply_markup of main menu
+    """
+    return render_cache.get(('main_menu',), lambda: _keyboard([[_button('Учиться', encode('studding')),
+                                                                 _button('Мой Прогресс', encode('progress'))]]))
+
+
+def render_studding(content: BranchContent, markers: Sequence[str]) -> str:
+    """
+    :param content: branch content
+    :param markers: marker of every content topic (TOPIC_FINISHED, TOPIC_OPENED or TOPIC_BLOCKED)
+    :return: reply_markup of studding menu
+    """
+    def build() -> Tuple[Tuple[Dict[str, str], ...], str]:
+        topics = tuple({marker: '[' + _button(f'{marker} {topic.name}', encode('topic', topic.id, 0)) + ']'
+                        for marker in (TOPIC_FINISHED, TOPIC_OPENED, TOPIC_BLOCKED)}
+                       for topic in content.topics)
+        return topics, '[' + _button('Назад', encode('main_menu')) + ']'
+
+    topics, back = render_cache.get(('studding', content.branch_id, content.version), build)
+    rows = [variants[marker] for variants, marker in zip(topics, markers)]
+    rows.append(back)
+    return '{"inline_keyboard": [' + ', '.join(rows) + ']}'
+
+
+def render_topic_block(content: BranchContent, topic: TopicSnapshot, block_id: int, template: str) -> Tuple[str, str]:
+    """
+    :param content: branch content
+    :param topic: topic of content
+    :param block_id: number of block
+    :param template: message template with block name and text
+    :return: text and reply_markup of theory block
+    """
+    def build() -> Tuple[str, str]:
+        block = topic.blocks[block_id]
+        buttons = []
+        if block_id != 0:
+            buttons.append(_button('Назад', encode('topic', topic.id, block_id - 1)))
+        buttons.append(_button('К разделу', encode('studding')))
+        if block_id < len(topic.blocks) - 1:
+            buttons.append(_button('Дальше', encode('topic', topic.id, block_id + 1)))
+        elif topic.test_id:
+            buttons.append(_button('Пройти тест', encode('test', topic.test_id, -1)))
+        else:
+            buttons.append(_button('Завершить раздел', encode('completetopic', topic.id)))
+        return template.format(block.name, block.text), _keyboard([buttons])
+
+    return render_cache.get(('topic', content.version, topic.id, block_id, template), build)
+
+
+def render_test_start(content: BranchContent, test: TestSnapshot) -> Tuple[str, str]:
+    """
+    :param content: branch content
+    :param test: test of content
+    :return: text and reply_markup of test start screen
+    """
+    def build() -> Tuple[str, str]:
+        topic = content.topics_by_id[test.topic_id]
+        return test.name, _keyboard([[_button('Назад к теории', encode('topic', topic.id, len(topic.blocks) - 1)),
+                                      _button('Начать тест', encode('test', test.id, 0))]])
+
+    return render_cache.get(('test_start', content.version, test.id), build)
+
+
+class QuestionTemplate(NamedTuple):
+    text: str
+    # (answer pk, checked button head, unchecked button head, button tail), student test pk goes between
+    answers: Tuple[Tuple[int, str, str, str], ...]
+    navigation: str
+
+
+def render_question(content: BranchContent, test: TestSnapshot, question_id: int, student_test_id: int,
+                    selected: frozenset = frozenset()) -> Tuple[str, str]:
+    """
+    :param content: branch content
+    :param test: test of content
+    :param question_id: number of question
+    :param student_test_id: StudentTest pk
+    :param selected: pk of selected answers
+    :return: text and reply_markup of question, text of opened question has no current answer
+    """
+    def build() -> QuestionTemplate:
+        question = test.questions[question_id]
+        answers = []
+        if not question.is_opened:
+            for answer in question.answers:
+                # split button at student test pk, callback data is the last field of button
+                callback_data = encode('answer', '$', question_id, answer.id)
+                checked, tail = _button(f'✔ {answer.answer}', callback_data).rsplit('$', 1)
+                unchecked = _button(f'🔳 {answer.answer}', callback_data).rsplit('$', 1)[0]
+                answers.append((answer.id, '[' + checked, '[' + unchecked, tail + ']'))
+
+        if question_id == len(test.questions) - 1:
+            navigation = [_button('⬅', encode('test', test.id, question_id - 1)),
+                          _button('Завершить тест', encode('test', test.id, question_id + 1))]
+        elif question_id == 0:
+            navigation = [_button('➡', encode('test', test.id, question_id + 1))]
+        else:
+            navigation = [_button('⬅', encode('test', test.id, question_id - 1)),
+                          _button('➡', encode('test', test.id, question_id + 1))]
+
+        if not question.is_opened:
+            text = f"Вопрос {question_id + 1}.\n\n{question.question}"
+        else:
+            text = f"Вопрос {question_id + 1}.\n\n{question.question}\n\n" \
+                   f"Это открытый вопрос, напишите на него ответ, он будет отправлен на проверку\n"
+        return QuestionTemplate(text, tuple(answers), '[' + ', '.join(navigation) + ']')
+
+    template = render_cache.get(('question', content.version, test.id, question_id), build)
+    student_test_id = str(student_test_id)
+    rows = [(checked if answer_id in selected else unchecked) + student_test_id + tail
+            for answer_id, checked, unchecked, tail in template.answers]
+    rows.append(template.navigation)
+    return template.text, '{"inline_keyboard": [' + ', '.join(rows) + ']}'
@@ -0,0 +1,135 @@
+from collections import defaultdict
+from types import MappingProxyType
+from typing import Dict, Iterable, Mapping, NamedTuple, Tuple
+from django.db import transaction
+from .content import TestSnapshot
+from .models import TestQuestion, StudentTest, StudentTheoryTopic, TheoryTopic
+from .progress import rebuild_progress
+
+
+class AnswerKey(NamedTuple):
+    """
+    Right answers of test
+    """
+    test_id: int
+    # closed question pk -> pks of right answers, question with several right answers needs all of them
+    right_answers: MappingProxyType
+    opened_questions: frozenset
+
+
+class Score(NamedTuple):
+    points: int
+    max_points: int
+    opened_questions: int
+    max_opened_questions: int
+
+    @property
+    def passed(self) -> bool:
+        return not self.max_points or self.points / self.max_points > 0.5
+
+
+def answer_key_from_snapshot(test: TestSnapshot) -> AnswerKey:
+    """
+    :param test: test of content snapshot
+    :return: AnswerKey
+    """
+    return AnswerKey(test.id,
+                     MappingProxyType({question.id: question.right_answers
+                                       for question in test.questions if not question.is_opened}),
+                     frozenset(question.id for question in test.questions if question.is_opened))
+
+
+def load_answer_key(test_id: int) -> AnswerKey:
+    """
+    Load answer key of test by 2 queries
+    :param test_id: TheoryTest pk
+    :return: AnswerKey
+    """
+    questions = dict(TestQuestion.objects.filter(theorytest=test_id).values_list('pk', 'is_opened'))
+    right_answers = defaultdict(set)
+    for question_id, answer_id in TestQuestion.answers.through.objects.filter(
+            testquestion__theorytest=test_id, testanswer__is_right=True).values_list('testquestion_id', 'testanswer_id'):
+        right_answers[question_id].add(answer_id)
+    return AnswerKey(test_id,
+                     MappingProxyType({question_id: frozenset(right_answers[question_id])
+                                       for question_id, is_opened in questions.items() if not is_opened}),
+                     frozenset(question_id for question_id, is_opened in questions.items() if is_opened))
+
+
+def score(key: AnswerKey, selected: Mapping[int, Iterable[int]]) -> Score:
+    """
+    Score submission: closed question gives a point if selected answers are exactly its right answers
+    :param key: AnswerKey of test
+    :param selected: question pk -> pks of selected answers
+    :return: Score
+    """
+    points = 0
+    for question_id, right in key.right_answers.items():
+        answers = selected.get(question_id)
+        if answers and right == frozenset(answers):
+            points += 1
+    return Score(points, len(key.right_answers), 0, len(key.opened_questions))
+
+
+def load_selected(student_test_ids: Iterable[int]) -> Dict[int, Dict[int, set]]:
+    """
+    Load selected answers of student tests by one query
+    :param student_test_ids: StudentTest pks
+    :return: {student test pk: {question pk: pks of selected answers}}
+    """
+    results = defaultdict(lambda: defaultdict(set))
+    for student_test_id, question_id, answer_id in StudentTest.answers.through.objects.filter(
+            studenttest_id__in=student_test_ids, studentanswer__answer__isnull=False).values_list(
+            'studenttest_id', 'studentanswer__question_id', 'studentanswer__answer_id'):
+        results[student_test_id][question_id].add(answer_id)
+    return results
+
+
+def rescore_test(test_id: int, batch_size: int = 1000) -> Tuple[int, int]:
+    """
+    Re-score all finished attempts of test with current answer key,
+    then update complete_test of students topic by their last attempt and their progress summaries
+    :param test_id: TheoryTest pk
+    :param batch_size: attempts per batch
+    :return: (count of attempts, count of changed attempts)
+    """
+    key = load_answer_key(test_id)
+    attempts = changed = 0
+    # student pk -> score of last finished attempt
+    last_scores: Dict[int, Score] = {}
+    last_pk = 0
+    while True:
+        batch = list(StudentTest.objects.filter(test_id=test_id, is_finished=True, pk__gt=last_pk).order_by('pk')
+                     .only('pk', 'student_id', 'points', 'max_points', 'max_opened_questions')[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        selected = load_selected([student_test.pk for student_test in batch])
+        # changed attempts grouped by new score, few groups as score has few values
+        updated = defaultdict(list)
+        for student_test in batch:
+            new = score(key, selected.get(student_test.pk, {}))
+            last_scores[student_test.student_id] = new
+            if (student_test.points, student_test.max_points, student_test.max_opened_questions) != \
+                    (new.points, new.max_points, new.max_opened_questions):
+                updated[new].append(student_test.pk)
+        with transaction.atomic():
+            for new, student_test_ids in updated.items():
+                StudentTest.objects.filter(pk__in=student_test_ids).update(
+                    points=new.points, max_points=new.max_points, max_opened_questions=new.max_opened_questions)
+        attempts += len(batch)
+        changed += sum(len(student_test_ids) for student_test_ids in updated.values())
+
+    student_ids = list(last_scores)
+    topic_id = TheoryTopic.objects.filter(test_id=test_id).values_list('pk', flat=True).first()
+    for i in range(0, len(student_ids), batch_size):
+        batch = student_ids[i:i + batch_size]
+        with transaction.atomic():
+            if topic_id:
+                for passed in (True, False):
+                    StudentTheoryTopic.objects.filter(
+                        theory_topic_id=topic_id,
+                        student_id__in=[student_id for student_id in batch if last_scores[student_id].passed == passed]
+                    ).update(complete_test=passed)
+            rebuild_progress(batch)
+    return attempts, changed
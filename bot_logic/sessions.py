@@ -0,0 +1,176 @@
+import atexit
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from django.db import close_old_connections
+from django.db.models.signals import post_save, post_delete
+from .models import Student, Staff
+
+LOG = logging.getLogger(__name__)
+
+# columns of Student which belong to conversation state
+SESSION_FIELDS = ('step', 'current_test', 'current_open_question')
+
+
+class StudentSession:
+    """
+    Compact conversation state of student in one chat
+    """
+    __slots__ = ('student_id', 'telegram_bot_id', 'user_id', 'staff_id', 'restaurant_branch_id',
+                 'step', 'current_test', 'current_open_question', 'loaded')
+
+    def __init__(self, student_id: int, telegram_bot_id: int, user_id: int, staff_id: Optional[int],
+                 restaurant_branch_id: Optional[int], step: int, current_test: Optional[int],
+                 current_open_question: Optional[int]):
+        self.student_id = student_id
+        self.telegram_bot_id = telegram_bot_id
+        self.user_id = user_id
+        self.staff_id = staff_id
+        self.restaurant_branch_id = restaurant_branch_id
+        self.step = step
+        self.current_test = current_test
+        self.current_open_question = current_open_question
+        self.loaded = time.monotonic()
+
+    def to_student(self) -> Student:
+        """
+        Build Student object from session without Data Base,
+        student.staff has pk and restaurant_branch_id, its other fields are deferred and loaded on first access
+        :return: Student
+        """
+        student = Student(pk=self.student_id, user_id=self.user_id, staff_id=self.staff_id,
+                          telegram_bot_id=self.telegram_bot_id, step=self.step, current_test=self.current_test,
+                          current_open_question=self.current_open_question)
+        student._state.adding = False
+        if self.staff_id is not None:
+            Student.staff.field.set_cached_value(student, Staff.from_db(
+                None, ['id', 'restaurant_branch_id'], [self.staff_id, self.restaurant_branch_id]))
+        return student
+
+
+class SessionStore:
+    """
+    In-memory student sessions keyed by (bot, chat)
+
+    Session is loaded by one query on first update from chat,
+    changes of step, current_test and current_open_question are written by UPDATE of changed columns only:
+    at once if `flush_interval` is 0 or batched by background thread every `flush_interval` seconds.
+    Sessions are dropped on Student post_save/post_delete and after `ttl` seconds.
+
+    Sessions live in process memory, so all updates of one bot must be handled by one process
+    (BOT_UPDATE_MODE=queue with one web worker) or `ttl` must be 0, then session is loaded on every update
+    and kept only to write changed columns. Writes are not conditional: the last writer of a column wins,
+    columns not changed by this process keep values written by others.
+    """
+
+    def __init__(self, flush_interval: float = 0, ttl: float = 3600):
+        """
+        :param flush_interval: seconds between batched writes, 0 for write-through
+        :param ttl: seconds to keep session in memory
+        """
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._sessions: Dict[Tuple[int, int], StudentSession] = {}
+        self._keys: Dict[int, Tuple[int, int]] = {}
+        self._pending: Dict[int, Dict] = {}
+        self._lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+        post_save.connect(self._invalidate, sender=Student, weak=False, dispatch_uid=f'student_sessions_save_{id(self)}')
+        post_delete.connect(self._invalidate, sender=Student, weak=False,
+                            dispatch_uid=f'student_sessions_delete_{id(self)}')
+
+    def load(self, telegram_bot_id: int, chat_id: int) -> Optional[Student]:
+        """
+        Get student of chat
+        :param telegram_bot_id: TelegramBot pk
+        :param chat_id: telegram chat id
+        :return: Student or None if chat is not authorized
+        """
+        key = (telegram_bot_id, chat_id)
+        session = self._sessions.get(key)
+        if session is not None and time.monotonic() - session.loaded < self.ttl:
+            return session.to_student()
+
+        row = Student.objects.filter(telegram_bot_id=telegram_bot_id, user_id=chat_id).values(
+            'pk', 'staff_id', 'staff__restaurant_branch_id', *SESSION_FIELDS).order_by('pk').first()
+        if not row:
+            return None
+        session = StudentSession(row['pk'], telegram_bot_id, chat_id, row['staff_id'],
+                                 row['staff__restaurant_branch_id'], row['step'], row['current_test'],
+                                 row['current_open_question'])
+        with self._lock:
+            pending = self._pending.get(session.student_id)
+            if pending:
+                for field, value in pending.items():
+                    setattr(session, field, value)
+            self._sessions[key] = session
+            self._keys[session.student_id] = key
+        return session.to_student()
+
+    def save(self, student: Student) -> None:
+        """
+        Persist changed conversation state of student
+        :param student: Student got from load()
+        :return:
+        """
+        key = (student.telegram_bot_id, student.user_id)
+        session = self._sessions.get(key)
+        if session is None or session.student_id != student.pk:
+            student.save(update_fields=SESSION_FIELDS)
+            return
+
+        changed = {field: getattr(student, field) for field in SESSION_FIELDS
+                   if getattr(student, field) != getattr(session, field)}
+        if not changed:
+            return
+
+        for field, value in changed.items():
+            setattr(session, field, value)
+        if not self.flush_interval:
+            Student.objects.filter(pk=student.pk).update(**changed)
+            return
+        with self._lock:
+            self._pending.setdefault(student.pk, {}).update(changed)
+        self._start_flusher()
+
+    def flush(self) -> int:
+        """
+        Write all batched changes
+        :return: count of written students
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for student_id, changed in pending.items():
+            try:
+                Student.objects.filter(pk=student_id).update(**changed)
+            except Exception as err:
+                LOG.exception(err)
+        return len(pending)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions = {}
+            self._keys = {}
+
+    def _start_flusher(self) -> None:
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._flush_forever, name='student-sessions-flush', daemon=True)
+            self._flusher.start()
+        atexit.register(self.flush)
+
+    def _flush_forever(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            close_old_connections()
+            self.flush()
+
+    def _invalidate(self, sender, instance: Student, **kwargs) -> None:
+        with self._lock:
+            key = self._keys.pop(instance.pk, None)
+            if key is not None:
+                self._sessions.pop(key, None)
@@ -1,7 +1,16 @@
 from telebot import types, TeleBot, apihelper
+from django.db import connection, transaction
+from django.db.models import OuterRef, Subquery
 from .models import *
 from .default_lang import ru
 from .utils import get_message_text
+from .callback_router import encode
+from .progress import get_progress, sync_progress
+from .limiter import login_limiter
+from .scoring import answer_key_from_snapshot, score
+from .content import content_cache, BranchContent, TestSnapshot
+from .rendering import render_main_menu, render_studding, render_topic_block, render_test_start, render_question, \
+    TOPIC_FINISHED, TOPIC_OPENED, TOPIC_BLOCKED
 from time import sleep
 
 msg = ru
@@ -18,6 +27,7 @@ class StudentLogic:
         studding
         progress
         view_topic
+        complete_topic
         view_test
         select_answer
         add_open_answer
@@ -33,19 +43,59 @@ class StudentLogic:
         5 - user pass test
 
 
-    All methods returns next user step
+    All methods returns next user step,
+    changes of user step, current_test and current_open_question are saved by caller
     """
 
-    def __init__(self, bot: TeleBot, message: types.Message, user: Student):
+    def __init__(self, bot: TeleBot, message: types.Message, user: Student, telegram_bot: TelegramBot = None):
         """
         :param bot: TeleBot object for working with telegram API
         :param message: Message object from user
         :param user: Student object, need for getting student info
+        :param telegram_bot: TelegramBot object of current bot
         :return StudentLogic object
         """
         self.bot = bot
         self.message = message
         self.user = user
+        self.telegram_bot = telegram_bot
+        self._content = None
+
+    @property
+    def content(self) -> BranchContent:
+        """
+        Course content snapshot of student restaurant branch
+        """
+        if self._content is None:
+            self._content = content_cache.get(self.user.staff.restaurant_branch_id)
+        return self._content
+
+    def topic_states(self) -> list:
+        """
+        Topics of student branch with student topic state, by one query
+        :return: list of dicts with topic pk, blocked and finished (None if topic is not assigned)
+        """
+        student_topic = StudentTheoryTopic.objects.filter(student=self.user, theory_topic=OuterRef('pk')).order_by('pk')
+        return list(TheoryTopic.objects.filter(restaurant_id=self.user.staff.restaurant_branch_id).order_by('pk').annotate(
+            blocked=Subquery(student_topic.values('blocked')[:1]),
+            finished=Subquery(student_topic.values('finished')[:1]),
+        ).values('pk', 'blocked', 'finished'))
+
+    def login_key(self) -> tuple:
+        """
+        :return: key of login_limiter, (bot, chat)
+        """
+        return self.telegram_bot.pk if self.telegram_bot else None, self.message.chat.id
+
+    def login_blocked(self) -> bool:
+        """
+        Check login attempts of chat in memory, blocked chat gets ban message
+        :return: True if chat is blocked after failed logins
+        """
+        if login_limiter.attempts_left(self.login_key()):
+            return False
+        self.bot.send_message(self.message.chat.id, msg['login_failed_ban'])
+        return True
 
     def check_token(self) -> int:
         """
@@ -53,13 +103,26 @@ class StudentLogic:
         :return None
         """
 
-        token = str(self.message.text)
-        student_settings = StudentSettings.objects.filter(token=token).first()
+        token = str(self.message.text).strip()
+        limiter_key = self.login_key()
+        if self.login_blocked():
+            return 0
+
+        # legacy tokens have 32 letters, malformed ones are failed without query
+        student_settings = None
+        if token.isalnum() and len(token) <= 32:
+            student_settings = StudentSettings.objects.select_related('student').filter(token=token).first()
 
         if not student_settings:
-            self.bot.send_message(self.message.chat.id, msg['login_failed'])
+            attempts_left = login_limiter.fail(limiter_key)
+            if attempts_left:
+                self.bot.send_message(self.message.chat.id, msg['login_failed'] + str(attempts_left))
+            else:
+                self.bot.send_message(self.message.chat.id, msg['login_failed_ban'])
             return 0
 
+        login_limiter.reset(limiter_key)
+
         if student_settings.student.step != 0:
             self.bot.send_message(self.message.chat.id, get_message_text('user_already_authorized', msg['user_already_authorized'], student_settings.student))
             return 0
@@ -78,7 +141,7 @@ class StudentLogic:
         :return: int (current student step)
         """
         if not self.user:
-            self.bot.send_message(self.message.chat.id, get_message_text('input_token', msg['key_enter'], bot_token=self.bot.token))
+            self.bot.send_message(self.message.chat.id, get_message_text('input_token', msg['key_enter'], telegram_bot=self.telegram_bot))
             return 0
         return self.main_menu()
 
@@ -87,10 +150,7 @@ class StudentLogic:
         Send message with main_menu
         :return: 1
         """
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(types.InlineKeyboardButton('Учиться', callback_data='studding'),
-                   types.InlineKeyboardButton('Мой Прогресс', callback_data='progress'))
-
+        markup = render_main_menu()
         text_message = get_message_text('main_menu', msg['main_menu'], self.user)
 
         try:
@@ -105,24 +165,17 @@ class StudentLogic:
         Send message with studding menu
         :return: 3
         """
-        markup = types.InlineKeyboardMarkup(row_width=2)
-        topics = TheoryTopic.objects.filter(restaurant=self.user.staff.restaurant_branch).all()
-        last_topic = None
-        for topic in topics:
-            student_topic = StudentTheoryTopic.objects.filter(student=self.user, theory_topic=topic).first()
-            if student_topic.blocked and last_topic and last_topic.finished:
-                student_topic.blocked = True
-                student_topic.save()
-            if student_topic.finished:
-                emoj = '✅'
-            elif not student_topic.blocked:
-                emoj = '🔓'
+        states = {state['pk']: state for state in self.topic_states()}
+        markers = []
+        for topic in self.content.topics:
+            state = states.get(topic.id)
+            if state and state['finished']:
+                markers.append(TOPIC_FINISHED)
+            elif state and state['blocked'] is False:
+                markers.append(TOPIC_OPENED)
             else:
-                emoj = '🔒'
-            last_topic = student_topic
-            markup.add(types.InlineKeyboardButton(f'{emoj} {topic.name}', callback_data=f'topic_{topic.pk}_0'))
-
-        markup.add(types.InlineKeyboardButton('Назад', callback_data='main_menu'))
+                markers.append(TOPIC_BLOCKED)
+        markup = render_studding(self.content, markers)
 
         text_message = get_message_text('studding', msg['studding'], self.user)
 
@@ -140,17 +193,20 @@ class StudentLogic:
         :return: 2
         """
         markup = types.InlineKeyboardMarkup(row_width=2)
-        markup.add(types.InlineKeyboardButton('Назад', callback_data='main_menu'))
+        markup.add(types.InlineKeyboardButton('Назад', callback_data=encode('main_menu')))
 
-        topics = TheoryTopic.objects.filter(restaurant=self.user.staff.restaurant_branch).all()
+        progress = get_progress(self.user.pk)
+        topics = progress.get_topics()
+        scores = progress.get_scores()
         progress_text = ""
-        for topic in topics:
-            student_topic = StudentTheoryTopic.objects.filter(student=self.user, theory_topic=topic).first()
-            topic_text = f"{topic.name} {'Открыт' if not student_topic.blocked else 'Закрыт'}\n"
-            student_test = StudentTest.objects.filter(test=topic.test, student=self.user).first()
-            if student_test:
-                topic_text += f'''\t
-{f"Пройден: {student_test.points}/{student_test.max_points} {f'Открытых вопросов {student_test.opened_questions}/{student_test.max_opened_questions}' if student_test.max_opened_questions else ''}" if student_test else "Не пройден"}\n\n'''
+        for topic in self.content.topics:
+            state = topics.get(str(topic.id))
+            topic_text = f"{topic.name} {'Открыт' if state and not state['blocked'] else 'Закрыт'}\n"
+            score = scores.get(str(topic.test_id))
+            if score:
+                opened_questions = f"Открытых вопросов {score['opened_questions']}/{score['max_opened_questions']}" \
+                    if score['max_opened_questions'] else ''
+                topic_text += f"\t\nПройден: {score['points']}/{score['max_points']} {opened_questions}\n\n"
             progress_text += topic_text
 
         text_message = get_message_text('progress', msg['progress'], self.user).format(progress_text)
@@ -171,13 +227,12 @@ class StudentLogic:
         :return: 4
         """
 
-        try:
-            topic = TheoryTopic.objects.get(pk=topic_id)
-        except TheoryTopic.DoesNotExist:
+        topic = self.content.topics_by_id.get(topic_id)
+        if not topic or not 0 <= block_id < len(topic.blocks):
             self.bot.send_message(text=msg.get('topic_not_found'), chat_id=self.message.chat.id)
             return self.studding()
 
-        student_topic = StudentTheoryTopic.objects.filter(student=self.user, theory_topic=topic).first()
+        student_topic = StudentTheoryTopic.objects.filter(student=self.user, theory_topic_id=topic.id).first()
         if not student_topic:
             self.bot.send_message(text=msg.get('topic_not_found'), chat_id=self.message.chat.id)
             return self.studding()
@@ -186,59 +241,54 @@ class StudentLogic:
             self.bot.send_message(text=msg.get('test_before_next_lesson'), chat_id=self.message.chat.id)
             return self.studding()
 
-        blocks = topic.blocks.all()
-        markup = types.InlineKeyboardMarkup(row_width=3)
-        tool_buttons = []
-
-        if block_id != 0:
-            tool_buttons.append(types.InlineKeyboardButton('Назад', callback_data=f'topic_{topic_id}_{block_id - 1}').to_dict())
-
-        tool_buttons.append(types.InlineKeyboardButton('К разделу', callback_data='studding').to_dict())
-
-        if block_id < len(blocks) - 1:
-            tool_buttons.append(types.InlineKeyboardButton('Дальше', callback_data=f'topic_{topic_id}_{block_id + 1}').to_dict())
-        else:
-            student_topic.complete_theory = True
-            student_topic.save()
-            if topic.test:
-                tool_buttons.append(types.InlineKeyboardButton('Пройти тест', callback_data=f'test_{topic.test.pk}_-1').to_dict())
-            else:
-                tool_buttons.append(types.InlineKeyboardButton('Завершить раздел', callback_data=f'completetopic_{topic_id}').to_dict())
-
-        text_message = get_message_text('topic', msg['topic'], self.user).format(blocks[block_id].name,
-                                                                                 blocks[block_id].text)
+        if block_id == len(topic.blocks) - 1 and not student_topic.complete_theory:
+            with transaction.atomic():
+                StudentTheoryTopic.objects.filter(pk=student_topic.pk).update(complete_theory=True)
+                sync_progress(self.user.pk)
 
-        markup.keyboard.append(tool_buttons)
+        text_message, markup = render_topic_block(self.content, topic, block_id,
+                                                  get_message_text('topic', msg['topic'], self.user))
         self.bot.edit_message_text(text=text_message, chat_id=self.message.chat.id,
                                    reply_markup=markup, message_id=self.message.message_id)
         return 4
 
-    def view_test(self, test_id: int, question_id: int) -> int:
+    def complete_topic(self, topic_id: int) -> int:
+        """
+        Leave topic without test, theory is completed on its last block
+        :param topic_id: topic for get in bd
+        :return: studding()
+        """
+        return self.studding()
+
+    def view_test(self, test_id: int, question_id: int, student_test: StudentTest = None) -> int:
         """
         view test or test questions
         :param test_id: test for get in bd
         :param question_id: number of question
+        :param student_test: current StudentTest if it is loaded already
         :return: 5
         """
-        try:
-            test = TheoryTest.objects.get(pk=test_id)
-            student_test = StudentTest.objects.filter(test=test, student=self.user, is_finished=False).first()
-            if not student_test:
-                student_test = StudentTest(test=test, student=self.user)
-                student_test.save()
-        except TheoryTest.DoesNotExist:
+        test = self.content.tests_by_id.get(test_id)
+        if not test or not -1 <= question_id <= len(test.questions):
             self.bot.send_message(text=msg.get('test_not_found'), chat_id=self.message.chat.id)
             return self.studding()
 
-        if question_id == test.questions.count():
+        if student_test is None:
+            student_test = StudentTest.objects.filter(test_id=test.id, student=self.user, is_finished=False).first()
+        if not student_test:
+            student_test = StudentTest(test_id=test.id, student=self.user, draft='{}')
+            student_test.save()
+        elif student_test.draft is None:
+            # test started before drafts: its answers move to draft on first view,
+            # current_open_question of test with draft is always TestQuestion pk
+            student_test.save_draft(student_test.get_draft())
+
+        if question_id == len(test.questions):
             return self.pass_test(test, student_test)
 
-        markup = types.InlineKeyboardMarkup(row_width=2)
         # start test
         if question_id == -1:
-            markup.add(types.InlineKeyboardButton('Назад к теории', callback_data=f'topic_{test.theorytopic.pk}_{test.theorytopic.blocks.count() - 1}'),
-                       types.InlineKeyboardButton('Начать тест', callback_data=f'test_{test_id}_0'))
-            text_message = f'{test.name}'
+            text_message, markup = render_test_start(self.content, test)
             try:
                 self.bot.edit_message_text(text=text_message, chat_id=self.message.chat.id,
                                            message_id=self.message.message_id, reply_markup=markup)
@@ -247,51 +297,19 @@ class StudentLogic:
                                       reply_markup=markup)
 
             return 5
-        else:
-            all_questions = test.questions.all()
-            if not all_questions[question_id].is_opened:
-                # fill variants
-                student_answers_tmp = student_test.answers.all()
-                student_answers = []
-                for temp_answ in student_answers_tmp:
-                    if temp_answ.answer:
-                        student_answers.append(temp_answ.answer.pk)
-                for answer in all_questions[question_id].answers.all():
-                    # stick or square
-                    markup.add(types.InlineKeyboardButton(f'{"✔" if answer.pk in student_answers else "🔳"} {answer.answer}',
-                                                          callback_data=f'answer_{student_test.pk}_{question_id}_{answer.pk}'))
-
-        # last question
-        if question_id == test.questions.count() - 1:
-            markup.add(types.InlineKeyboardButton('⬅', callback_data=f'test_{test_id}_{question_id - 1}'),
-                       types.InlineKeyboardButton('Завершить тест', callback_data=f'test_{test_id}_{question_id+1}'))
-        # first question
-        elif question_id == 0:
-            markup.add(types.InlineKeyboardButton('➡', callback_data=f'test_{test_id}_{question_id + 1}'))
-            self.user.current_test = student_test.pk
+
+        question = test.questions[question_id]
+        self.user.current_test = student_test.pk
+        answer = student_test.get_draft().get(str(question.id))
+        if not question.is_opened:
+            # stick or square on selected answers
+            text_message, markup = render_question(self.content, test, question_id, student_test.pk,
+                                                   frozenset(answer or ()))
             self.user.current_open_question = None
-            self.user.save()
-        # another questions
         else:
-            markup.add(types.InlineKeyboardButton('⬅', callback_data=f'test_{test_id}_{question_id - 1}'),
-                       types.InlineKeyboardButton('➡', callback_data=f'test_{test_id}_{question_id + 1}'))
-
-        if not all_questions[question_id].is_opened:
-            text_message = f"Вопрос {question_id + 1}.\n\n{all_questions[question_id].question}"
-        else:
-            text_message = f"Вопрос {question_id + 1}.\n\n{all_questions[question_id].question}\n\n" \
-                           f"Это открытый вопрос, напишите на него ответ, он будет отправлен на проверку\n"
-            answer = student_test.answers.filter(question=all_questions[question_id]).first()
-            if answer:
-                text_message += f"Ваш текущий ответ: {answer.text if answer.text else 'Не отправлен'}"
-            else:
-                text_message += "Ваш текущий ответ: Не отправлен"
-            if not answer:
-                answer = StudentAnswer(student=self.user, question=all_questions[question_id])
-                answer.save()
-                student_test.answers.add(answer)
-                self.user.current_open_question = answer.pk
-                self.user.save()
+            text_message, markup = render_question(self.content, test, question_id, student_test.pk)
+            text_message += f"Ваш текущий ответ: {answer if answer else 'Не отправлен'}"
+            self.user.current_open_question = question.id
 
         try:
             self.bot.edit_message_text(text=text_message, chat_id=self.message.chat.id,
@@ -310,28 +328,34 @@ class StudentLogic:
         :param answer_id: number of answer
         :return: view_test()
         """
-        student_test = StudentTest.objects.filter(pk=student_test_id).first()
-        if not student_test:
+        student_test = StudentTest.objects.filter(pk=student_test_id, student=self.user).first()
+        test = self.content.tests_by_id.get(student_test.test_id) if student_test else None
+        if not test:
             self.bot.send_message(text=msg.get('test_not_found'), chat_id=self.message.chat.id)
             return self.studding()
-        try:
-            question = student_test.test.questions.all()[question_id]
-            answer = TestAnswer.objects.get(pk=answer_id)
-        except IndexError:
+        if not 0 <= question_id < len(test.questions):
             self.bot.send_message(text=msg.get('test_not_found'), chat_id=self.message.chat.id)
-            return self.view_test(student_test.test.pk, question_id)
-        except TestAnswer.DoesNotExist:
+            return self.view_test(test.id, -1)
+        question = test.questions[question_id]
+        if answer_id not in {answer.id for answer in question.answers}:
             self.bot.send_message(text=msg.get('answer_not_found'), chat_id=self.message.chat.id)
-            return self.view_test(student_test.test.pk, question_id)
-
-        student_answer = StudentAnswer(student=self.user, question=question, answer=answer)
-        student_answer.save()
-        for answ in student_test.answers.all():
-            if answ.question == question:
-                answ.delete()
-        student_test.answers.add(student_answer)
-        student_test.save()
-        return self.view_test(student_test.test.pk, question_id)
+            return self.view_test(test.id, question_id)
+
+        if student_test.is_finished:
+            # button of finished attempt, show question of current attempt
+            return self.view_test(test.id, question_id)
+
+        draft = student_test.get_draft()
+        selected = draft.get(str(question.id), [])
+        if question.is_multiple:
+            # tap toggles answer
+            selected = [selected_id for selected_id in selected if selected_id != answer_id] \
+                if answer_id in selected else selected + [answer_id]
+        else:
+            selected = [answer_id]
+        draft[str(question.id)] = selected
+        student_test.save_draft(draft)
+        return self.view_test(test.id, question_id, student_test)
 
     def add_open_answer(self) -> int:
         """
@@ -340,76 +364,80 @@ class StudentLogic:
         """
         answer_text = self.message.text
         student_test = StudentTest.objects.filter(pk=self.user.current_test).first()
-
-        try:
-            test = TheoryTest.objects.get(pk=self.user.current_test)
-        except TheoryTest.DoesNotExist:
+        test = self.content.tests_by_id.get(student_test.test_id) if student_test else None
+        if not test:
             self.bot.send_message(text=msg.get('test_not_found'), chat_id=self.message.chat.id)
             return self.progress()
 
-        try:
-            student_answer = StudentAnswer.objects.get(pk=self.user.current_open_question)
-        except StudentAnswer.DoesNotExist:
+        question_pk = self.user.current_open_question
+        if student_test.draft is None and question_pk is not None:
+            # test started before drafts, question was opened by old view_test which stored StudentAnswer pk
+            question_pk = student_test.answers.filter(pk=question_pk).values_list('question_id', flat=True).first()
+        question_id = test.question_index.get(question_pk)
+        if question_id is None or student_test.is_finished or not test.questions[question_id].is_opened:
             self.bot.send_message(text=msg.get('answer_not_found'), chat_id=self.message.chat.id)
-            return self.view_test(test.pk, 0)
+            return self.view_test(test.id, 0)
 
-        student_answer.text = answer_text
-        student_answer.save()
+        draft = student_test.get_draft()
+        draft[str(question_pk)] = answer_text
+        student_test.save_draft(draft)
         self.bot.send_message(text=msg.get('answer_writen'), chat_id=self.message.chat.id)
-        question_id = self.user.current_open_question
         self.user.current_open_question = None
-        self.user.save()
-        i = 0
-        for question in student_test.test.questions.all():
-            if question.pk == question_id:
-                break
-            i += 1
-
-        return self.view_test(test.pk, i)
+        return self.view_test(test.id, question_id, student_test)
 
-    def pass_test(self, test: TheoryTest, student_test: StudentTest) -> int:
+    def pass_test(self, test: TestSnapshot, student_test: StudentTest) -> int:
         """
         check test answers, write to db and close test
         :param test:
         :param student_test:
         :return: progress()
         """
-        student_test.max_points = 0
-        student_test.points = 0
-        student_test.max_opened_questions = 0
-        student_test.opened_questions = 0
-
-        for question in test.questions.all():
-            if question.is_opened:
-                student_test.max_opened_questions += 1
-                continue
-            else:
-                student_test.max_points += 1
-            is_right = False
-            for student_answer in student_test.answers.filter(question__is_opened=False).all():
-                if is_right:
-                    break
-                for answer in question.answers.all():
-                    if student_answer.answer.pk == answer.pk and answer.is_right:
-                        student_test.points += 1
-                        is_right = True
-                        break
+        draft = student_test.get_draft()
+        selected = {int(question_id): answer for question_id, answer in draft.items() if isinstance(answer, list)}
+        result = score(answer_key_from_snapshot(test), selected)
+        student_test.points, student_test.max_points, student_test.opened_questions, \
+            student_test.max_opened_questions = result
         student_test.is_finished = True
-        student_theory_topic = StudentTheoryTopic.objects.filter(student=self.user, theory_topic=test.theorytopic).first()
-        if student_theory_topic:
-            if student_test.points / student_test.max_points > 0.5:
-                student_theory_topic.complete_test = True
-            else:
-                student_theory_topic.complete_test = False
-            student_theory_topic.finished = True
-            student_theory_topic.save()
-
-        student_test.save()
-        self.open_next_topic(student_test)
+        student_test.draft = None
+        with transaction.atomic():
+            self.materialize_answers(student_test, draft)
+            student_theory_topic = StudentTheoryTopic.objects.filter(student=self.user, theory_topic_id=test.topic_id).first()
+            if student_theory_topic:
+                student_theory_topic.complete_test = result.passed
+                student_theory_topic.finished = True
+                student_theory_topic.save()
+
+            student_test.save()
+            if not student_test.max_opened_questions:
+                self.open_next_topic(student_test)
+            sync_progress(self.user.pk)
         self.user.current_test = None
-        self.user.save()
+        self.user.current_open_question = None
         return self.progress()
 
+    def materialize_answers(self, student_test: StudentTest, draft: dict) -> None:
+        """
+        Write answers of finished test as StudentAnswer rows
+        :param student_test: finished test
+        :param draft: answers of test, see StudentTest.get_draft()
+        """
+        # rows of test started before drafts
+        StudentAnswer.objects.filter(studenttest=student_test).delete()
+        answers = []
+        for question_id, answer in draft.items():
+            if isinstance(answer, list):
+                answers.extend(StudentAnswer(student=self.user, question_id=int(question_id), answer_id=answer_id)
+                               for answer_id in answer)
+            else:
+                answers.append(StudentAnswer(student=self.user, question_id=int(question_id), text=answer))
+        if connection.features.can_return_rows_from_bulk_insert:
+            StudentAnswer.objects.bulk_create(answers)
+        else:
+            for answer in answers:
+                answer.save()
+        StudentTest.answers.through.objects.bulk_create(
+            StudentTest.answers.through(studenttest_id=student_test.pk, studentanswer_id=answer.pk) for answer in answers)
+
     def message_in_test(self) -> int:
         """
         Send alert when user do something wrong on time test
@@ -421,27 +449,10 @@ class StudentLogic:
     @staticmethod
     def open_next_topic(current_test: StudentTest) -> None:
         """
-        open new topic if test does not have opened questions
+        open next topic after test without opened questions
         :param current_test:
         :return:
         """
-        answers = current_test.answers.filter(question__is_opened=True).all()
-        if not answers:
-            next_topic = StudentTheoryTopic.objects.filter(student=current_test.student, blocked=True).first()
-            next_topic.update(blocked=True)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        next_topic = StudentTheoryTopic.objects.filter(student_id=current_test.student_id, blocked=True).order_by('theory_topic_id').first()
+        if next_topic:
+            StudentTheoryTopic.objects.filter(pk=next_topic.pk).update(blocked=False)
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import TeleBot, apihelper
+
+LOG = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter, `rate` tokens per second with bursts up to `capacity`
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take one token
+        :return: seconds to wait before token may be used
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self) -> float:
+        """
+        Take one token, sleep if bucket is empty
+        :return: seconds waited
+        """
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def is_full(self) -> bool:
+        with self._lock:
+            return self._tokens + (time.monotonic() - self._updated) * self.rate >= self.capacity
+
+
+class TelegramClient(TeleBot):
+    """
+    TeleBot which respects telegram send limits
+
+    Every outgoing message waits for token in global bucket of bot and bucket of chat,
+    answer 429 is retried after `retry_after` seconds while retry budget is not spent.
+    """
+
+    def __init__(self, token, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 max_retries: int = 3, retry_budget: float = 30, **kwargs):
+        """
+        :param token: bot API token
+        :param global_rate: messages per second for all chats
+        :param chat_rate: messages per second for one chat
+        :param chat_burst: messages one chat may get at once
+        :param max_retries: max retries of one message after 429
+        :param retry_budget: max seconds of waiting retry_after for one message
+        """
+        super(TelegramClient, self).__init__(token, **kwargs)
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._chat_buckets_lock = threading.Lock()
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        return self._limited(chat_id, super(TelegramClient, self).send_message, chat_id, text, *args, **kwargs)
+
+    def edit_message_text(self, text, chat_id=None, *args, **kwargs):
+        return self._limited(chat_id, super(TelegramClient, self).edit_message_text, text, chat_id, *args, **kwargs)
+
+    def _limited(self, chat_id, method, *args, **kwargs):
+        retries = 0
+        waited = 0.0
+        while True:
+            self.global_bucket.acquire()
+            if chat_id is not None:
+                self._get_chat_bucket(chat_id).acquire()
+            try:
+                return method(*args, **kwargs)
+            except apihelper.ApiException as err:
+                retry_after = get_retry_after(err)
+                if retry_after is None or retries >= self.max_retries or waited + retry_after > self.retry_budget:
+                    raise
+                LOG.warning(f'telegram flood control, chat {chat_id}, retry after {retry_after}s')
+                retries += 1
+                waited += retry_after
+                time.sleep(retry_after)
+
+    def _get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is not None:
+            return bucket
+        with self._chat_buckets_lock:
+            if len(self._chat_buckets) > 10000:
+                # idle chats have full buckets, forget them
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.is_full()}
+            bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        return bucket
+
+
+def get_retry_after(err: apihelper.ApiException) -> Optional[float]:
+    """
+    Get retry_after from telegram answer 429
+    :param err: ApiException from telebot
+    :return: seconds to wait or None if error is not flood control
+    """
+    result = getattr(err, 'result', None)
+    if result is None or result.status_code != 429:
+        return None
+    try:
+        return float(result.json()['parameters']['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return 1.0
+
+
+def configure_api(api_url: str = None, pool_size: int = 10, connect_timeout: float = 3.5,
+                  read_timeout: float = 10) -> None:
+    """
+    Configure telebot requests: one keep-alive session with connection pool for all threads
+    :param api_url: telegram API url template, e.g. fake server for tests
+    :param pool_size: max keep-alive connections to telegram
+    :param connect_timeout: seconds for connect
+    :param read_timeout: seconds for read answer
+    :return:
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    apihelper.session = session
+    apihelper.CONNECT_TIMEOUT = connect_timeout
+    apihelper.READ_TIMEOUT = read_timeout
+    if api_url:
+        apihelper.API_URL = api_url
@@ -1,3 +1,689 @@
-from django.test import TestCase
+import io
+import json
+import threading
+import time
+from unittest import mock
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from telebot import types
+from .default_lang import ru
+from .assignments import assign_topic, needs_assignment_dedupe
+from .ingestion import UpdateDispatcher
+from .limiter import AttemptLimiter
+from .models import TelegramBot, Restaurant, City, RestaurantBranch, Staff, Student, TheoryTopic, TheoryTest, \
+    TestQuestion, TestAnswer, StudentTest, StudentAnswer, StudentTheoryTopic, StudentProgress, TOKEN_LENGTH, \
+    dedupe_student_topics, mark_multiple_answer_questions
+from .progress import sync_progress, get_progress
+from .scoring import AnswerKey, load_answer_key, rescore_test, score
+from .sessions import SessionStore
+from .student_controllers import StudentLogic
+from .views import text_logic
 
-# Create your tests here.
+CHAT_ID = 777
+
+
+def make_message(text: str = '') -> types.Message:
+    return types.Message.de_json({'message_id': 1, 'date': 0, 'text': text,
+                                  'chat': {'id': CHAT_ID, 'type': 'private'},
+                                  'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'x'}})
+
+
+class BotTestCase(TestCase):
+    """
+    Restaurant chain with bot, every staff works in own branch
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.telegram_bot = TelegramBot.objects.create(name='bot', token='TOKEN')
+        cls.restaurant = Restaurant.objects.create(name='restaurant', bot=cls.telegram_bot)
+        cls.city = City.objects.create()
+
+    def make_staff(self) -> Staff:
+        """
+        :return: Staff of new branch
+        """
+        branch = RestaurantBranch.objects.create(main_restaurant=self.restaurant, name='branch', city=self.city,
+                                                 address='address')
+        return Staff.objects.create(restaurant_branch=branch, user=User.objects.create(username=f'staff{branch.pk}'),
+                                    first_name='first', second_name='second')
+
+    def make_student(self, topics: int) -> Student:
+        """
+        Student of new branch with opened and finished topics, every topic has finished test
+        :param topics: count of topics
+        :return: logged in Student
+        """
+        staff = self.make_staff()
+        branch = staff.restaurant_branch
+        student = Student.objects.create(staff=staff, telegram_bot=self.telegram_bot, user_id=CHAT_ID, step=1)
+        for i in range(topics):
+            test = TheoryTest.objects.create(name=f'test{i}')
+            question = TestQuestion.objects.create(question=f'question{i}')
+            question.answers.add(TestAnswer.objects.create(answer='answer', is_right=True))
+            test.questions.add(question)
+            TheoryTopic.objects.create(restaurant=branch, creator=staff, name=f'topic{i}', text='text', test=test)
+            StudentTest.objects.create(test=test, student=student, is_finished=True, points=1, max_points=1)
+        StudentTheoryTopic.objects.filter(student=student).update(blocked=False, finished=True)
+        sync_progress(student.pk, activity=False)
+        return Student.objects.select_related('staff').get(pk=student.pk)
+
+
+class StudentLogicTestCase(BotTestCase):
+
+    def count_queries(self, student: Student, screen: str) -> int:
+        """
+        Queries of screen shown second time, so content snapshot and messages are cached
+        """
+        getattr(StudentLogic(mock.Mock(), make_message(), student, self.telegram_bot), screen)()
+        with CaptureQueriesContext(connection) as queries:
+            getattr(StudentLogic(mock.Mock(), make_message(), student, self.telegram_bot), screen)()
+        return len(queries)
+
+    def test_screen_queries_do_not_depend_on_topics(self):
+        one_topic = self.make_student(1)
+        many_topics = self.make_student(10)
+        for screen in ('studding', 'progress'):
+            with self.subTest(screen=screen):
+                self.assertEqual(self.count_queries(one_topic, screen), self.count_queries(many_topics, screen))
+
+    def test_login_updates_changed_student_columns_only(self):
+        student = Student.objects.create(staff=self.make_staff(), telegram_bot=self.telegram_bot)
+        token = student.studentsettings.token
+        logic = StudentLogic(mock.Mock(), make_message(token), None, self.telegram_bot)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(logic.check_token(), 1)
+
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(updates, [f'UPDATE "bot_logic_student" SET "user_id" = {CHAT_ID}, "step" = 1 '
+                                   f'WHERE "bot_logic_student"."id" = {student.pk}'])
+        for table in ('bot_logic_studentinfo', 'bot_logic_studentsettings'):
+            self.assertFalse([sql for sql in updates if f'UPDATE "{table}"' in sql])
+
+
+class AttemptLimiterTestCase(TestCase):
+
+    def test_window(self):
+        limiter = AttemptLimiter(max_attempts=2, window=60)
+        with mock.patch('bot_logic.limiter.time.monotonic', return_value=1000.0) as monotonic:
+            self.assertEqual(limiter.attempts_left('chat'), 2)
+            self.assertEqual(limiter.fail('chat'), 1)
+            monotonic.return_value = 1030.0
+            self.assertEqual(limiter.fail('chat'), 0)
+            self.assertEqual(limiter.attempts_left('chat'), 0)
+            self.assertEqual(limiter.attempts_left('other chat'), 2)
+            # first attempt leaves the window
+            monotonic.return_value = 1060.0
+            self.assertEqual(limiter.attempts_left('chat'), 1)
+            monotonic.return_value = 1090.0
+            self.assertEqual(limiter.attempts_left('chat'), 2)
+
+    def test_reset(self):
+        limiter = AttemptLimiter(max_attempts=2, window=60)
+        limiter.fail('chat')
+        limiter.fail('chat')
+        limiter.reset('chat')
+        self.assertEqual(limiter.attempts_left('chat'), 2)
+
+
+class TokenLoginTestCase(BotTestCase):
+
+    def setUp(self):
+        self.limiter = AttemptLimiter(max_attempts=2, window=60)
+        patcher = mock.patch('bot_logic.student_controllers.login_limiter', self.limiter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bot = mock.Mock()
+
+    def send(self, text: str) -> None:
+        text_logic(self.bot, self.telegram_bot, make_message(text))
+
+    def last_text(self) -> str:
+        return self.bot.send_message.call_args[0][1]
+
+    def test_tokens_are_random_and_fixed_length(self):
+        staff = self.make_staff()
+        tokens = {Student.objects.create(staff=staff, telegram_bot=self.telegram_bot).studentsettings.token
+                  for _ in range(10)}
+        self.assertEqual(len(tokens), 10)
+        for token in tokens:
+            self.assertEqual(len(token), TOKEN_LENGTH)
+            self.assertTrue(token.isalpha() and token.islower())
+
+    def test_malformed_token_is_failed_without_query(self):
+        for token in ('not a token', 'x' * 33):
+            with self.subTest(token=token), self.assertNumQueries(0):
+                self.assertEqual(StudentLogic(self.bot, make_message(token), None, self.telegram_bot).check_token(), 0)
+        self.assertEqual(self.limiter.attempts_left((self.telegram_bot.pk, CHAT_ID)), 0)
+
+    def test_blocked_chat_is_answered_without_query(self):
+        self.send('wrongtoken')
+        self.assertEqual(self.last_text(), ru['login_failed'] + '1')
+        self.send('wrongtoken')
+        self.assertEqual(self.last_text(), ru['login_failed_ban'])
+        token = Student.objects.create(staff=self.make_staff(),
+                                       telegram_bot=self.telegram_bot).studentsettings.token
+        with self.assertNumQueries(0):
+            self.send(token)
+        self.assertEqual(self.last_text(), ru['login_failed_ban'])
+
+    def test_login_resets_failed_attempts(self):
+        student = Student.objects.create(staff=self.make_staff(), telegram_bot=self.telegram_bot)
+        self.send('wrongtoken')
+        self.assertEqual(self.limiter.attempts_left((self.telegram_bot.pk, CHAT_ID)), 1)
+        StudentLogic(self.bot, make_message(student.studentsettings.token), None, self.telegram_bot).check_token()
+        self.assertEqual(self.limiter.attempts_left((self.telegram_bot.pk, CHAT_ID)), 2)
+
+
+class ProgressTestCase(BotTestCase):
+
+    def setUp(self):
+        self.student = self.make_student(2)
+        self.topics = list(TheoryTopic.objects.filter(restaurant_id=self.student.staff.restaurant_branch_id)
+                           .order_by('pk'))
+        StudentTheoryTopic.objects.filter(student=self.student, theory_topic=self.topics[1]).update(
+            blocked=True, finished=False)
+        test = self.topics[0].test
+        # last finished attempt wins, not finished attempt is skipped
+        StudentTest.objects.create(test=test, student=self.student, is_finished=True, points=0, max_points=1,
+                                   opened_questions=0, max_opened_questions=1)
+        StudentTest.objects.create(test=test, student=self.student, is_finished=False, points=1, max_points=1)
+
+    def test_sync_progress(self):
+        progress = sync_progress(self.student.pk)
+        self.assertEqual((progress.topics_total, progress.topics_unlocked, progress.topics_finished), (2, 1, 1))
+        # finished attempts of make_student and the new one are not checked by Staff
+        self.assertEqual(progress.pending_reviews, 3)
+        self.assertEqual(progress.get_topics()[str(self.topics[1].pk)]['blocked'], True)
+        self.assertEqual(progress.get_scores()[str(self.topics[0].test_id)],
+                         {'student_test': StudentTest.objects.filter(is_finished=True).order_by('pk').last().pk,
+                          'points': 0, 'max_points': 1, 'opened_questions': 0, 'max_opened_questions': 1})
+        self.assertIsNotNone(progress.last_activity)
+        stored = StudentProgress.objects.get(student=self.student)
+        self.assertEqual((stored.pending_reviews, stored.topics, stored.scores),
+                         (progress.pending_reviews, progress.topics, progress.scores))
+
+    def test_get_progress_builds_missing_summary(self):
+        StudentProgress.objects.filter(student=self.student).delete()
+        self.assertEqual(get_progress(self.student.pk).topics_total, 2)
+        self.assertTrue(StudentProgress.objects.filter(student=self.student).exists())
+
+    def test_rebuild_progress_check(self):
+        # changes above are made by update(), summary has drifted
+        with self.assertRaisesMessage(CommandError, '1 of 1 progress summaries are missing or drifted'):
+            call_command('rebuildprogress', check=True, stdout=io.StringIO())
+        out = io.StringIO()
+        call_command('rebuildprogress', stdout=out)
+        self.assertEqual(out.getvalue().strip(), '1 of 1 progress summaries rebuilt')
+        out = io.StringIO()
+        call_command('rebuildprogress', check=True, stdout=out)
+        self.assertEqual(out.getvalue().strip(), '1 progress summaries are up to date')
+
+        StudentProgress.objects.filter(student=self.student).delete()
+        with self.assertRaises(CommandError):
+            call_command('rebuildprogress', check=True, stdout=io.StringIO())
+
+
+class TheoryTestCase(BotTestCase):
+    """
+    Logged in student with topic, test of topic has single answer, multiple answer and opened questions
+    """
+
+    def setUp(self):
+        self.student = self.make_student(0)
+        staff = self.student.staff
+        self.test = TheoryTest.objects.create(name='test')
+        # single answer, multiple answer and opened question
+        self.single = self.make_question(right=1, wrong=1)
+        self.multiple = self.make_question(right=2, wrong=1, is_multiple=True)
+        self.opened = TestQuestion.objects.create(question='opened', is_opened=True)
+        self.test.questions.add(self.opened)
+        self.topic = TheoryTopic.objects.create(restaurant=staff.restaurant_branch, creator=staff, name='topic',
+                                                text='text', test=self.test)
+
+    def make_question(self, right: int, wrong: int, is_multiple: bool = False) -> TestQuestion:
+        question = TestQuestion.objects.create(question='question', is_multiple=is_multiple)
+        question.answers.add(*[TestAnswer.objects.create(answer='answer', is_right=i < right)
+                               for i in range(right + wrong)])
+        self.test.questions.add(question)
+        return question
+
+    def answers(self, question: TestQuestion, is_right: bool) -> list:
+        return list(question.answers.filter(is_right=is_right).order_by('pk').values_list('pk', flat=True))
+
+    def number(self, question: TestQuestion) -> int:
+        return self.test.get_question_order().index(question.pk)
+
+    def logic(self, text: str = '') -> StudentLogic:
+        return StudentLogic(mock.Mock(), make_message(text), self.student, self.telegram_bot)
+
+    def select(self, student_test: StudentTest, question: TestQuestion, answer_id: int) -> list:
+        self.logic().select_answer(student_test.pk, self.number(question), answer_id)
+        return StudentTest.objects.get(pk=student_test.pk).get_draft()[str(question.pk)]
+
+
+class ScoringTestCase(TheoryTestCase):
+
+    def test_score(self):
+        key = load_answer_key(self.test.pk)
+        self.assertEqual(key, AnswerKey(self.test.pk, key.right_answers, frozenset({self.opened.pk})))
+        single_right, = self.answers(self.single, True)
+        single_wrong, = self.answers(self.single, False)
+        multiple_right = self.answers(self.multiple, True)
+        multiple_wrong, = self.answers(self.multiple, False)
+        cases = {
+            'single right': ({self.single.pk: [single_right]}, 1),
+            'single wrong': ({self.single.pk: [single_wrong]}, 0),
+            'multiple right': ({self.multiple.pk: multiple_right}, 1),
+            'multiple partial': ({self.multiple.pk: multiple_right[:1]}, 0),
+            'multiple with wrong': ({self.multiple.pk: multiple_right + [multiple_wrong]}, 0),
+            'empty selection': ({self.single.pk: [], self.multiple.pk: []}, 0),
+            'nothing selected': ({}, 0),
+            'all right': ({self.single.pk: [single_right], self.multiple.pk: multiple_right[::-1]}, 2),
+        }
+        for case, (selected, points) in cases.items():
+            with self.subTest(case=case):
+                result = score(key, selected)
+                self.assertEqual(result, (points, 2, 0, 1))
+                self.assertEqual(result.passed, points == 2)
+
+    def finish(self, selected: dict) -> StudentTest:
+        student_test = StudentTest.objects.create(test=self.test, student=self.student, is_finished=True,
+                                                  points=0, max_points=2, max_opened_questions=1)
+        for question, answers in selected.items():
+            student_test.answers.add(*[StudentAnswer.objects.create(student=self.student, question=question,
+                                                                    answer_id=answer_id) for answer_id in answers])
+        return student_test
+
+    def test_rescore_test(self):
+        single_right, = self.answers(self.single, True)
+        multiple_right = self.answers(self.multiple, True)
+        multiple_wrong, = self.answers(self.multiple, False)
+        attempts = [self.finish({self.single: [single_right], self.multiple: multiple_right}),
+                    self.finish({self.single: [single_right], self.multiple: multiple_right + [multiple_wrong]}),
+                    self.finish({self.single: [single_right], self.multiple: multiple_right[:1]}),
+                    self.finish({})]
+        # not finished attempt is not scored
+        StudentTest.objects.create(test=self.test, student=self.student, points=0, max_points=2)
+        with CaptureQueriesContext(connection) as batched:
+            self.assertEqual(rescore_test(self.test.pk, batch_size=2), (4, 3))
+        self.assertEqual([StudentTest.objects.get(pk=attempt.pk).points for attempt in attempts], [2, 1, 1, 0])
+        # student topic follows the last finished attempt
+        self.assertFalse(StudentTheoryTopic.objects.get(student=self.student, theory_topic=self.topic).complete_test)
+
+        # the answer key is fixed: the wrong answer is right too
+        TestAnswer.objects.filter(pk=multiple_wrong).update(is_right=True)
+        StudentTest.objects.filter(pk=attempts[-1].pk).delete()
+        with CaptureQueriesContext(connection) as single_batch:
+            self.assertEqual(rescore_test(self.test.pk, batch_size=10), (3, 2))
+        self.assertEqual([StudentTest.objects.get(pk=attempt.pk).points for attempt in attempts[:3]], [1, 2, 1])
+        self.assertFalse(StudentTheoryTopic.objects.get(student=self.student, theory_topic=self.topic).complete_test)
+        # two batches of attempts take one more batch of queries
+        self.assertGreater(len(batched), len(single_batch))
+        self.assertEqual(sync_progress(self.student.pk, activity=False).get_scores()[str(self.test.pk)]['points'], 1)
+
+
+    def test_select_answer(self):
+        student_test = StudentTest.objects.create(test=self.test, student=self.student, draft='{}')
+        single_right, = self.answers(self.single, True)
+        single_wrong, = self.answers(self.single, False)
+        self.assertEqual(self.select(student_test, self.single, single_wrong), [single_wrong])
+        self.assertEqual(self.select(student_test, self.single, single_right), [single_right])
+
+        first, second = self.answers(self.multiple, True)
+        self.assertEqual(self.select(student_test, self.multiple, first), [first])
+        self.assertEqual(self.select(student_test, self.multiple, second), [first, second])
+        self.assertEqual(self.select(student_test, self.multiple, first), [second])
+
+    def test_multiple_is_decided_by_question(self):
+        # multiple answer question with one right answer toggles answers too
+        question = self.make_question(right=1, wrong=1, is_multiple=True)
+        student_test = StudentTest.objects.create(test=self.test, student=self.student, draft='{}')
+        right, = self.answers(question, True)
+        wrong, = self.answers(question, False)
+        self.select(student_test, question, wrong)
+        self.assertEqual(self.select(student_test, question, right), [wrong, right])
+
+    def test_multiple_answer_questions_are_marked_on_migrate(self):
+        TestQuestion.objects.update(is_multiple=False)
+        mark_multiple_answer_questions(sender=apps.get_app_config('bot_logic'), using='default')
+        self.assertEqual(set(TestQuestion.objects.filter(is_multiple=True).values_list('pk', flat=True)),
+                         {self.multiple.pk})
+
+
+class DraftTestCase(TheoryTestCase):
+
+    def test_answers_are_kept_in_draft(self):
+        student_test = StudentTest.objects.create(test=self.test, student=self.student, draft='{}')
+        single_right, = self.answers(self.single, True)
+        first, second = self.answers(self.multiple, True)
+        self.select(student_test, self.single, single_right)
+        self.select(student_test, self.multiple, second)
+        self.select(student_test, self.multiple, first)
+        self.logic().view_test(self.test.pk, self.number(self.opened))
+        self.assertEqual(self.student.current_open_question, self.opened.pk)
+        self.student.current_test = student_test.pk
+        self.logic('open answer').add_open_answer()
+
+        student_test.refresh_from_db()
+        self.assertEqual(json.loads(student_test.draft), {str(self.single.pk): [single_right],
+                                                          str(self.multiple.pk): [second, first],
+                                                          str(self.opened.pk): 'open answer'})
+        self.assertFalse(StudentAnswer.objects.exists())
+
+    def test_view_test_renders_draft(self):
+        single_right, = self.answers(self.single, True)
+        student_test = StudentTest.objects.create(test=self.test, student=self.student, draft=json.dumps(
+            {str(self.single.pk): [single_right], str(self.opened.pk): 'open answer'}))
+        logic = self.logic()
+        logic.view_test(self.test.pk, self.number(self.single))
+        markup = json.loads(logic.bot.edit_message_text.call_args[1]['reply_markup'])
+        self.assertEqual([row[0]['text'] for row in markup['inline_keyboard'][:2]], ['✔ answer', '🔳 answer'])
+        logic.view_test(self.test.pk, self.number(self.opened))
+        self.assertTrue(logic.bot.edit_message_text.call_args[1]['text'].endswith('Ваш текущий ответ: open answer'))
+        self.assertEqual(self.student.current_test, student_test.pk)
+        self.assertEqual(StudentTest.objects.filter(student=self.student).count(), 1)
+
+    def finish(self, student_test: StudentTest) -> None:
+        self.logic().view_test(self.test.pk, len(self.test.get_question_order()))
+        student_test.refresh_from_db()
+        self.assertTrue(student_test.is_finished)
+        self.assertIsNone(student_test.draft)
+        self.assertIsNone(self.student.current_test)
+
+    def test_draft_is_materialized_on_finish(self):
+        single_right, = self.answers(self.single, True)
+        multiple_right = self.answers(self.multiple, True)
+        student_test = StudentTest.objects.create(test=self.test, student=self.student, draft=json.dumps(
+            {str(self.single.pk): [single_right], str(self.multiple.pk): multiple_right,
+             str(self.opened.pk): 'open answer'}))
+        self.finish(student_test)
+        self.assertEqual((student_test.points, student_test.max_points, student_test.max_opened_questions), (2, 2, 1))
+        self.assertEqual(sorted(student_test.answers.values_list('question_id', 'answer_id', 'text')),
+                         sorted([(self.single.pk, single_right, None), (self.opened.pk, None, 'open answer')] +
+                                [(self.multiple.pk, answer_id, None) for answer_id in multiple_right]))
+        self.assertEqual(StudentAnswer.objects.count(), 4)
+
+    def legacy_test(self) -> StudentTest:
+        """
+        Attempt started before drafts: answers are StudentAnswer rows,
+        opened question has empty row and current_open_question is its pk
+        """
+        single_right, = self.answers(self.single, True)
+        student_test = StudentTest.objects.create(test=self.test, student=self.student)
+        opened = StudentAnswer.objects.create(student=self.student, question=self.opened)
+        student_test.answers.add(StudentAnswer.objects.create(student=self.student, question=self.single,
+                                                              answer_id=single_right), opened)
+        self.student.current_test = student_test.pk
+        self.student.current_open_question = opened.pk
+        return student_test
+
+    def test_legacy_rows_are_materialized_on_finish(self):
+        student_test = self.legacy_test()
+        self.logic('open answer').add_open_answer()
+        self.finish(student_test)
+        single_right, = self.answers(self.single, True)
+        self.assertEqual(sorted(student_test.answers.values_list('question_id', 'answer_id', 'text')),
+                         sorted([(self.single.pk, single_right, None), (self.opened.pk, None, 'open answer')]))
+        # rows of legacy attempt are replaced
+        self.assertEqual(StudentAnswer.objects.count(), 2)
+        self.assertEqual(student_test.points, 1)
+
+    def test_legacy_open_question(self):
+        student_test = self.legacy_test()
+        self.logic('open answer').add_open_answer()
+        student_test.refresh_from_db()
+        self.assertEqual(student_test.get_draft()[str(self.opened.pk)], 'open answer')
+
+    def test_legacy_test_gets_draft_on_view(self):
+        # then current_open_question is TestQuestion pk
+        student_test = self.legacy_test()
+        self.logic().view_test(self.test.pk, self.number(self.single))
+        student_test.refresh_from_db()
+        self.assertIn(str(self.single.pk), json.loads(student_test.draft))
+        self.logic().view_test(self.test.pk, self.number(self.opened))
+        self.assertEqual(self.student.current_open_question, self.opened.pk)
+        self.logic('new answer').add_open_answer()
+        student_test.refresh_from_db()
+        self.assertEqual(student_test.get_draft()[str(self.opened.pk)], 'new answer')
+
+
+class SessionStoreTestCase(BotTestCase):
+
+    def setUp(self):
+        self.student = self.make_student(0)
+        self.key = (self.telegram_bot.pk, CHAT_ID)
+
+    def row(self) -> tuple:
+        return Student.objects.filter(pk=self.student.pk).values_list('step', 'current_test').get()
+
+    def test_session_is_reused(self):
+        store = SessionStore(ttl=60)
+        with mock.patch('bot_logic.sessions.time.monotonic', return_value=1000.0) as monotonic:
+            with self.assertNumQueries(1):
+                student = store.load(*self.key)
+            self.assertEqual((student.pk, student.step, student.staff_id), (self.student.pk, 1, self.student.staff_id))
+            monotonic.return_value = 1059.0
+            with self.assertNumQueries(0):
+                student = store.load(*self.key)
+                self.assertEqual(student.staff.restaurant_branch_id, self.student.staff.restaurant_branch_id)
+            # other fields of staff are loaded on access
+            with self.assertNumQueries(1):
+                self.assertEqual(student.staff.first_name, 'first')
+
+            monotonic.return_value = 1060.0
+            with self.assertNumQueries(1):
+                store.load(*self.key)
+        with self.assertNumQueries(1):
+            self.assertIsNone(store.load(self.telegram_bot.pk, CHAT_ID + 1))
+
+    def test_session_is_dropped_on_student_save(self):
+        store = SessionStore(ttl=60)
+        store.load(*self.key)
+        student = Student.objects.get(pk=self.student.pk)
+        student.step = 3
+        student.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(store.load(*self.key).step, 3)
+
+    def test_ttl_0_loads_every_update(self):
+        store = SessionStore(ttl=0)
+        store.load(*self.key)
+        Student.objects.filter(pk=self.student.pk).update(step=3)
+        with self.assertNumQueries(1):
+            self.assertEqual(store.load(*self.key).step, 3)
+
+    def test_write_through_changed_columns_only(self):
+        store = SessionStore(ttl=60)
+        student = store.load(*self.key)
+        with self.assertNumQueries(0):
+            store.save(student)
+        # other process changes current_test, the last writer of step wins
+        Student.objects.filter(pk=self.student.pk).update(step=3, current_test=7)
+        student.step = 5
+        with CaptureQueriesContext(connection) as queries:
+            store.save(student)
+        self.assertEqual([query['sql'] for query in queries],
+                         [f'UPDATE "bot_logic_student" SET "step" = 5 WHERE "bot_logic_student"."id" = {student.pk}'])
+        self.assertEqual(self.row(), (5, 7))
+        with self.assertNumQueries(0):
+            self.assertEqual(store.load(*self.key).step, 5)
+
+    def test_batched_writes_are_flushed(self):
+        store = SessionStore(flush_interval=60, ttl=60)
+        with mock.patch.object(store, '_start_flusher') as start_flusher:
+            student = store.load(*self.key)
+            student.step, student.current_test = 5, 7
+            with self.assertNumQueries(0):
+                store.save(student)
+            start_flusher.assert_called_once_with()
+        self.assertEqual(self.row(), (1, None))
+        # session loaded again before flush keeps the change
+        store.clear()
+        self.assertEqual((store.load(*self.key).step, store.load(*self.key).current_test), (5, 7))
+
+        self.assertEqual(store.flush(), 1)
+        self.assertEqual(self.row(), (5, 7))
+        self.assertEqual(store.flush(), 0)
+
+
+class AssignTopicTestCase(BotTestCase):
+
+    def test_missing_rows_are_created_once(self):
+        staff = self.make_staff()
+        topic = TheoryTopic.objects.create(restaurant=staff.restaurant_branch, creator=staff, name='topic', text='text')
+        students = [Student.objects.create(staff=staff, telegram_bot=self.telegram_bot) for _ in range(5)]
+        StudentTheoryTopic.objects.create(student=students[1], theory_topic=topic)
+        bulk_create = StudentTheoryTopic.objects.bulk_create
+
+        def concurrent_bulk_create(objs, **kwargs):
+            # other process assigns the last student between select and insert of its chunk
+            objs = list(objs)
+            if any(obj.student_id == students[4].pk for obj in objs):
+                StudentTheoryTopic.objects.create(student=students[4], theory_topic=topic)
+            return bulk_create(objs, **kwargs)
+
+        chunks = []
+        with mock.patch.object(StudentTheoryTopic.objects, 'bulk_create', side_effect=concurrent_bulk_create):
+            self.assertEqual(assign_topic(topic.pk, staff.restaurant_branch_id, chunk_size=2, progress=chunks.append), 4)
+        self.assertEqual(chunks, [2, 4])
+        self.assertEqual(sorted(StudentTheoryTopic.objects.filter(theory_topic=topic).values_list('student_id', flat=True)),
+                         [student.pk for student in students])
+        self.assertEqual(StudentProgress.objects.get(student=students[0]).topics_total, 1)
+        self.assertEqual(assign_topic(topic.pk, staff.restaurant_branch_id, chunk_size=2), 0)
+
+
+class DedupeStudentTopicsTestCase(TransactionTestCase):
+    """
+    Duplicates made before the unique constraint are deleted before migration adds it
+    """
+
+    def setUp(self):
+        constraint, = StudentTheoryTopic._meta.constraints
+        # sqlite remakes table by constraints of model
+        with mock.patch.object(StudentTheoryTopic._meta, 'constraints', []), connection.schema_editor() as editor:
+            editor.remove_constraint(StudentTheoryTopic, constraint)
+
+        def add_constraint():
+            with connection.schema_editor() as editor:
+                editor.add_constraint(StudentTheoryTopic, constraint)
+        self.addCleanup(add_constraint)
+
+    def test_duplicates_are_deleted(self):
+        telegram_bot = TelegramBot.objects.create(name='bot', token='TOKEN')
+        branch = RestaurantBranch.objects.create(main_restaurant=Restaurant.objects.create(name='restaurant'),
+                                                 name='branch', address='address')
+        staff = Staff.objects.create(restaurant_branch=branch, user=User.objects.create(username='staff'))
+        topics = [TheoryTopic.objects.create(restaurant=branch, creator=staff, name='topic', text='text')
+                  for _ in range(2)]
+        students = [Student.objects.create(staff=staff, telegram_bot=telegram_bot) for _ in range(2)]
+        # first row of student and topic is kept
+        for student in students:
+            for topic in topics:
+                StudentTheoryTopic.objects.create(student=student, theory_topic=topic,
+                                                  complete_test=student == students[0] and topic == topics[0])
+        for student, topic in ((students[0], topics[0]), (students[0], topics[0]), (students[1], topics[1])):
+            StudentTheoryTopic.objects.create(student=student, theory_topic=topic)
+        self.assertTrue(needs_assignment_dedupe())
+
+        dedupe_student_topics(sender=apps.get_app_config('bot_logic'), using='default')
+        rows = list(StudentTheoryTopic.objects.order_by('student_id', 'theory_topic_id').values_list(
+            'student_id', 'theory_topic_id', 'complete_test'))
+        self.assertEqual(rows, [(students[0].pk, topics[0].pk, True), (students[0].pk, topics[1].pk, False),
+                                (students[1].pk, topics[0].pk, False), (students[1].pk, topics[1].pk, False)])
+
+    def test_table_with_constraint_is_skipped(self):
+        self.doCleanups()
+        self.assertFalse(needs_assignment_dedupe())
+        with mock.patch('bot_logic.assignments.remove_duplicate_assignments') as remove:
+            dedupe_student_topics(sender=apps.get_app_config('bot_logic'), using='default')
+        remove.assert_not_called()
+
+
+def make_update(chat_id: int, number: int) -> dict:
+    return {'update_id': number, 'message': {'message_id': number, 'date': 0, 'text': str(number),
+                                             'chat': {'id': chat_id, 'type': 'private'}}}
+
+
+class UpdateDispatcherTestCase(SimpleTestCase):
+
+    def setUp(self):
+        # updates are held in process() until released
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def blocking_process(self, token: str, update: dict) -> None:
+        self.started.set()
+        self.release.wait(5)
+
+    def fill(self, dispatcher: UpdateDispatcher) -> None:
+        """
+        First update is taken by lane thread and blocked, second one fills the queue
+        """
+        self.assertTrue(dispatcher.put('TOKEN', make_update(1, 1)))
+        self.assertTrue(self.started.wait(5))
+        self.assertTrue(dispatcher.put('TOKEN', make_update(1, 2)))
+
+    def test_updates_of_chat_are_handled_in_order(self):
+        handled = []
+        lock = threading.Lock()
+
+        def process(token: str, update: dict) -> None:
+            time.sleep(0.001 * (update['update_id'] % 3))
+            with lock:
+                handled.append((threading.current_thread().name, update['message']['chat']['id'],
+                                update['update_id']))
+
+        dispatcher = UpdateDispatcher(process, maxsize=1000, lanes=2)
+        for number in range(30):
+            self.assertTrue(dispatcher.put('TOKEN', make_update(number % 3, number)))
+        dispatcher.join()
+        self.assertTrue(dispatcher.shutdown(5))
+        for chat_id in range(3):
+            with self.subTest(chat_id=chat_id):
+                updates = [(thread, number) for thread, chat, number in handled if chat == chat_id]
+                self.assertEqual([number for thread, number in updates], list(range(chat_id, 30, 3)))
+                # chat has one lane
+                self.assertEqual(len({thread for thread, number in updates}), 1)
+        self.assertEqual(len({thread for thread, chat, number in handled}), 2)
+        self.assertEqual(dispatcher.stats()['processed'], 30)
+
+    def test_full_lane_rejects_update(self):
+        dispatcher = UpdateDispatcher(self.blocking_process, maxsize=1, lanes=1)
+        self.fill(dispatcher)
+        self.assertFalse(dispatcher.put('TOKEN', make_update(1, 3)))
+        self.assertEqual(dispatcher.stats()['rejected'], 1)
+        self.release.set()
+        dispatcher.join()
+        self.assertTrue(dispatcher.put('TOKEN', make_update(1, 4)))
+        self.assertTrue(dispatcher.shutdown(5))
+        self.assertFalse(dispatcher.put('TOKEN', make_update(1, 5)))
+
+    def test_shutdown_of_full_lane_is_not_blocked(self):
+        dispatcher = UpdateDispatcher(self.blocking_process, maxsize=1, lanes=1)
+        self.fill(dispatcher)
+        started = time.monotonic()
+        with self.assertLogs('bot_logic.ingestion', 'ERROR'):
+            self.assertFalse(dispatcher.shutdown(0.1))
+        self.assertLess(time.monotonic() - started, 1)
+
+    @override_settings(BOT_UPDATE_MODE='queue')
+    def test_webhook_answers_503_when_lane_is_full(self):
+        dispatcher = UpdateDispatcher(self.blocking_process, maxsize=1, lanes=1)
+        with mock.patch('bot_logic.views.update_dispatcher', dispatcher), mock.patch('bot_logic.views.bot_registry'):
+            self.fill(dispatcher)
+            with self.assertLogs('bot_logic.views', 'WARNING'):
+                response = self.client.post('/telegram_bot/TOKEN', data=json.dumps(make_update(1, 3)),
+                                            content_type='application/json')
+            self.assertEqual(response.status_code, 503)
+            self.release.set()
+            dispatcher.join()
+            response = self.client.post('/telegram_bot/TOKEN', data=json.dumps(make_update(1, 4)),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        dispatcher.shutdown(5)
@@ -15,9 +15,10 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-from .views import get_web_hook
+from .views import get_web_hook, get_update_dispatcher_stats
 from django.views.decorators.csrf import csrf_exempt
 
 urlpatterns = [
+    path('stats/', get_update_dispatcher_stats, name="telegram update dispatcher stats"),
     path('<str:token>', csrf_exempt(get_web_hook), name="telegram webhook"),
 ]
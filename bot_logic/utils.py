@@ -1,16 +1,95 @@
+import threading
+import time
+from typing import Dict, Tuple
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from .models import TelegramMessage, TelegramBot
+from .default_lang import ru
+from .versions import SharedVersion
 
 
-def get_message_text(tag, message, user=None, bot_token: str = None) -> str:
-    if bot_token:
-        bot = TelegramBot.objects.filter(token=bot_token).first()
-        if bot:
-            message_to_send = TelegramMessage.objects.filter(tag=tag, bot=bot).first()
-        else:
-            message_to_send = None
-    else:
-        message_to_send = TelegramMessage.objects.filter(tag=tag, bot=user.telegram_bot).first()
-    if not message_to_send:
-        return message
+class MessageCatalog:
+    """
+    In-memory catalog of bot messages: default messages merged with TelegramMessage of bot
+
+    All TelegramMessage of bot are loaded by one query on first use,
+    catalogs are dropped when any TelegramMessage is saved or deleted in any process (see SharedVersion)
+    and reloaded after BOT_CONTENT_TTL seconds.
+    """
+
+    def __init__(self, defaults: Dict[str, str]):
+        """
+        :param defaults: default messages by tag
+        """
+        self._defaults = defaults
+        # bot pk -> (catalog, shared version, time of load)
+        self._catalogs: Dict[int, Tuple[Dict[str, str], int, float]] = {}
+        self.shared_version = SharedVersion('messages')
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tag: str, message: str, bot_id: int) -> str:
+        """
+        Get message text of bot
+        :param tag: message tag (see in default_lang.py)
+        :param message: text if tag is not found
+        :param bot_id: TelegramBot pk
+        :return: message text
+        """
+        version = self.shared_version.get()
+        entry = self._catalogs.get(bot_id)
+        if entry is not None:
+            catalog, catalog_version, loaded = entry
+            if catalog_version == version and time.monotonic() - loaded < settings.BOT_CONTENT_TTL:
+                self.hits += 1
+                return catalog.get(tag, message)
+        self.misses += 1
+        return self._load(bot_id, version).get(tag, message)
+
+    def clear(self) -> None:
+        """
+        Drop catalogs of process and change shared version after commit
+        """
+        with self._lock:
+            self._catalogs = {}
+        transaction.on_commit(self.shared_version.bump)
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'bots': len(self._catalogs)}
+
+    def _load(self, bot_id: int, version: int) -> Dict[str, str]:
+        loaded = time.monotonic()
+        catalog = dict(self._defaults)
+        overrides = {}
+        for tag, text in TelegramMessage.objects.filter(bot_id=bot_id).order_by('pk').values_list('tag', 'text'):
+            overrides.setdefault(tag, text)
+        catalog.update(overrides)
+        with self._lock:
+            catalogs = dict(self._catalogs)
+            catalogs[bot_id] = (catalog, version, loaded)
+            self._catalogs = catalogs
+        return catalog
+
+
+message_catalog = MessageCatalog(ru)
+
+
+@receiver(post_save, sender=TelegramMessage)
+@receiver(post_delete, sender=TelegramMessage)
+def clear_message_catalog(sender, instance: TelegramMessage, **kwargs):
+    message_catalog.clear()
+
+
+def get_message_text(tag, message, user=None, bot_token: str = None, telegram_bot: TelegramBot = None) -> str:
+    if telegram_bot:
+        bot_id = telegram_bot.pk
+    elif bot_token:
+        bot_id = TelegramBot.objects.filter(token=bot_token).values_list('pk', flat=True).first()
+        if not bot_id:
+            return message
     else:
-        return message_to_send.text
+        bot_id = user.telegram_bot_id
+    return message_catalog.get(tag, message, bot_id)
@@ -0,0 +1,43 @@
+import time
+from django.conf import settings
+from django.core.cache import caches
+
+
+class SharedVersion:
+    """
+    Version of data cached in memory of processes, kept in cache BOT_CACHE_ALIAS
+
+    Process checks version before use of its in-memory copy and rebuilds the copy when version is changed
+    by write in any process. The cache must be shared by all processes (e.g. memcached),
+    else copies of other processes are only bounded by BOT_CONTENT_TTL.
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: name of cached data
+        """
+        self.key = f'bot_logic:version:{name}'
+
+    def get(self) -> int:
+        """
+        Get current version, version is created on first use after cache is cleared
+        :return: version
+        """
+        cache = caches[settings.BOT_CACHE_ALIAS]
+        version = cache.get(self.key)
+        if version is None:
+            # versions start from current time, so copies built before cache was cleared are not matched
+            cache.add(self.key, int(time.time() * 1000), timeout=None)
+            version = cache.get(self.key, 0)
+        return version
+
+    def bump(self) -> None:
+        """
+        Change version, call after commit of write,
+        else data of old version can be cached with new version by concurrent update
+        """
+        try:
+            caches[settings.BOT_CACHE_ALIAS].incr(self.key)
+        except ValueError:
+            # no version yet, it is created on next read
+            pass
@@ -1,114 +1,141 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from .models import *
 from telebot import TeleBot, types
 import logging
 import json
 from .student_controllers import StudentLogic
+from .registry import BotRegistry
+from .ingestion import create_update_dispatcher
+from .telegram_client import TelegramClient, configure_api
+from .utils import message_catalog
+from .rendering import render_cache
+from .assignments import assignment_jobs
+from .sessions import SessionStore
+from .callback_router import callback_router
 
 # Create your views here.
 
 LOG = logging.getLogger(__name__)
-bot = TeleBot('')
 
 
 def get_web_hook(request, token):
-    bot_orm = TelegramBot.objects.filter(token=token).first()
-    json_data = json.loads(request.body)
-    if not bot_orm:
+    entry = bot_registry.get(token)
+    if not entry:
         LOG.error('fail bot')
         return HttpResponse('fail bot', status=500)
-    LOG.debug(str(json_data).encode('utf-8'))
-    global bot
-    bot.token = bot_orm.token
-    request_body_dict = json_data
-    update = types.Update.de_json(request_body_dict)
-    bot.process_new_updates([update])
+    json_data = json.loads(request.body)
+    if settings.BOT_UPDATE_MODE == 'queue':
+        if not update_dispatcher.put(token, json_data):
+            LOG.warning('update lane is full')
+            return HttpResponse('busy', status=503)
+        return HttpResponse('ok', status=200)
+    process_update(token, json_data)
     return HttpResponse('ok', status=200)
 
 
-@bot.message_handler(commands=['start'])
-def send_welcome(message):
-    telegram_bot = TelegramBot.objects.filter(token=bot.token).first()
-    user = Student.objects.filter(telegram_bot=telegram_bot, user_id=message.chat.id).first()
-    action = StudentLogic(bot, message, user)
-    action.welcome()
-
-
-@bot.message_handler(content_types=['text'])
-def text_logic(message: types.Message):
-    telegram_bot = TelegramBot.objects.filter(token=bot.token).first()
-    user = Student.objects.filter(telegram_bot=telegram_bot, user_id=message.chat.id).first()
-    action = StudentLogic(bot, message, user)
-    if not user or user.step == 0:
-        if not user:
-            action.check_token()
-        else:
-            user.step = action.check_token()
-
-    elif user.step == 5 and user.current_open_question:
-        user.step = action.add_open_answer()
-
-    elif user.step == 5:
-        user.step = action.message_in_test()
+@staff_member_required
+def get_update_dispatcher_stats(request):
+    stats = update_dispatcher.stats()
+    stats['message_catalog'] = message_catalog.stats()
+    stats['render_cache'] = render_cache.stats()
+    stats['assignments'] = assignment_jobs.stats()
+    return JsonResponse(stats)
+
+
+def process_update(token: str, json_data: dict) -> None:
+    """
+    Handle one telegram update
+    :param token: telegram bot token
+    :param json_data: update dict from telegram
+    :return:
+    """
+    entry = bot_registry.get(token)
+    if not entry:
+        LOG.error('fail bot')
+        return
+    LOG.debug(str(json_data).encode('utf-8'))
+    update = types.Update.de_json(json_data)
+    entry.bot.process_new_updates([update])
 
-    user.save()
 
+def setup_handlers(bot: TeleBot, telegram_bot: TelegramBot) -> None:
+    """
+    Register student handlers on TeleBot object of one TelegramBot
+    :param bot: TeleBot object
+    :param telegram_bot: TelegramBot object for this bot
+    :return:
+    """
 
-@bot.callback_query_handler(func=lambda c: True)
-def inline_logic(c):
-    LOG.debug(c.data)
-    user = Student.objects.get(user_id=c.message.chat.id)
-    action = StudentLogic(bot, c.message, user)
-
-    if c.data == "main_menu":
-        user.step = action.main_menu()
-    elif c.data == "studding":
-        user.step = action.studding()
-    elif c.data == "progress":
-        user.step = action.progress()
-    elif 'topic_' in c.data:
-        try:
-            param = c.data.split('_')
-            topic_id = int(param[1])
-            block_id = int(param[2])
-        except Exception as err:
-            LOG.error(err)
-            return
-        user.step = action.view_topic(topic_id, block_id)
-
-    elif 'test_' in c.data:
-        try:
-            param = c.data.split('_')
-            test_id = int(param[1])
-            question_id = int(param[2])
-        except Exception as err:
-            LOG.error(err)
-            return
-        user.step = action.view_test(test_id, question_id)
-
-    elif 'answer_' in c.data:
-        try:
-            param = c.data.split('_')
-            student_test_id = int(param[1])
-            question_id = int(param[2])
-            answer_id = int(param[3])
-        except Exception as err:
-            LOG.error(err)
-            return
-        user.step = action.select_answer(student_test_id, question_id, answer_id)
+    @bot.message_handler(commands=['start'])
+    def _send_welcome(message):
+        send_welcome(bot, telegram_bot, message)
 
-    user.save()
+    @bot.message_handler(content_types=['text'])
+    def _text_logic(message):
+        text_logic(bot, telegram_bot, message)
 
+    @bot.callback_query_handler(func=lambda c: True)
+    def _inline_logic(c):
+        inline_logic(bot, telegram_bot, c)
 
 
+def create_bot(token: str) -> TelegramClient:
+    return TelegramClient(token, threaded=False,
+                          global_rate=settings.TELEGRAM_GLOBAL_RATE,
+                          chat_rate=settings.TELEGRAM_CHAT_RATE,
+                          chat_burst=settings.TELEGRAM_CHAT_BURST,
+                          max_retries=settings.TELEGRAM_MAX_RETRIES,
+                          retry_budget=settings.TELEGRAM_RETRY_BUDGET)
 
 
+configure_api(api_url=settings.TELEGRAM_API_URL, pool_size=settings.TELEGRAM_POOL_SIZE)
+bot_registry = BotRegistry(setup_handlers, create_bot)
+student_sessions = SessionStore(flush_interval=settings.BOT_SESSION_FLUSH_INTERVAL, ttl=settings.BOT_SESSION_TTL)
+update_dispatcher = create_update_dispatcher(process_update, maxsize=settings.BOT_UPDATE_QUEUE_SIZE,
+                                             lanes=settings.BOT_UPDATE_LANES,
+                                             drain_timeout=settings.BOT_UPDATE_DRAIN_TIMEOUT)
 
 
+def send_welcome(bot: TeleBot, telegram_bot: TelegramBot, message: types.Message):
+    user = student_sessions.load(telegram_bot.pk, message.chat.id)
+    action = StudentLogic(bot, message, user, telegram_bot)
+    action.welcome()
 
 
+def text_logic(bot: TeleBot, telegram_bot: TelegramBot, message: types.Message):
+    action = StudentLogic(bot, message, None, telegram_bot)
+    # chat blocked by failed logins is answered without Data Base
+    if action.login_blocked():
+        return
+    user = action.user = student_sessions.load(telegram_bot.pk, message.chat.id)
+    if not user or user.step == 0:
+        if not user:
+            action.check_token()
+            return
+        else:
+            user.step = action.check_token()
 
+    elif user.step == 5 and user.current_open_question:
+        user.step = action.add_open_answer()
 
+    elif user.step == 5:
+        user.step = action.message_in_test()
 
+    student_sessions.save(user)
 
 
+def inline_logic(bot: TeleBot, telegram_bot: TelegramBot, c: types.CallbackQuery):
+    LOG.debug(c.data)
+    resolved = callback_router.resolve(c.data)
+    if not resolved:
+        LOG.error(f'unknown callback data {c.data}')
+        return
+    route, args = resolved
+    user = student_sessions.load(telegram_bot.pk, c.message.chat.id)
+    if not user:
+        return
+    action = StudentLogic(bot, c.message, user, telegram_bot)
+    user.step = getattr(action, route.method)(*args)
+    student_sessions.save(user)
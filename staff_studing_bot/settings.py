@@ -240,4 +240,75 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 WEBHOOK_HOST = os.environ['WEBHOOK_HOST']
 
 
+# Telegram updates processing
+# sync - process update inside webhook request,
+# queue - put update to serial lane of its chat and answer at once, lanes are handled in parallel
 
+BOT_UPDATE_MODE = env.str('BOT_UPDATE_MODE', default='sync')
+BOT_UPDATE_QUEUE_SIZE = env.int('BOT_UPDATE_QUEUE_SIZE', default=1000)
+BOT_UPDATE_LANES = env.int('BOT_UPDATE_LANES', default=4)
+BOT_UPDATE_DRAIN_TIMEOUT = env.float('BOT_UPDATE_DRAIN_TIMEOUT', default=10.0)
+
+# Student sessions
+# BOT_SESSION_FLUSH_INTERVAL - seconds between batched writes of student step, 0 for write on every update
+# BOT_SESSION_TTL - seconds to trust session in process memory, sessions are not shared by processes,
+# so it is 0 (load on every update) unless updates are handled by queue of one process
+
+BOT_SESSION_FLUSH_INTERVAL = env.float('BOT_SESSION_FLUSH_INTERVAL', default=0.0)
+BOT_SESSION_TTL = env.float('BOT_SESSION_TTL', default=3600.0 if BOT_UPDATE_MODE == 'queue' else 0.0)
+
+# Content and messages of bots are cached in memory of process,
+# changes are seen by other processes through versions in cache BOT_CACHE_ALIAS, it must be shared by all processes,
+# e.g. memcached, as with cache of process other processes see changes only after BOT_CONTENT_TTL seconds
+
+BOT_CACHE_ALIAS = env.str('BOT_CACHE_ALIAS', default='default')
+BOT_CONTENT_TTL = env.float('BOT_CONTENT_TTL', default=30.0)
+
+# max count of cached rendered screen parts
+BOT_RENDER_CACHE_SIZE = env.int('BOT_RENDER_CACHE_SIZE', default=2048)
+
+# failed token logins allowed per chat of bot in window of seconds
+BOT_LOGIN_ATTEMPTS = env.int('BOT_LOGIN_ATTEMPTS', default=5)
+BOT_LOGIN_WINDOW = env.float('BOT_LOGIN_WINDOW', default=900.0)
+
+# assign new topic to students of branch in background thread after commit
+BOT_ASSIGN_IN_BACKGROUND = env.bool('BOT_ASSIGN_IN_BACKGROUND', default=False)
+# students per insert of topic assignment
+BOT_ASSIGN_CHUNK_SIZE = env.int('BOT_ASSIGN_CHUNK_SIZE', default=1000)
+
+
+# Staff API lists
+# STAFF_PAGE_SIZE - rows per page without `limit` query param
+
+STAFF_PAGE_SIZE = env.int('STAFF_PAGE_SIZE', default=100)
+STAFF_MAX_PAGE_SIZE = env.int('STAFF_MAX_PAGE_SIZE', default=1000)
+# rows per query of streaming exports
+STAFF_EXPORT_CHUNK_SIZE = env.int('STAFF_EXPORT_CHUNK_SIZE', default=1000)
+
+# Conditional GET of staff reference endpoints (cities, branches, topics)
+# versions of resources are kept in cache STAFF_CACHE_ALIAS, it must be shared by all processes, e.g. memcached,
+# as writes bump versions only in cache of their process otherwise
+# STAFF_CACHE_BODIES - also cache response data by version
+
+STAFF_CACHE_ALIAS = env.str('STAFF_CACHE_ALIAS', default='default')
+STAFF_CACHE_BODIES = env.bool('STAFF_CACHE_BODIES', default=False)
+STAFF_CACHE_BODY_TIMEOUT = env.int('STAFF_CACHE_BODY_TIMEOUT', default=3600)
+
+CACHES = {
+    'default': {
+        'BACKEND': env.str('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': env.str('CACHE_LOCATION', default=''),
+    }
+}
+
+
+# Telegram API client
+# TELEGRAM_API_URL - url template of Bot API, e.g. fake server from `manage.py runfaketelegram`
+
+TELEGRAM_API_URL = env.str('TELEGRAM_API_URL', default='')
+TELEGRAM_POOL_SIZE = env.int('TELEGRAM_POOL_SIZE', default=10)
+TELEGRAM_GLOBAL_RATE = env.float('TELEGRAM_GLOBAL_RATE', default=30.0)
+TELEGRAM_CHAT_RATE = env.float('TELEGRAM_CHAT_RATE', default=1.0)
+TELEGRAM_CHAT_BURST = env.float('TELEGRAM_CHAT_BURST', default=3.0)
+TELEGRAM_MAX_RETRIES = env.int('TELEGRAM_MAX_RETRIES', default=3)
+TELEGRAM_RETRY_BUDGET = env.float('TELEGRAM_RETRY_BUDGET', default=30.0)
@@ -0,0 +1,133 @@
+import hashlib
+import math
+import time
+from functools import partial, wraps
+from typing import Callable, Optional, Tuple
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework.request import Request
+from rest_framework.views import Response
+from .models import City, RestaurantBranch, TheoryTopic, Staff
+
+# resources of staff reference endpoints
+CITIES = 'cities'
+BRANCHES = 'branches'
+TOPICS = 'topics'
+
+
+def _cache():
+    return caches[settings.STAFF_CACHE_ALIAS]
+
+
+def get_version(resource: str) -> Tuple[int, float]:
+    """
+    Get version of resource, version is created on first use after cache is cleared
+    :param resource: name of resource
+    :return: (version, time of last change)
+    """
+    cache = _cache()
+    values = cache.get_many([f'staffapi:version:{resource}', f'staffapi:modified:{resource}'])
+    version = values.get(f'staffapi:version:{resource}')
+    modified = values.get(f'staffapi:modified:{resource}')
+    if version is None or modified is None:
+        # versions start from current time, so ETags issued before cache was cleared are not matched
+        now = time.time()
+        cache.add(f'staffapi:modified:{resource}', now, timeout=None)
+        cache.add(f'staffapi:version:{resource}', int(now * 1000), timeout=None)
+        values = cache.get_many([f'staffapi:version:{resource}', f'staffapi:modified:{resource}'])
+        version = values.get(f'staffapi:version:{resource}', int(now * 1000))
+        modified = values.get(f'staffapi:modified:{resource}', now)
+    return version, modified
+
+
+def bump_version(resource: str) -> None:
+    """
+    Change version of resource, call after commit of write,
+    else data of old version can be cached with new version by concurrent request
+    :param resource: name of resource
+    """
+    cache = _cache()
+    cache.set(f'staffapi:modified:{resource}', time.time(), timeout=None)
+    try:
+        cache.incr(f'staffapi:version:{resource}')
+    except ValueError:
+        # no version yet, it is created on next read
+        pass
+
+
+def versioned(resource: str, variant: Optional[Callable[[Request], str]] = None):
+    """
+    Conditional GET for APIView method by version of resource:
+    strong ETag and Last-Modified on 200 responses, 304 for matching If-None-Match or If-Modified-Since
+    before the view runs, optional cache of response data by version (STAFF_CACHE_BODIES)
+    :param resource: name of resource
+    :param variant: function of request which returns part of response depending on request, e.g. query params
+    :return: decorator
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request: Request, *args, **kwargs) -> Response:
+            version, modified = get_version(resource)
+            key = f'{resource}-{version}'
+            if variant:
+                key += '-' + hashlib.md5(variant(request).encode()).hexdigest()[:12]
+            etag = f'"{key}"'
+            # HTTP dates have whole seconds, round up so Last-Modified is never earlier than the change
+            modified = math.ceil(modified)
+            last_modified = http_date(modified)
+
+            if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+            if if_none_match:
+                not_modified = if_none_match.strip() == '*' or \
+                    etag in (value.strip() for value in if_none_match.split(','))
+            else:
+                since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+                not_modified = since is not None and modified <= since
+            if not_modified:
+                response = Response(status=304)
+            else:
+                data = _cache().get(f'staffapi:body:{key}') if settings.STAFF_CACHE_BODIES else None
+                if data is not None:
+                    response = Response(data, status=200)
+                else:
+                    response = method(self, request, *args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                    if settings.STAFF_CACHE_BODIES:
+                        _cache().set(f'staffapi:body:{key}', response.data,
+                                     timeout=settings.STAFF_CACHE_BODY_TIMEOUT)
+            response['ETag'] = etag
+            response['Last-Modified'] = last_modified
+            response['Cache-Control'] = 'private, no-cache'
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+def bump_cities(sender, **kwargs):
+    transaction.on_commit(partial(bump_version, CITIES))
+
+
+@receiver(post_save, sender=RestaurantBranch)
+@receiver(post_delete, sender=RestaurantBranch)
+def bump_branches(sender, **kwargs):
+    transaction.on_commit(partial(bump_version, BRANCHES))
+    # topics of staff are chosen by restaurant of branch
+    transaction.on_commit(partial(bump_version, TOPICS))
+
+
+@receiver(post_save, sender=TheoryTopic)
+@receiver(post_delete, sender=TheoryTopic)
+@receiver(post_save, sender=Staff)
+@receiver(post_delete, sender=Staff)
+def bump_topics(sender, **kwargs):
+    # one version for all chains: staff sees topics of every branch of the chain
+    transaction.on_commit(partial(bump_version, TOPICS))
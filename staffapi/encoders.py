@@ -0,0 +1,113 @@
+import operator
+from typing import Any, Callable, Dict, Mapping, Optional, Sequence, Tuple
+from bot_logic.models import StudentInfo
+
+
+class RowEncoder:
+    """
+    Read-only encoder of values() rows to JSON-ready dicts
+
+    Output is built from data we own, so nothing is validated. Encoding function
+    of every set of output fields is built once and cached.
+    """
+
+    def __init__(self, columns: Mapping[str, str], converters: Optional[Mapping[str, Callable[[Any], Any]]] = None):
+        """
+        :param columns: output field -> column of values() row
+        :param converters: output field -> function of not None column value
+        """
+        self.columns = dict(columns)
+        self.converters = dict(converters or {})
+        self._compiled: Dict[Tuple[str, ...], Callable[[Mapping[str, Any]], Dict[str, Any]]] = {}
+
+    def select(self, fields: Optional[Sequence[str]] = None) -> Tuple[str, ...]:
+        """
+        :param fields: output fields, all if None
+        :return: columns for values()
+        """
+        return tuple(dict.fromkeys(self.columns[field] for field in (fields or self.columns)))
+
+    def compile(self, fields: Optional[Sequence[str]] = None) -> Callable[[Mapping[str, Any]], Dict[str, Any]]:
+        """
+        :param fields: output fields, all if None
+        :return: function of values() row which returns output dict
+        """
+        fields = tuple(fields or self.columns)
+        encode = self._compiled.get(fields)
+        if encode is not None:
+            return encode
+
+        columns = [self.columns[field] for field in fields]
+        if len(columns) == 1:
+            def get(row: Mapping[str, Any]) -> tuple:
+                return row[columns[0]],
+        else:
+            get = operator.itemgetter(*columns)
+        converters = tuple((field, self.converters[field]) for field in fields if field in self.converters)
+
+        def encode(row: Mapping[str, Any]) -> Dict[str, Any]:
+            data = dict(zip(fields, get(row)))
+            for field, convert in converters:
+                if data[field] is not None:
+                    data[field] = convert(data[field])
+            return data
+
+        self._compiled[fields] = encode
+        return encode
+
+
+def _isoformat(value) -> str:
+    return value.isoformat()
+
+
+_profile_photo_storage = StudentInfo._meta.get_field('profile_photo').storage
+
+
+def _profile_photo_url(name: str) -> Optional[str]:
+    return _profile_photo_storage.url(name) if name else None
+
+
+# student of Student values() with joined StudentInfo and StudentSettings
+STUDENT_ENCODER = RowEncoder({
+    'id': 'pk',
+    'token': 'studentsettings__token',
+    'position': 'studentinfo__position',
+    'first_name': 'studentinfo__first_name',
+    'second_name': 'studentinfo__second_name',
+    'third_name': 'studentinfo__third_name',
+    'education': 'studentinfo__education',
+    'date_work_start': 'studentinfo__date_start',
+    'date_birth': 'studentinfo__date_birth',
+    'phone': 'studentinfo__phone',
+    'email': 'studentinfo__email',
+    'profile_photo': 'studentinfo__profile_photo',
+}, {
+    'date_work_start': _isoformat,
+    'date_birth': _isoformat,
+    'profile_photo': _profile_photo_url,
+})
+
+# student of branch list with count of not checked actions
+MINIMAL_STUDENT_ENCODER = RowEncoder({
+    'id': 'pk',
+    'first_name': 'studentinfo__first_name',
+    'second_name': 'studentinfo__second_name',
+    'third_name': 'studentinfo__third_name',
+    'actions': 'actions',
+})
+
+# student topic of StudentTheoryTopic values(), opened_questions are added by caller
+ANSWER_ENCODER = RowEncoder({
+    'id': 'pk',
+    'name': 'theory_topic__name',
+    'complete_theory': 'complete_theory',
+    'complete_test': 'complete_test',
+    'complete_opened_questions': 'complete_opened_questions',
+})
+
+# opened answer of StudentTest.answers.through values()
+OPENED_QUESTION_ENCODER = RowEncoder({
+    'id': 'studentanswer_id',
+    'question': 'studentanswer__question__question',
+    'answer': 'studentanswer__text',
+})
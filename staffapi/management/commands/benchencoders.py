@@ -0,0 +1,84 @@
+import datetime
+import time
+from django.core.management.base import BaseCommand
+from staffapi.encoders import STUDENT_ENCODER, MINIMAL_STUDENT_ENCODER, ANSWER_ENCODER, OPENED_QUESTION_ENCODER
+from staffapi.serializers import StudentSerializer, MinimalStudentSerializer, AnswerSerializer, OpenedQuestionSerializer
+
+
+class Command(BaseCommand):
+    help = 'Measure rows/s of read-only encoders against validating serializer round trip on student and answer rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        students = [{'pk': i, 'studentsettings__token': f'{i:016d}', 'studentinfo__position': 'cook',
+                     'studentinfo__first_name': f'Ivan{i}', 'studentinfo__second_name': 'Petrov',
+                     'studentinfo__third_name': 'Ivanovich', 'studentinfo__education': 'Среднее',
+                     'studentinfo__date_start': datetime.date(2020, 2, 1), 'studentinfo__date_birth': None,
+                     'studentinfo__phone': '89990001122', 'studentinfo__email': f'student{i}@example.com',
+                     'studentinfo__profile_photo': '', 'actions': i % 3} for i in range(rows)]
+        topics = [{'pk': i, 'theory_topic__name': 'topic', 'complete_theory': True, 'complete_test': True,
+                   'complete_opened_questions': None} for i in range(rows)]
+        opened = [{'studentanswer_id': i, 'studentanswer__question__question': 'question',
+                   'studentanswer__text': 'answer'} for i in range(rows)]
+
+        def student_serializer(row):
+            serializer = StudentSerializer(data={
+                'id': row['pk'], 'token': row['studentsettings__token'], 'position': row['studentinfo__position'],
+                'first_name': row['studentinfo__first_name'], 'second_name': row['studentinfo__second_name'],
+                'third_name': row['studentinfo__third_name'], 'education': row['studentinfo__education'],
+                'date_work_start': row['studentinfo__date_start'], 'date_birth': row['studentinfo__date_birth'],
+                'phone': row['studentinfo__phone'], 'email': row['studentinfo__email'], 'profile_photo': None})
+            serializer.is_valid()
+            return serializer.data
+
+        def minimal_serializer(row):
+            serializer = MinimalStudentSerializer(data={
+                'id': row['pk'], 'first_name': row['studentinfo__first_name'],
+                'second_name': row['studentinfo__second_name'], 'third_name': row['studentinfo__third_name'],
+                'actions': row['actions']})
+            serializer.is_valid()
+            return serializer.data
+
+        def answer_serializer(i):
+            question = OpenedQuestionSerializer(data={'id': opened[i]['studentanswer_id'],
+                                                      'question': opened[i]['studentanswer__question__question'],
+                                                      'answer': opened[i]['studentanswer__text']})
+            question.is_valid()
+            topic = topics[i]
+            serializer = AnswerSerializer(data={
+                'id': topic['pk'], 'name': topic['theory_topic__name'], 'complete_theory': topic['complete_theory'],
+                'complete_test': topic['complete_test'],
+                'complete_opened_questions': topic['complete_opened_questions'], 'opened_questions': [question.data]})
+            serializer.is_valid()
+            return serializer.data
+
+        encode_student = STUDENT_ENCODER.compile()
+        encode_minimal = MINIMAL_STUDENT_ENCODER.compile()
+        encode_answer = ANSWER_ENCODER.compile()
+        encode_opened_question = OPENED_QUESTION_ENCODER.compile()
+
+        def answer_encoder(i):
+            topic = encode_answer(topics[i])
+            topic['opened_questions'] = [encode_opened_question(opened[i])]
+            return topic
+
+        for name, serializer, encoder, data in (
+                ('student', student_serializer, encode_student, students),
+                ('minimal student', minimal_serializer, encode_minimal, students),
+                ('answer', answer_serializer, answer_encoder, range(rows))):
+            serializer_speed = self.measure(serializer, data)
+            encoder_speed = self.measure(encoder, data)
+            self.stdout.write(f'{name:<16} serializer {serializer_speed:>11,.0f} rows/s   '
+                              f'encoder {encoder_speed:>11,.0f} rows/s   x{encoder_speed / serializer_speed:.0f}')
+
+    def measure(self, encode, data) -> float:
+        """
+        :return: rows/s
+        """
+        started = time.perf_counter()
+        for row in data:
+            encode(row)
+        return len(data) / (time.perf_counter() - started)
@@ -0,0 +1,97 @@
+import json
+import time
+import tracemalloc
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+from bot_logic.models import *
+from staffapi.encoders import STUDENT_ENCODER
+from staffapi.services import _student_values
+from staffapi.views import StudentExportView, StudentAnswersExportView
+
+
+class Command(BaseCommand):
+    help = 'Measure memory ceiling and speed of streaming exports against building whole list in memory ' \
+           'on test Data Base'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=100000)
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            started = time.monotonic()
+            user, branch = self.create_dataset(options['students'])
+            self.stdout.write(f'dataset: {options["students"]} students in {time.monotonic() - started:.1f}s')
+
+            factory = APIRequestFactory()
+
+            def stream(view, url):
+                request = factory.get(url)
+                force_authenticate(request, user)
+                response = view.as_view()(request)
+                return sum(len(chunk) for chunk in response.streaming_content)
+
+            def in_memory():
+                encode = STUDENT_ENCODER.compile()
+                rows = [encode(row) for row in _student_values(Student.objects.filter(staff__restaurant_branch=branch),
+                                                               list(STUDENT_ENCODER.columns)).order_by('pk')]
+                return len(json.dumps({'data': rows, 'success': True}, ensure_ascii=False))
+
+            with override_settings(STAFF_EXPORT_CHUNK_SIZE=options['chunk_size']):
+                self.measure('students in memory list', in_memory, options['students'])
+                self.measure('students ndjson stream', lambda: stream(
+                    StudentExportView, f'/staff/student/export/?restaurant_branch={branch.pk}'), options['students'])
+                self.measure('students csv stream', lambda: stream(
+                    StudentExportView, f'/staff/student/export/?restaurant_branch={branch.pk}&data_format=csv'),
+                    options['students'])
+                self.measure('answers ndjson stream', lambda: stream(
+                    StudentAnswersExportView, f'/staff/answers/export/?restaurant_branch={branch.pk}'),
+                    options['students'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def measure(self, name: str, run, rows: int):
+        """
+        Run export twice: timed, then with tracemalloc for peak of allocated memory
+        :param name: name of export
+        :param run: function which exports all rows and returns count of written bytes
+        :param rows: count of exported rows
+        """
+        started = time.perf_counter()
+        size = run()
+        seconds = time.perf_counter() - started
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.stdout.write(f'{name:<25} {seconds:6.2f}s {rows / seconds:>9,.0f} rows/s '
+                          f'{size / 2 ** 20:7.1f} MiB written, peak {peak / 2 ** 20:7.1f} MiB')
+
+    def create_dataset(self, students: int):
+        """
+        Create branch with students, their info, settings and topic with explicit pks
+        :return: staff user, restaurant branch
+        """
+        telegram_bot = TelegramBot.objects.create(name='bench', token='bench')
+        branch = RestaurantBranch.objects.create(main_restaurant=Restaurant.objects.create(name='bench', bot=telegram_bot),
+                                                 name='bench', address='bench')
+        user = User.objects.create(username='bench')
+        staff = Staff.objects.create(restaurant_branch=branch, user=user)
+        topic = TheoryTopic.objects.create(restaurant=branch, creator=staff, name='bench', text='bench')
+        with transaction.atomic():
+            Student.objects.bulk_create((Student(pk=i + 1, staff=staff, telegram_bot=telegram_bot, step=1)
+                                         for i in range(students)), batch_size=500)
+            StudentInfo.objects.bulk_create(
+                (StudentInfo(student_id=i + 1, position='cook', first_name=f'Ivan{i}', second_name='Petrov',
+                             third_name='Ivanovich', phone='89990001122', email=f'student{i}@example.com')
+                 for i in range(students)), batch_size=500)
+            StudentSettings.objects.bulk_create((StudentSettings(student_id=i + 1, token=f'{i:016d}')
+                                                 for i in range(students)), batch_size=500)
+            StudentTheoryTopic.objects.bulk_create(
+                (StudentTheoryTopic(student_id=i + 1, theory_topic=topic, blocked=False, complete_theory=True)
+                 for i in range(students)), batch_size=500)
+        return user, branch
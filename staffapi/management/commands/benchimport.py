@@ -0,0 +1,60 @@
+import json
+import time
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIRequestFactory, force_authenticate
+from bot_logic.models import *
+from staffapi.views import StudentImportView
+
+
+class Command(BaseCommand):
+    help = 'Measure speed of bulk student import from CSV and NDJSON on test Data Base'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            user, topic = self.create_dataset()
+            factory = APIRequestFactory()
+            rows = options['rows']
+            uploads = {
+                'csv': '\n'.join(['first_name,second_name,third_name,position,date_start,email,phone,course'] + [
+                    f'Ivan{{0}}-{i},Petrov,Ivanovich,cook,01.02.2020,student{i}@example.com,89990001122,{topic.pk}'
+                    for i in range(rows)]),
+                'ndjson': '\n'.join(json.dumps({
+                    'first_name': f'Ivan{{0}}-{i}', 'second_name': 'Petrov', 'third_name': 'Ivanovich',
+                    'position': 'cook', 'date_start': '01.02.2020', 'email': f'student{i}@example.com',
+                    'phone': '89990001122', 'course': topic.pk}) for i in range(rows)),
+            }
+            for data_format, upload in uploads.items():
+                for attempt in range(options['repeat']):
+                    # names are unique in every attempt, else rows are failed as duplicates
+                    request = factory.post(f'/staff/student/import/?data_format={data_format}',
+                                           data=upload.replace('{0}', f'{data_format}{attempt}').encode(),
+                                           content_type='text/plain')
+                    force_authenticate(request, user)
+                    started = time.perf_counter()
+                    response = StudentImportView.as_view()(request)
+                    seconds = time.perf_counter() - started
+                    created = response.data['data']['created'] if response.status_code == 201 else 0
+                    self.stdout.write(f'{data_format:<7} {rows} rows {seconds:6.2f}s {created / seconds:>9,.0f} '
+                                      f'created rows/s, status {response.status_code}')
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def create_dataset(self):
+        """
+        Create restaurant chain with bot, branch, staff and topic
+        :return: staff user, topic
+        """
+        telegram_bot = TelegramBot.objects.create(name='bench', token='bench')
+        branch = RestaurantBranch.objects.create(main_restaurant=Restaurant.objects.create(name='bench', bot=telegram_bot),
+                                                 name='bench', address='bench')
+        user = User.objects.create(username='bench')
+        staff = Staff.objects.create(restaurant_branch=branch, user=user)
+        topic = TheoryTopic.objects.create(restaurant=branch, creator=staff, name='bench', text='bench')
+        return user, topic
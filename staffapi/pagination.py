@@ -0,0 +1,93 @@
+import base64
+import binascii
+import json
+from functools import reduce
+from typing import Any, List, Optional, Sequence, Tuple
+from django.conf import settings
+from django.db.models import Q, QuerySet
+from rest_framework.request import Request
+
+
+class PageError(ValueError):
+    """
+    Invalid `cursor` or `limit` query param
+    """
+
+
+def encode_cursor(ordering: Sequence[str], values: Sequence[Any]) -> str:
+    """
+    :param ordering: ordering of page
+    :param values: values of ordering fields of last row of page
+    :return: opaque cursor of next page
+    """
+    return base64.urlsafe_b64encode(json.dumps([list(ordering), list(values)]).encode()).decode()
+
+
+def decode_cursor(ordering: Sequence[str], cursor: str) -> List[Any]:
+    """
+    :param ordering: ordering of requested page, cursor of other ordering is invalid
+    :param cursor: cursor from previous page
+    :return: values of ordering fields of last row of previous page
+    """
+    try:
+        cursor_ordering, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, TypeError):
+        raise PageError('invalid param `cursor`')
+    if cursor_ordering != list(ordering) or len(values) != len(ordering):
+        raise PageError('invalid param `cursor`')
+    return values
+
+
+def get_page_params(request: Request) -> Tuple[Optional[str], int]:
+    """
+    :param request: request with optional `cursor` and `limit` query params
+    :return: (cursor, limit)
+    """
+    limit = request.query_params.get('limit')
+    if limit is None:
+        return request.query_params.get('cursor'), settings.STAFF_PAGE_SIZE
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise PageError('invalid param `limit`')
+    if not 0 < limit <= settings.STAFF_MAX_PAGE_SIZE:
+        raise PageError(f'param `limit` must be from 1 to {settings.STAFF_MAX_PAGE_SIZE}')
+    return request.query_params.get('cursor'), limit
+
+
+def _after(ordering: Sequence[str], values: Sequence[Any]) -> Q:
+    """
+    Condition of rows after row with values in ordering,
+    e.g. ('-actions', 'pk') gives actions < a OR (actions = a AND pk > b)
+    """
+    conditions = []
+    for i, field in enumerate(ordering):
+        name = field.lstrip('-')
+        condition = Q(**{f'{name}__lt' if field.startswith('-') else f'{name}__gt': values[i]})
+        for previous, value in zip(ordering[:i], values):
+            condition &= Q(**{previous.lstrip('-'): value})
+        conditions.append(condition)
+    return reduce(lambda left, right: left | right, conditions)
+
+
+def _value(row: Any, field: str) -> Any:
+    name = field.lstrip('-')
+    return row[name] if isinstance(row, dict) else getattr(row, name)
+
+
+def paginate(queryset: QuerySet, ordering: Sequence[str], cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+    """
+    Get page of queryset by keyset of ordering, one query for any page
+    :param queryset: queryset of model instances or values() with ordering fields
+    :param ordering: unique ordering, last field should be pk
+    :param cursor: cursor from previous page or None for first page
+    :param limit: rows per page
+    :return: (rows of page, cursor of next page or None for last page)
+    """
+    if cursor:
+        queryset = queryset.filter(_after(ordering, decode_cursor(ordering, cursor)))
+    rows = list(queryset.order_by(*ordering)[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(ordering, [_value(rows[-1], field) for field in ordering])
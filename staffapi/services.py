@@ -1,13 +1,22 @@
 from rest_framework.views import Response
+from rest_framework.exceptions import ValidationError
 from django.http import HttpRequest
 from .serializers import CitySerializer, RestaurantBranchSerializer, \
-    StudentSerializer, MinimalStudentSerializer, \
-    AnswerSerializer, OpenedQuestionSerializer, \
     AnswerPostSerializer, StudentPostSerializer, \
     TheoryTopicListSerializer
+import csv
+from collections import defaultdict
+import io
+import json
 from .models import *
+from django.db import connection, transaction
+from django.db.models import Exists, F, Max, OuterRef, QuerySet, Subquery
+from django.db.models.functions import Coalesce
+from bot_logic.progress import sync_progress, rebuild_progress, ensure_progress
+from .pagination import paginate
+from .encoders import STUDENT_ENCODER, MINIMAL_STUDENT_ENCODER, ANSWER_ENCODER, OPENED_QUESTION_ENCODER
 from rest_framework.utils.serializer_helpers import ReturnList, ReturnDict
-from typing import Optional, List, Dict, Any, Union
+from typing import Optional, List, Dict, Any, Union, Iterable, Iterator, Sequence
 from rest_framework.request import Request
 
 
@@ -58,151 +67,320 @@ def validate_restaurant_branch_to_pk(pk: int) -> Optional[RestaurantBranch]:
         return None
 
 
-def validate_student_to_pk(pk: int) -> Optional[Student]:
+def validate_staff_restaurant_branch(staff: Staff, pk: Any) -> Optional[RestaurantBranch]:
+    """
+    This function validate restaurant branch to exist in restaurant chain of staff
+    :param staff:
+    :param pk: RestaurantBranch pk
+    :return: restaurant branch or None if it does not exist or belongs to other restaurant chain
+    """
+    if not str(pk).isdigit() or staff.restaurant_branch_id is None:
+        return None
+    return RestaurantBranch.objects.filter(
+        pk=pk, main_restaurant__restaurantbranch=staff.restaurant_branch_id).first()
+
+
+def get_staff_students(staff: Staff) -> QuerySet:
+    """
+    :param staff:
+    :return: students of all branches of restaurant chain of staff
+    """
+    return Student.objects.filter(staff__restaurant_branch__main_restaurant__restaurantbranch=staff.restaurant_branch_id)
+
+
+def validate_student_to_pk(pk: int, staff: Optional[Staff] = None) -> Optional[Student]:
     """
     This function validate student to exist in Data Base
     :param pk:
+    :param staff: only students of restaurant chain of staff if not None
     :return:
     """
+    students = get_staff_students(staff) if staff is not None else Student.objects.all()
     try:
-        student = Student.objects.get(pk=pk)
+        student = students.get(pk=pk)
         return student
-    except Student.DoesNotExist:
+    except (Student.DoesNotExist, ValueError):
         return None
 
 
-def get_minimal_info_about_students(restaurant_branch: RestaurantBranch) -> List:
+# orderings of student list by `ordering` query param, pk makes keyset unique
+STUDENT_LIST_ORDERINGS = {
+    'id': ('pk',),
+    'actions': ('actions', 'pk'),
+    '-actions': ('-actions', 'pk'),
+}
+
+
+def get_minimal_info_about_students(restaurant_branch: RestaurantBranch, ordering: str = 'id',
+                                    cursor: Optional[str] = None, limit: int = 100) -> Dict[str, Any]:
     """
-    This function generate list of students and not view actions
+    This function generate page of students and not view actions by 2 queries
     :param restaurant_branch:
-    :return:
+    :param ordering: key of STUDENT_LIST_ORDERINGS
+    :param cursor: cursor of page, None for first page
+    :param limit: students per page
+    :return: {"data": [students], "next": cursor of next page or None}
     """
-    students = Student.objects.filter(staff__restaurant_branch=restaurant_branch).all()
-    results = []
-    for student in students:
-        students_serializer = MinimalStudentSerializer(data={"id": student.pk,
-                                                             "first_name": student.studentinfo.first_name,
-                                                             "second_name": student.studentinfo.second_name,
-                                                             "third_name": student.studentinfo.third_name,
-                                                             "actions": _calculate_student_not_process_actions(student)})
-        if students_serializer.is_valid():
-            results.append(students_serializer.data)
+    students = Student.objects.filter(staff__restaurant_branch=restaurant_branch)
+    ensure_progress(students)
+    # finished tests which need check Staff, from progress summary
+    students = students.annotate(actions=Coalesce(F('progress__pending_reviews'), 0)) \
+        .values(*MINIMAL_STUDENT_ENCODER.select())
+    rows, next_cursor = paginate(students, STUDENT_LIST_ORDERINGS[ordering], cursor, limit)
+    encode = MINIMAL_STUDENT_ENCODER.compile()
+    return {"data": [encode(row) for row in rows], "next": next_cursor}
+
+
+# default output fields of students, login token is returned only on request
+STUDENT_READ_FIELDS = tuple(field for field in STUDENT_ENCODER.columns if field != 'token')
+
+
+def parse_student_fields(fields: Optional[str], default: Optional[Sequence[str]] = None) -> Optional[List[str]]:
+    """
+    :param fields: comma separated output fields from `fields` query param
+    :param default: fields if param is empty, all fields if None
+    :return: list of fields without duplicates in order of STUDENT_ENCODER columns, so encoders are compiled
+    for a bounded number of field sets, or None if some field is unknown
+    """
+    if not fields:
+        return list(default or STUDENT_ENCODER.columns)
+    fields = {field.strip() for field in fields.split(',') if field.strip()}
+    if not fields or any(field not in STUDENT_ENCODER.columns for field in fields):
+        return None
+    return [field for field in STUDENT_ENCODER.columns if field in fields]
+
+
+def _student_values(students: QuerySet, fields: List[str]) -> QuerySet:
+    """
+    :param students: queryset of students
+    :param fields: output fields of STUDENT_ENCODER
+    :return: values() queryset of needed columns of students with joined info and settings, pk is always selected
+    """
+    return students.values(*dict.fromkeys(('pk',) + STUDENT_ENCODER.select(fields)))
+
+
+def get_full_student_info(pk: int, fields: Optional[List[str]] = None,
+                          staff: Optional[Staff] = None) -> Optional[Dict[str, Any]]:
+    """
+    This function get one student by one query
+    :param pk: Student pk
+    :param fields: output fields, all if None
+    :param staff: only students of restaurant chain of staff if not None
+    :return: student data or None if student does not exist
+    """
+    students = get_staff_students(staff) if staff is not None else Student.objects.all()
+    row = _student_values(students.filter(pk=pk), fields).first()
+    return STUDENT_ENCODER.compile(fields)(row) if row else None
+
+
+def get_students_page(staff: Staff, restaurant: Optional[RestaurantBranch] = None,
+                      fields: Optional[List[str]] = None, cursor: Optional[str] = None, limit: int = 100) -> Dict[str, Any]:
+    """
+    This function get page of students of restaurant branch or of staff by one query
+    :param staff:
+    :param restaurant: restaurant branch checked by validate_staff_restaurant_branch, students of staff if None
+    :param fields: output fields, all if None
+    :param cursor: cursor of page, None for first page
+    :param limit: students per page
+    :return: {"data": [students], "next": cursor of next page or None}
+    """
+    if restaurant:
+        students = Student.objects.filter(staff__restaurant_branch=restaurant)
+    else:
+        students = Student.objects.filter(staff=staff)
+    rows, next_cursor = paginate(_student_values(students, fields), ('pk',), cursor, limit)
+    encode = STUDENT_ENCODER.compile(fields)
+    return {"data": [encode(row) for row in rows], "next": next_cursor}
+
+
+def _pending_review_topics(student_topics: Optional[QuerySet] = None) -> QuerySet:
+    """
+    :param student_topics: queryset of StudentTheoryTopic to filter, all if None
+    :return: student topics with passed test whose opened answers are not checked by Staff,
+    last finished attempt of test must have opened questions
+    """
+    if student_topics is None:
+        student_topics = StudentTheoryTopic.objects.all()
+    last_test = StudentTest.objects.filter(student=OuterRef(OuterRef('student')),
+                                           test=OuterRef(OuterRef('theory_topic__test')),
+                                           is_finished=True).order_by('-pk').values('pk')[:1]
+    return student_topics.filter(
+        Exists(StudentTest.objects.filter(pk=Subquery(last_test), max_opened_questions__gt=0)),
+        complete_test=True, complete_opened_questions__isnull=True)
+
+
+def _students_answers(student_ids: List[int], pending: bool = False) -> Dict[int, Dict[str, Any]]:
+    """
+    Get topics and opened answers of last finished test of students by 3 queries
+    :param student_ids: Student pks
+    :param pending: only topics pending review
+    :return: {student pk: {"student_id", "topics": [topics with opened answers]}}
+    """
+    results = {student_id: {"student_id": student_id, "topics": []} for student_id in student_ids}
+    student_topics = StudentTheoryTopic.objects.filter(student_id__in=student_ids)
+    if pending:
+        student_topics = _pending_review_topics(student_topics)
+    student_topics = list(student_topics.order_by('student_id', 'pk').values(
+        'student_id', 'theory_topic__test_id', *ANSWER_ENCODER.select()))
+
+    # last finished attempt of test of every passed topic
+    test_ids = {row['theory_topic__test_id'] for row in student_topics if row['complete_test']}
+    last_tests = {(row['student_id'], row['test_id']): row['last'] for row in StudentTest.objects.filter(
+        student_id__in=student_ids, test_id__in=test_ids, is_finished=True).order_by().values(
+        'student_id', 'test_id').annotate(last=Max('pk'))} if test_ids else {}
+
+    opened_answers = defaultdict(list)
+    encode_opened_question = OPENED_QUESTION_ENCODER.compile()
+    for row in StudentTest.answers.through.objects.filter(
+            studenttest_id__in=list(last_tests.values()), studentanswer__question__is_opened=True).order_by(
+            'studentanswer_id').values('studenttest_id', *OPENED_QUESTION_ENCODER.select()):
+        opened_answers[row['studenttest_id']].append(encode_opened_question(row))
+
+    encode_answer = ANSWER_ENCODER.compile()
+    for row in student_topics:
+        last_test = row['complete_test'] and last_tests.get((row['student_id'], row['theory_topic__test_id']))
+        topic = encode_answer(row)
+        topic['opened_questions'] = opened_answers.get(last_test, [])
+        results[row['student_id']]['topics'].append(topic)
     return results
 
 
-def _calculate_student_not_process_actions(student: Student):
+def get_all_students_answers(restaurant_branch: RestaurantBranch, pending: bool = False,
+                             cursor: Optional[str] = None, limit: int = 100) -> Dict[str, Any]:
+    """
+    Get page of students answers in restaurant branch by 4 queries
+    :param restaurant_branch:
+    :param pending: only students and topics pending review
+    :param cursor: cursor of page, None for first page
+    :param limit: students per page
+    :return: {"data": [students answers], "next": cursor of next page or None}
     """
-    This function calculate last student actions which need check Staff
+    students = Student.objects.filter(staff__restaurant_branch=restaurant_branch)
+    if pending:
+        pending_topics = _pending_review_topics(StudentTheoryTopic.objects.filter(student=OuterRef('pk')))
+        students = students.filter(Exists(pending_topics))
+    rows, next_cursor = paginate(students.values('pk'), ('pk',), cursor, limit)
+    results = _students_answers([row['pk'] for row in rows], pending)
+    return {"data": list(results.values()), "next": next_cursor}
+
+
+def get_current_student_answers(student: Student, pending: bool = False) -> Dict[str, Any]:
+    """
+    Get info about one student answers by 3 queries
     :param student:
+    :param pending: only topics pending review
     :return:
     """
-    return StudentTest.objects.filter(student=student, is_finished=True, is_check_staff=False).count()
+    return _students_answers([student.pk], pending)[student.pk]
+
+
+# columns of answers CSV export, one row per student topic
+ANSWER_EXPORT_FIELDS = ('student_id', 'id', 'name', 'complete_theory', 'complete_test', 'complete_opened_questions',
+                        'opened_questions')
+
 
+# json.dumps with arguments builds new encoder on every call
+_json_encode = json.JSONEncoder(ensure_ascii=False).encode
 
-def get_full_student_info(staff: Staff, restaurant: RestaurantBranch = None, pk: int = None, many: bool = False) -> Optional[List]:
+
+def _iter_pk_chunks(queryset: QuerySet, chunk_size: int) -> Iterator[List[int]]:
     """
-    This function get one ore all instanses of students
-    :param staff:
-    :param restaurant:
-    :param pk: if not many
-    :param many: if True return all
-    :return:
+    :param queryset: queryset of model
+    :param chunk_size: pks per query
+    :return: iterator of chunks of pks by keyset, only pk column is selected, so database sorts only keys
     """
-    if many:
-        if restaurant:
-            students = Student.objects.filter(staff__restaurant_branch=restaurant).all()
-        else:
-            students = Student.objects.filter(staff=staff).all()
+    cursor = None
+    while True:
+        rows, cursor = paginate(queryset.values('pk'), ('pk',), cursor, chunk_size)
+        if rows:
+            yield [row['pk'] for row in rows]
+        if not cursor:
+            return
 
-        results = []
-        for student in students:
-            photo = student.studentinfo.profile_photo.url if student.studentinfo.profile_photo else None
-            students_serializer = StudentSerializer(data={"id": student.pk,
-                                                          "token": student.studentsettings.token,
-                                                          "position": student.studentinfo.position,
-                                                          "first_name": student.studentinfo.first_name,
-                                                          "second_name": student.studentinfo.second_name,
-                                                          "third_name": student.studentinfo.third_name,
-                                                          "date_work_start": student.studentinfo.date_start,
-                                                          "date_birth": student.studentinfo.date_birth,
-                                                          "phone": student.studentinfo.phone,
-                                                          "email": student.studentinfo.email,
-                                                          "profile_photo": photo})
-            if students_serializer.is_valid():
-                results.append(students_serializer.data)
-        return results
+
+def iter_students_export(staff: Staff, restaurant: Optional[RestaurantBranch] = None,
+                         fields: Optional[List[str]] = None, chunk_size: int = 1000) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate all students of restaurant branch or of staff by chunks, 2 queries per chunk
+    :param staff:
+    :param restaurant: restaurant branch checked by validate_staff_restaurant_branch, students of staff if None
+    :param fields: output fields, all if None
+    :param chunk_size: students per query
+    :return: iterator of student data
+    """
+    encode = STUDENT_ENCODER.compile(fields)
+    if restaurant:
+        students = Student.objects.filter(staff__restaurant_branch=restaurant)
     else:
-        try:
-            student = Student.objects.get(pk=pk)
-            photo = student.studentinfo.profile_photo.url if student.studentinfo.profile_photo else None
-            students_serializer = StudentSerializer(data={"id": student.pk,
-                                                          "token": student.studentsettings.token,
-                                                          "position": student.studentinfo.position,
-                                                          "first_name": student.studentinfo.first_name,
-                                                          "second_name": student.studentinfo.second_name,
-                                                          "third_name": student.studentinfo.third_name,
-                                                          "date_work_start": student.studentinfo.date_start,
-                                                          "date_birth": student.studentinfo.date_birth,
-                                                          "phone": student.studentinfo.phone,
-                                                          "email": student.studentinfo.email,
-                                                          "profile_photo": photo})
-            if students_serializer.is_valid():
-                return students_serializer.data
-        except Student.DoesNotExist:
-            return None
-
-
-def get_all_students_answers(restaurant_branch: RestaurantBranch) -> Optional[List]:
-    """
-    Get info about all students answers in restaurant branch
+        students = Student.objects.filter(staff=staff)
+    for pks in _iter_pk_chunks(students, chunk_size):
+        # joined columns of chunk are read by range of its pks
+        for row in _student_values(students.filter(pk__gte=pks[0], pk__lte=pks[-1]), fields).order_by('pk'):
+            yield encode(row)
+
+
+def iter_answers_export(restaurant_branch: RestaurantBranch, pending: bool = False,
+                        chunk_size: int = 1000) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate answers of all students of restaurant branch by chunks, up to 4 queries per chunk
     :param restaurant_branch:
-    :return:
+    :param pending: only students and topics pending review
+    :param chunk_size: students per chunk
+    :return: iterator of students answers
     """
-    students = Student.objects.filter(staff__restaurant_branch=restaurant_branch).all()
-    results = []
-    for student in students:
-        results.append(get_current_student_answers(student))
-    return results
+    students = Student.objects.filter(staff__restaurant_branch=restaurant_branch)
+    if pending:
+        pending_topics = _pending_review_topics(StudentTheoryTopic.objects.filter(student=OuterRef('pk')))
+        students = students.filter(Exists(pending_topics))
+    for pks in _iter_pk_chunks(students, chunk_size):
+        yield from _students_answers(pks, pending).values()
 
 
-def get_current_student_answers(student: Student) -> Optional[Dict[str, Union[list, Any]]]:
+def iter_answer_topics(students_answers: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
     """
-    Get info about one student answers
-    :param student:
-    :return:
+    Flatten students answers to rows of ANSWER_EXPORT_FIELDS, opened answers are JSON encoded
+    :param students_answers: iterator of students answers
+    :return: iterator of topic rows
     """
-    student_topics = StudentTheoryTopic.objects.filter(student=student).all()
-
-    results = {"student_id": student.pk,
-               'topics': []}
-
-    for student_topic in student_topics:
-        opened_questions = []
-        if student_topic.complete_test:
-            student_tests = StudentTest.objects.filter(student=student, test__theorytopic=student_topic.theory_topic, is_finished=True).all()
-            if student_tests:
-
-                student_tests = list(student_tests)
-                student_test = student_tests[-1]
-                for answer in student_test.answers.all():
-                    if answer.question.is_opened:
-                        print(answer.question.question)
-                        print(answer.text)
-                        opened_question = OpenedQuestionSerializer(data={"id": answer.pk,
-                                                                         "question": answer.question.question,
-                                                                         "answer": answer.text})
-                        if opened_question.is_valid():
-                            opened_questions.append(opened_question.data)
-
-        answer_in_topic = AnswerSerializer(data={"id": student_topic.pk,
-                                                 "name": student_topic.theory_topic.name,
-                                                 "complete_theory": student_topic.complete_theory,
-                                                 "complete_test": student_topic.complete_test,
-                                                 "complete_opened_questions": student_topic.complete_opened_questions,
-                                                 "opened_questions": opened_questions})
-        if answer_in_topic.is_valid():
-            results['topics'].append(answer_in_topic.data)
-    return results
+    for student in students_answers:
+        for topic in student['topics']:
+            yield dict(topic, student_id=student['student_id'], opened_questions=_json_encode(topic['opened_questions']))
+
+
+class _Echo:
+    """
+    File-like object for csv.writer which returns written line
+    """
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def stream_rows(rows: Iterable[Dict[str, Any]], data_format: str, fields: Sequence[str],
+                lines_per_chunk: int = 500) -> Iterator[str]:
+    """
+    Encode rows to NDJSON or CSV with header row, lines are joined to chunks of streaming response
+    :param rows: iterator of row dicts
+    :param data_format: ndjson or csv
+    :param fields: CSV columns
+    :param lines_per_chunk: lines per yielded chunk
+    :return: iterator of text chunks
+    """
+    writer = csv.writer(_Echo())
+
+    def encode(row: Dict[str, Any]) -> str:
+        if data_format == 'csv':
+            return writer.writerow([row.get(field) for field in fields])
+        return _json_encode(row) + '\n'
+
+    lines = [writer.writerow(fields)] if data_format == 'csv' else []
+    for row in rows:
+        lines.append(encode(row))
+        if len(lines) >= lines_per_chunk:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
 
 
 def change_answer_status(request: Request, pk: int):
@@ -214,7 +392,9 @@ def change_answer_status(request: Request, pk: int):
         "complete_opened_questions": request.data.get('complete_opened_questions')
     })
     if post_ser.is_valid():
-        post_ser.save()
+        with transaction.atomic():
+            post_ser.save()
+            sync_progress(answer.student_id, activity=False)
         return {"success": True, "data": "ok"}
     else:
         return {"success": False, "error": post_ser.errors}
@@ -239,33 +419,123 @@ def register_new_student(request: Request) -> Dict:
 
         created = add_course_to_user(topic, student)
 
-        user_data = {"id": student.pk,
-                     "token": student.studentsettings.token,
-                     "position": student.studentinfo.position,
-                     "first_name": student.studentinfo.first_name,
-                     "second_name": student.studentinfo.second_name,
-                     "third_name": student.studentinfo.third_name,
-                     "date_work_start": student.studentinfo.date_start,
-                     "date_birth": student.studentinfo.date_birth,
-                     "education": student.studentinfo.education,
-                     "phone": student.studentinfo.phone,
-                     "email": student.studentinfo.email}
-
-        if not created:
-            user_data['course'] = None
-        else:
-            user_data['course'] = topic.pk
-
-        students_serializer_return = StudentSerializer(data=user_data)
-
-        if students_serializer_return.is_valid():
-            return {'data': students_serializer_return.validated_data, 'success': True}
-        print(students_serializer_return.errors)
-        return {'data': student_ser.validated_data, 'success': True, 'access_token': student.studentsettings.token}
+        user_data = get_full_student_info(student.pk)
+        user_data['course'] = topic.pk if created else None
+        return {'data': user_data, 'success': True}
     else:
         return {'errors': student_ser.errors, 'success': False}
 
 
+def parse_students_upload(request: Request) -> List[Dict[str, Any]]:
+    """
+    Parse uploaded students: CSV with header row or NDJSON (one JSON object per line),
+    from multipart `file` or request body. Format is taken from `data_format` query param, file name or content type
+    :param request:
+    :return: list of row dicts
+    """
+    upload = request.FILES.get('file') if (request.content_type or '').startswith('multipart/') else None
+    if upload:
+        content = upload.read()
+        name = upload.name or ''
+    else:
+        content = request.body
+        name = ''
+    text = content.decode('utf-8-sig')
+    data_format = request.query_params.get('data_format') or \
+        ('csv' if name.endswith('.csv') or 'csv' in (request.content_type or '') else 'ndjson')
+
+    if data_format == 'csv':
+        return [{key: value for key, value in row.items() if value != ''}
+                for row in csv.DictReader(io.StringIO(text))]
+    rows = []
+    for line in text.splitlines():
+        if line.strip():
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            rows.append(row if isinstance(row, dict) else {'__error__': 'invalid json object'})
+    return rows
+
+
+def import_students(request: Request) -> Dict:
+    """
+    Create many students of request staff in one transaction by bulk inserts:
+    Student, StudentInfo, StudentSettings with unique tokens, course assignments and progress summaries.
+    Row fields are fields of StudentPostSerializer and optional `course` (TheoryTopic pk of restaurant chain of staff)
+    :param request:
+    :return: {"success": bool, "data": {"created": int, "failed": int, "rows": [per row result]}}
+    """
+    staff = request.user.staff
+    restaurant = staff.restaurant_branch.main_restaurant if staff.restaurant_branch_id else None
+    if restaurant is None or restaurant.bot_id is None:
+        # students can not be created without bot of restaurant chain
+        return {"errors": "restaurant has no bot", "success": False}
+    rows = parse_students_upload(request)
+    if not rows:
+        return {"errors": "no rows", "success": False}
+
+    courses = set()
+    for row in rows:
+        if str(row.get('course', '')).isdigit():
+            courses.add(int(row['course']))
+    # only topics of restaurant chain of staff
+    courses = set(TheoryTopic.objects.filter(pk__in=courses, restaurant__main_restaurant_id=restaurant.pk)
+                  .values_list('pk', flat=True))
+    existing = set(StudentInfo.objects.filter(student__staff=staff).values_list('first_name', 'second_name',
+                                                                                'third_name'))
+    # one serializer for all rows, its fields are built once
+    student_ser = StudentPostSerializer()
+    results = []
+    valid = []
+    for number, row in enumerate(rows, start=1):
+        if '__error__' in row:
+            results.append({"row": number, "success": False, "errors": row['__error__']})
+            continue
+        course = row.get('course')
+        if course not in (None, '') and (not str(course).isdigit() or int(course) not in courses):
+            results.append({"row": number, "success": False, "errors": "course does not exist"})
+            continue
+        try:
+            data = student_ser.run_validation(row)
+        except ValidationError as err:
+            results.append({"row": number, "success": False, "errors": err.detail})
+            continue
+        name = (data['first_name'], data['second_name'], data['third_name'])
+        if name in existing:
+            results.append({"row": number, "success": False, "errors": "Student already exist"})
+            continue
+        existing.add(name)
+        result = {"row": number, "success": True}
+        results.append(result)
+        valid.append((result, data, int(course) if course not in (None, '') else None))
+
+    with transaction.atomic():
+        students = [Student(staff=staff, telegram_bot_id=restaurant.bot_id) for _ in valid]
+        Student.objects.bulk_create(students)
+        if not connection.features.can_return_rows_from_bulk_insert:
+            # inserted rows are the last ones, other writers wait for end of transaction
+            pks = list(Student.objects.order_by('-pk').values_list('pk', flat=True)[:len(students)])[::-1]
+            for student, pk in zip(students, pks):
+                student.pk = pk
+
+        StudentInfo.objects.bulk_create(StudentInfo(student=student, **data)
+                                        for student, (_, data, _) in zip(students, valid))
+        students_settings = []
+        for student in students:
+            student_settings = StudentSettings(student=student)
+            student_settings.create_token()
+            students_settings.append(student_settings)
+        StudentSettings.objects.bulk_create(students_settings)
+        StudentTheoryTopic.objects.bulk_create(StudentTheoryTopic(theory_topic_id=course, student=student, blocked=False)
+                                               for student, (_, _, course) in zip(students, valid) if course)
+        rebuild_progress([student.pk for student in students])
+
+    for student, student_settings, (result, _, course) in zip(students, students_settings, valid):
+        result.update({"id": student.pk, "token": student_settings.token, "course": course})
+    return {"success": True, "data": {"created": len(valid), "failed": len(rows) - len(valid), "rows": results}}
+
+
 def update_student_info(request: Request, pk: int) -> Dict:
     try:
         student = Student.objects.get(pk=pk)
@@ -274,26 +544,8 @@ def update_student_info(request: Request, pk: int) -> Dict:
 
     student_ser = StudentPostSerializer(student.studentinfo, data=request.data)
     if student_ser.is_valid():
-        print(student_ser.validated_data)
         student_ser.update(student.studentinfo, student_ser.validated_data)
-
-        students_serializer_return = StudentSerializer(data={"id": student.pk,
-                                                             "token": student.studentsettings.token,
-                                                             "position": student.studentinfo.position,
-                                                             "first_name": student.studentinfo.first_name,
-                                                             "second_name": student.studentinfo.second_name,
-                                                             "third_name": student.studentinfo.third_name,
-                                                             "date_work_start": student.studentinfo.date_start,
-                                                             "date_birth": student.studentinfo.date_birth,
-                                                             "education": student.studentinfo.education,
-                                                             "phone": student.studentinfo.phone,
-                                                             "email": student.studentinfo.email,
-                                                             })
-
-        if students_serializer_return.is_valid():
-            return {'data': students_serializer_return.validated_data, 'success': True}
-
-        return {'data': students_serializer_return.validated_data, 'success': True}
+        return {'data': get_full_student_info(student.pk), 'success': True}
     else:
         return {'errors': student_ser.errors, 'success': False}
 
@@ -301,12 +553,15 @@ def update_student_info(request: Request, pk: int) -> Dict:
 def add_course_to_user(topic: TheoryTopic, student: Student) -> bool:
     if StudentTheoryTopic.objects.filter(theory_topic=topic, student=student):
         return False
-    student_topic = StudentTheoryTopic(theory_topic=topic, student=student, blocked=False)
-    student_topic.save()
+    with transaction.atomic():
+        student_topic = StudentTheoryTopic(theory_topic=topic, student=student, blocked=False)
+        student_topic.save()
+        sync_progress(student.pk, activity=False)
     return True
 
 
 def get_all_course(request: Request) -> Dict:
-    topics = TheoryTopic.objects.filter(restaurant=request.user.staff.restaurant_branch.main_restaurant).all()
+    topics = TheoryTopic.objects.filter(
+        restaurant__main_restaurant_id=request.user.staff.restaurant_branch.main_restaurant_id).all()
     topics_ser = TheoryTopicListSerializer(topics, many=True)
     return {"data": topics_ser.data, 'success': True}
@@ -1,3 +1,369 @@
-from django.test import TestCase
+import base64
+import json
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.test import TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from bot_logic.models import TelegramBot, Restaurant, City, RestaurantBranch, Staff, Student, StudentInfo, \
+    StudentTheoryTopic, TheoryTopic, TheoryTest, TestQuestion, StudentTest, StudentAnswer, StudentProgress
+from staffapi.pagination import encode_cursor
+from staffapi.services import get_all_students_answers, iter_answers_export
 
-# Create your tests here.
+
+class StaffApiTestCase(TestCase):
+    """
+    Two restaurant chains, the first one has two branches, request staff works in the first branch
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.city = City.objects.create()
+        cls.telegram_bot = TelegramBot.objects.create(name='bot', token='TOKEN')
+        cls.restaurant = Restaurant.objects.create(name='restaurant', bot=cls.telegram_bot)
+        cls.branch = cls.make_branch(cls.restaurant)
+        cls.chain_branch = cls.make_branch(cls.restaurant)
+        cls.other_branch = cls.make_branch(Restaurant.objects.create(name='other'))
+        cls.staff = cls.make_staff(cls.branch)
+
+    @classmethod
+    def make_branch(cls, restaurant: Restaurant) -> RestaurantBranch:
+        return RestaurantBranch.objects.create(main_restaurant=restaurant, name='branch', city=cls.city,
+                                               address='address')
+
+    @staticmethod
+    def make_staff(branch: RestaurantBranch) -> Staff:
+        user = User.objects.create(username=f'staff{User.objects.count()}')
+        return Staff.objects.create(restaurant_branch=branch, user=user, first_name='first', second_name='second')
+
+    def make_students(self, branch: RestaurantBranch, count: int = 1) -> list:
+        staff = self.staff if branch == self.branch else self.make_staff(branch)
+        return [Student.objects.create(staff=staff, telegram_bot=self.telegram_bot) for _ in range(count)]
+
+    def setUp(self):
+        self.client = APIClient()
+        # fresh user, so related objects are read as in real request
+        self.client.force_authenticate(User.objects.get(pk=self.staff.user_id))
+
+
+class StudentViewTestCase(StaffApiTestCase):
+
+    def test_read_is_scoped_to_restaurant_chain(self):
+        own, = self.make_students(self.branch)
+        chain, = self.make_students(self.chain_branch)
+        other, = self.make_students(self.other_branch)
+        self.assertEqual(self.client.get(f'/staff/student/{own.pk}').data['data']['id'], own.pk)
+        self.assertEqual(self.client.get(f'/staff/student/{chain.pk}').data['data']['id'], chain.pk)
+        self.assertIsNone(self.client.get(f'/staff/student/{other.pk}').data['data'])
+
+        response = self.client.get(f'/staff/student/?restaurant_branch={self.chain_branch.pk}')
+        self.assertEqual([student['id'] for student in response.data['data']], [chain.pk])
+        response = self.client.get(f'/staff/student/?restaurant_branch={self.other_branch.pk}')
+        self.assertEqual(response.status_code, 422)
+
+    def test_token_is_returned_only_on_request(self):
+        student, = self.make_students(self.branch)
+        for url in (f'/staff/student/{student.pk}', '/staff/student/'):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                data = response.data['data'] if isinstance(response.data['data'], dict) else response.data['data'][0]
+                self.assertNotIn('token', data)
+                self.assertIn('first_name', data)
+        response = self.client.get(f'/staff/student/{student.pk}?fields=token,id')
+        self.assertEqual(response.data['data'], {'id': student.pk, 'token': student.studentsettings.token})
+
+    def test_anonymous_is_rejected(self):
+        self.assertEqual(APIClient().get('/staff/student/').status_code, 401)
+
+
+class ExportTestCase(StaffApiTestCase):
+
+    def export(self, url: str) -> list:
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_students_export_is_scoped_to_restaurant_chain(self):
+        chain, = self.make_students(self.chain_branch)
+        self.make_students(self.other_branch)
+        rows = self.export(f'/staff/student/export/?restaurant_branch={self.chain_branch.pk}')
+        self.assertEqual([row['id'] for row in rows], [chain.pk])
+        self.assertNotIn('token', rows[0])
+        rows = self.export(f'/staff/student/export/?restaurant_branch={self.chain_branch.pk}&fields=id,token')
+        self.assertEqual(rows, [{'id': chain.pk, 'token': chain.studentsettings.token}])
+        response = self.client.get(f'/staff/student/export/?restaurant_branch={self.other_branch.pk}')
+        self.assertEqual(response.status_code, 422)
+
+    def test_answers_export_is_scoped_to_restaurant_chain(self):
+        chain, = self.make_students(self.chain_branch)
+        rows = self.export(f'/staff/answers/export/?restaurant_branch={self.chain_branch.pk}')
+        self.assertEqual([row['student_id'] for row in rows], [chain.pk])
+        response = self.client.get(f'/staff/answers/export/?restaurant_branch={self.other_branch.pk}')
+        self.assertEqual(response.status_code, 422)
+
+    def test_anonymous_is_rejected(self):
+        for url in ('/staff/student/export/', f'/staff/answers/export/?restaurant_branch={self.branch.pk}'):
+            with self.subTest(url=url):
+                self.assertEqual(APIClient().get(url).status_code, 401)
+
+
+class ListStudentsWithActionsViewTestCase(StaffApiTestCase):
+
+    def test_branch_is_scoped_to_restaurant_chain(self):
+        chain, = self.make_students(self.chain_branch)
+        response = self.client.get(f'/staff/liststudents/{self.chain_branch.pk}')
+        self.assertEqual([student['id'] for student in response.data['data']], [chain.pk])
+        self.assertEqual(self.client.get(f'/staff/liststudents/{self.other_branch.pk}').status_code, 422)
+        self.assertEqual(APIClient().get(f'/staff/liststudents/{self.branch.pk}').status_code, 401)
+
+    def test_missing_progress_summary_is_built(self):
+        student, = self.make_students(self.branch)
+        StudentTest.objects.create(student=student, test=TheoryTest.objects.create(name='test'), is_finished=True)
+        StudentProgress.objects.filter(student=student).delete()
+        response = self.client.get(f'/staff/liststudents/{self.branch.pk}')
+        self.assertEqual(response.data['data'][0]['actions'], 1)
+        self.assertEqual(StudentProgress.objects.get(student=student).pending_reviews, 1)
+
+
+class StudentListPaginationTestCase(StaffApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.students = self.make_students(self.branch, 5)
+        # ties of actions are ordered by pk
+        self.actions = dict(zip([student.pk for student in self.students], [2, 1, 2, 0, 1]))
+        self.client.get(f'/staff/liststudents/{self.branch.pk}')
+        for student_id, actions in self.actions.items():
+            StudentProgress.objects.filter(student_id=student_id).update(pending_reviews=actions)
+
+    def get_pages(self, ordering: str) -> list:
+        """
+        :return: pages of student pks
+        """
+        pages = []
+        url = f'/staff/liststudents/{self.branch.pk}?ordering={ordering}&limit=2'
+        cursor = None
+        while True:
+            response = self.client.get(url + (f'&cursor={cursor}' if cursor else ''))
+            self.assertEqual(response.status_code, 200)
+            for row in response.data['data']:
+                self.assertEqual(row['actions'], self.actions[row['id']])
+            pages.append([row['id'] for row in response.data['data']])
+            cursor = response.data['next']
+            if cursor is None:
+                return pages
+
+    def test_orderings(self):
+        pks = sorted(self.actions)
+        expected = {
+            'id': pks,
+            'actions': sorted(pks, key=lambda pk: (self.actions[pk], pk)),
+            '-actions': sorted(pks, key=lambda pk: (-self.actions[pk], pk)),
+        }
+        for ordering, order in expected.items():
+            with self.subTest(ordering=ordering):
+                self.assertEqual(self.get_pages(ordering), [order[0:2], order[2:4], order[4:]])
+
+    def test_last_full_page_has_no_next(self):
+        response = self.client.get(f'/staff/liststudents/{self.branch.pk}?limit=5')
+        self.assertEqual(len(response.data['data']), 5)
+        self.assertIsNone(response.data['next'])
+
+    def test_tampered_cursor(self):
+        url = f'/staff/liststudents/{self.branch.pk}?ordering=actions&cursor='
+        cursors = {
+            'not base64': '!!!',
+            'not json': base64.urlsafe_b64encode(b'not json').decode(),
+            'other ordering': encode_cursor(('-actions', 'pk'), [1, self.students[0].pk]),
+            'missing value': encode_cursor(('actions', 'pk'), [1]),
+        }
+        for case, cursor in cursors.items():
+            with self.subTest(case=case):
+                response = self.client.get(url + cursor)
+                self.assertEqual(response.status_code, 422)
+                self.assertEqual(response.data['error'], 'invalid param `cursor`')
+        self.assertEqual(self.client.get(f'/staff/liststudents/{self.branch.pk}?limit=0').status_code, 422)
+
+
+class PendingAnswersTestCase(StaffApiTestCase):
+    """
+    Students with topics pending review: last finished attempt of passed test has opened questions,
+    which are not checked by Staff
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.students = self.make_students(self.branch, 6)
+        self.test = TheoryTest.objects.create(name='test')
+        self.question = TestQuestion.objects.create(question='opened', is_opened=True)
+        self.test.questions.add(self.question)
+        self.topic = TheoryTopic.objects.create(restaurant=self.branch, creator=self.staff, name='topic',
+                                                text='text', test=self.test)
+        StudentTheoryTopic.objects.update(complete_test=True)
+        pending, other_pending, checked, not_passed, last_without_opened, without_attempt = self.students
+        self.pending = [pending, other_pending]
+        for student in (pending, other_pending, checked, not_passed):
+            self.finish(student, 1)
+        StudentTheoryTopic.objects.filter(student=checked).update(complete_opened_questions=True)
+        StudentTheoryTopic.objects.filter(student=not_passed).update(complete_test=False)
+        self.finish(last_without_opened, 1)
+        self.finish(last_without_opened, 0)
+
+    def finish(self, student: Student, opened_questions: int) -> None:
+        student_test = StudentTest.objects.create(test=self.test, student=student, is_finished=True,
+                                                  max_opened_questions=opened_questions)
+        if opened_questions:
+            student_test.answers.add(StudentAnswer.objects.create(student=student, question=self.question,
+                                                                  text=f'answer {student_test.pk}'))
+
+    def assert_pending(self, students_answers: list) -> None:
+        self.assertEqual([row['student_id'] for row in students_answers], [student.pk for student in self.pending])
+        for row in students_answers:
+            topic, = row['topics']
+            self.assertEqual(topic['id'], StudentTheoryTopic.objects.get(student_id=row['student_id']).pk)
+            answer, = topic['opened_questions']
+            self.assertEqual(answer['question'], 'opened')
+
+    def test_students_answers(self):
+        with self.assertNumQueries(4):
+            page = get_all_students_answers(self.branch, pending=True)
+        self.assert_pending(page['data'])
+        with self.assertNumQueries(4):
+            page = get_all_students_answers(self.branch, pending=True, limit=1)
+        self.assert_pending(page['data'] + get_all_students_answers(self.branch, True, page['next'], 1)['data'])
+        response = self.client.get(f'/staff/answers/?restaurant_branch={self.branch.pk}&pending=1')
+        self.assert_pending(response.data['data'])
+        response = self.client.get(f'/staff/answers/?restaurant_branch={self.branch.pk}')
+        self.assertEqual(len(response.data['data']), 6)
+
+    def test_answers_export(self):
+        # one query of pks and 3 queries of answers per chunk
+        for chunk_size, queries in ((1, 8), (2, 4)):
+            with self.subTest(chunk_size=chunk_size):
+                with self.assertNumQueries(queries):
+                    rows = list(iter_answers_export(self.branch, pending=True, chunk_size=chunk_size))
+                self.assert_pending(rows)
+
+
+class StudentAnswersViewTestCase(StaffApiTestCase):
+
+    def test_answers_are_scoped_to_restaurant_chain(self):
+        chain, = self.make_students(self.chain_branch)
+        other, = self.make_students(self.other_branch)
+        response = self.client.get(f'/staff/answers/?restaurant_branch={self.chain_branch.pk}')
+        self.assertEqual([student['student_id'] for student in response.data['data']], [chain.pk])
+        response = self.client.get(f'/staff/answers/?restaurant_branch={self.other_branch.pk}')
+        self.assertFalse(response.data['success'])
+        self.assertEqual(self.client.get(f'/staff/answers/?user={chain.pk}').data['data']['student_id'], chain.pk)
+        self.assertEqual(self.client.get(f'/staff/answers/?user={other.pk}').status_code, 422)
+        self.assertEqual(APIClient().get(f'/staff/answers/?user={chain.pk}').status_code, 401)
+
+
+class StudentImportViewTestCase(StaffApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.topic = TheoryTopic.objects.create(restaurant=self.chain_branch, creator=self.staff, name='topic',
+                                                text='text')
+        self.other_topic = TheoryTopic.objects.create(restaurant=self.other_branch, creator=self.staff, name='topic',
+                                                      text='text')
+
+    def post(self, body: str, data_format: str):
+        return self.client.post(f'/staff/student/import/?data_format={data_format}', data=body.encode(),
+                                content_type='text/csv' if data_format == 'csv' else 'application/x-ndjson')
+
+    def assert_created(self, response, names: dict):
+        """
+        Check that every created row has pk and token of its inserted student
+        :param response: import response
+        :param names: row number -> first name of created student
+        """
+        self.assertEqual(response.status_code, 201)
+        created = {row['row']: row for row in response.data['data']['rows'] if row['success']}
+        self.assertEqual(set(created), set(names))
+        for number, first_name in names.items():
+            student = Student.objects.select_related('studentinfo', 'studentsettings').get(pk=created[number]['id'])
+            self.assertEqual(student.studentinfo.first_name, first_name)
+            self.assertEqual(student.studentsettings.token, created[number]['token'])
+            self.assertEqual(student.staff_id, self.staff.pk)
+            self.assertEqual(student.telegram_bot_id, self.telegram_bot.pk)
+
+    def test_csv(self):
+        Student.objects.create(staff=self.staff, telegram_bot=self.telegram_bot)
+        StudentInfo.objects.filter(student__staff=self.staff).update(first_name='Old', second_name='S', third_name='T')
+        response = self.post('\n'.join([
+            'first_name,second_name,third_name,date_start,course',
+            f'Ivan,Petrov,Ivanovich,01.02.2020,{self.topic.pk}',
+            'Petr,Ivanov,Petrovich,2020-02-01,',
+            'Old,S,T,,',
+            'Ivan,Petrov,Ivanovich,,',
+            f'Anna,Petrova,Ivanovna,,{self.other_topic.pk}',
+            'Olga,Petrova,Ivanovna,,',
+        ]), 'csv')
+        self.assert_created(response, {1: 'Ivan', 6: 'Olga'})
+        errors = {row['row']: row['errors'] for row in response.data['data']['rows'] if not row['success']}
+        self.assertEqual(set(errors), {2, 3, 4, 5})
+        self.assertIn('date_start', errors[2])
+        self.assertEqual(errors[3], 'Student already exist')
+        self.assertEqual(errors[4], 'Student already exist')
+        self.assertEqual(errors[5], 'course does not exist')
+        self.assertEqual(response.data['data']['created'], 2)
+        self.assertEqual(response.data['data']['failed'], 4)
+        ivan = response.data['data']['rows'][0]['id']
+        self.assertTrue(StudentTheoryTopic.objects.filter(student_id=ivan, theory_topic=self.topic,
+                                                          blocked=False).exists())
+
+    def test_ndjson(self):
+        response = self.post('\n'.join([
+            json.dumps({'first_name': 'Ivan', 'second_name': 'Petrov', 'third_name': 'Ivanovich'}),
+            '{not json',
+            json.dumps({'first_name': 'Petr', 'second_name': 'Ivanov'}),
+            '',
+            json.dumps({'first_name': 'Olga', 'second_name': 'Petrova', 'third_name': 'Ivanovna',
+                        'course': self.topic.pk}),
+        ]), 'ndjson')
+        self.assert_created(response, {1: 'Ivan', 4: 'Olga'})
+        errors = {row['row']: row['errors'] for row in response.data['data']['rows'] if not row['success']}
+        self.assertEqual(errors[2], 'invalid json object')
+        self.assertIn('third_name', errors[3])
+
+    def test_restaurant_without_bot(self):
+        Restaurant.objects.filter(pk=self.restaurant.pk).update(bot=None)
+        response = self.post('first_name,second_name,third_name\nIvan,Petrov,Ivanovich', 'csv')
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(Student.objects.exists())
+
+
+@override_settings(STAFF_CACHE_BODIES=False)
+class TopicListViewTestCase(TransactionTestCase):
+    """
+    Versions of resources are bumped on commit, so writes are committed
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        restaurant = Restaurant.objects.create(name='restaurant')
+        branch, self.chain_branch = [RestaurantBranch.objects.create(main_restaurant=restaurant, name='branch',
+                                                                     address='address') for _ in range(2)]
+        self.staff = Staff.objects.create(restaurant_branch=branch, user=User.objects.create(username='staff'))
+        self.topic = TheoryTopic.objects.create(restaurant=self.chain_branch, creator=self.staff, name='topic',
+                                                text='text')
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.get(pk=self.staff.user_id))
+
+    def test_conditional_get(self):
+        response = self.client.get('/staff/topic/list/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([topic['id'] for topic in response.data['data']], [self.topic.pk])
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get('/staff/topic/list/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # topic of other branch of the chain is changed
+        self.topic.name = 'new name'
+        self.topic.save()
+        response = self.client.get('/staff/topic/list/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['data'][0]['name'], 'new name')
@@ -1,15 +1,22 @@
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView, Response
 from .services import \
     get_all_cities, \
     get_all_restaurant_branches_in_city, \
     validate_city_to_pk, \
-    validate_restaurant_branch_to_pk, \
+    validate_staff_restaurant_branch, \
     get_minimal_info_about_students, \
-    get_full_student_info, get_current_student_answers, \
+    get_full_student_info, get_students_page, parse_student_fields, get_current_student_answers, \
     validate_student_to_pk, get_all_students_answers, \
     change_answer_status, register_new_student, \
-    update_student_info, get_all_course
+    update_student_info, get_all_course, import_students, \
+    STUDENT_LIST_ORDERINGS, STUDENT_READ_FIELDS, ANSWER_EXPORT_FIELDS, \
+    iter_students_export, iter_answers_export, iter_answer_topics, stream_rows
+from .pagination import get_page_params, PageError
+from .caching import versioned, CITIES, BRANCHES, TOPICS
 from rest_framework.request import Request
 
 
@@ -19,6 +26,7 @@ class CityView(APIView):
     View class to add and view City List
     """
 
+    @versioned(CITIES)
     def get(self, request: Request) -> Response:
         """
         This method return full city list
@@ -33,6 +41,7 @@ class RestaurantBranchView(APIView):
     View class to add and view restaurant branch list
     """
 
+    @versioned(BRANCHES, variant=lambda request: str(request.query_params.get('city')))
     def get(self, request: Request) -> Response:
         """
         This method return all restaurant branches current staff
@@ -50,35 +59,63 @@ class ListStudentsWithActionsView(APIView):
     """
     View class to get list of students current restaurant branch
     """
+    permission_classes = [IsAuthenticated]
 
     def get(self, request: Request, pk: int) -> Response:
         """
-        This method return all list of student current pk
-        :param pk: restaurant branch pk
-        :param request:
-        :return: Response({"data": [StudentSerializer], "success": True}, status=200)
+        This method return page of students current pk
+        :param pk: restaurant branch pk of restaurant chain of staff
+        :param request: query params `ordering` (id, actions, -actions), `cursor`, `limit`
+        :return: Response({"data": [MinimalStudentSerializer], "next": cursor, "success": True}, status=200)
         """
-        restaurant_branch = validate_restaurant_branch_to_pk(pk)
-        results = get_minimal_info_about_students(restaurant_branch)
-        return Response({"data": results, "success": True}, status=200)
+        restaurant_branch = validate_staff_restaurant_branch(request.user.staff, pk)
+        if not restaurant_branch:
+            return Response({"success": False, "error": "restaurant branch not found"}, status=422)
+        ordering = request.query_params.get('ordering', 'id')
+        if ordering not in STUDENT_LIST_ORDERINGS:
+            return Response({"success": False, "error": "invalid param `ordering`"}, status=422)
+        try:
+            cursor, limit = get_page_params(request)
+            page = get_minimal_info_about_students(restaurant_branch, ordering, cursor, limit)
+        except PageError as err:
+            return Response({"success": False, "error": str(err)}, status=422)
+        return Response({"data": page['data'], "next": page['next'], "success": True}, status=200)
 
 
 class StudentView(APIView):
     """
     Full info about students
     """
+    permission_classes = [IsAuthenticated]
+
     def get(self, request: Request, pk=None) -> Response:
         """
-        Get one instance of pk != None or all instances of Students with full info
-        :param request:
+        Get one instance of pk != None or page of instances of Students with full info,
+        students and `restaurant_branch` must be of restaurant chain of staff
+        :param request: query params `fields` (comma separated, token is returned only on request),
+        `restaurant_branch`, `cursor`, `limit`
         :param pk:
-        :return:
+        :return: Response({"data": StudentSerializer or [StudentSerializer], "next": cursor, "success": True}, status=200)
         """
+        fields = parse_student_fields(request.query_params.get('fields'), STUDENT_READ_FIELDS)
+        if fields is None:
+            return Response({"success": False, "error": "invalid param `fields`"}, status=422)
+        staff = request.user.staff
         if pk:
-            data = get_full_student_info(request.user.staff, request.query_params.get('restaurant_branch'), pk=pk)
-        else:
-            data = get_full_student_info(request.user.staff, request.query_params.get('restaurant_branch'), many=True)
-        return Response({"data": data, "success": True}, status=200)
+            data = get_full_student_info(pk, fields, staff)
+            return Response({"data": data, "success": True}, status=200)
+
+        restaurant = request.query_params.get('restaurant_branch')
+        if restaurant:
+            restaurant = validate_staff_restaurant_branch(staff, restaurant)
+            if not restaurant:
+                return Response({"success": False, "error": "invalid param `restaurant_branch`"}, status=422)
+        try:
+            cursor, limit = get_page_params(request)
+            page = get_students_page(staff, restaurant, fields, cursor, limit)
+        except PageError as err:
+            return Response({"success": False, "error": str(err)}, status=422)
+        return Response({"data": page['data'], "next": page['next'], "success": True}, status=200)
 
     def post(self, request: Request) -> Response:
 
@@ -98,30 +135,129 @@ class StudentView(APIView):
             return Response(response, status=201)
 
 
+class StudentImportView(APIView):
+    """
+    Bulk onboarding of students from CSV or NDJSON file
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request: Request) -> Response:
+        """
+        Create students of request staff from uploaded rows in one transaction
+        :param request: multipart `file` or body, CSV with header row or NDJSON
+        :return: Response({"data": {"created", "failed", "rows": [per row result]}, "success": True}, status=201)
+        """
+        response = import_students(request)
+
+        if response.get('errors'):
+            return Response(response, status=422)
+        else:
+            return Response(response, status=201)
+
+
+def _export_response(rows, data_format: str, fields, name: str) -> StreamingHttpResponse:
+    """
+    :param rows: iterator of row dicts
+    :param data_format: ndjson or csv
+    :param fields: CSV columns
+    :param name: file name without extension
+    :return: streaming attachment response
+    """
+    content_type = 'text/csv' if data_format == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(stream_rows(rows, data_format, fields),
+                                     content_type=f'{content_type}; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{name}.{data_format}"'
+    return response
+
+
+class StudentExportView(APIView):
+    """
+    Streaming export of all students with full info
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request: Request) -> Response:
+        """
+        Export students of restaurant branch of restaurant chain of staff or of request staff,
+        rows are read and written by chunks
+        :param request: query params `data_format` (ndjson or csv), `fields` (comma separated,
+        token is exported only on request), `restaurant_branch`
+        :return: StreamingHttpResponse with NDJSON or CSV rows
+        """
+        data_format = request.query_params.get('data_format', 'ndjson')
+        if data_format not in ('ndjson', 'csv'):
+            return Response({"success": False, "error": "invalid param `data_format`"}, status=422)
+        fields = parse_student_fields(request.query_params.get('fields'), STUDENT_READ_FIELDS)
+        if fields is None:
+            return Response({"success": False, "error": "invalid param `fields`"}, status=422)
+        staff = request.user.staff
+        restaurant = request.query_params.get('restaurant_branch')
+        if restaurant:
+            restaurant = validate_staff_restaurant_branch(staff, restaurant)
+            if not restaurant:
+                return Response({"success": False, "error": "invalid param `restaurant_branch`"}, status=422)
+        rows = iter_students_export(staff, restaurant, fields, settings.STAFF_EXPORT_CHUNK_SIZE)
+        return _export_response(rows, data_format, fields, 'students')
+
+
+class StudentAnswersExportView(APIView):
+    """
+    Streaming export of students answers of restaurant branch
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request: Request) -> Response:
+        """
+        Export answers, NDJSON has one student with topics per line, CSV has one student topic per row
+        :param request: query params `restaurant_branch` (of restaurant chain of staff), `data_format` (ndjson or csv),
+        `pending` (1 for pending review only)
+        :return: StreamingHttpResponse with NDJSON or CSV rows
+        """
+        data_format = request.query_params.get('data_format', 'ndjson')
+        if data_format not in ('ndjson', 'csv'):
+            return Response({"success": False, "error": "invalid param `data_format`"}, status=422)
+        rest_branch = validate_staff_restaurant_branch(request.user.staff, request.query_params.get('restaurant_branch'))
+        if not rest_branch:
+            return Response({"success": False, "error": "invalid query param `restaurant_branch`"}, status=422)
+        pending = request.query_params.get('pending') in ('1', 'true')
+        rows = iter_answers_export(rest_branch, pending, settings.STAFF_EXPORT_CHUNK_SIZE)
+        if data_format == 'csv':
+            rows = iter_answer_topics(rows)
+        return _export_response(rows, data_format, ANSWER_EXPORT_FIELDS, 'answers')
+
+
 class StudentAnswersView(APIView):
     """
     info about student answers and check opened answers
     """
+    permission_classes = [IsAuthenticated]
 
     def get(self, request: Request) -> Response:
         """
-        Get one instance of pk != None or all instances of StudentsAnswers and opened
-        :param request:
+        Get one instance of pk != None or page of StudentsAnswers and opened
+        :param request: query params `user` or `restaurant_branch` (of restaurant chain of staff),
+        `pending` (1 for pending review only), `cursor`, `limit`
         :return:
         """
+        pending = request.query_params.get('pending') in ('1', 'true')
+        staff = request.user.staff
         pk = request.query_params.get("user")
         if pk:
-            student = validate_student_to_pk(pk)
+            student = validate_student_to_pk(pk, staff)
             if student:
-                data = get_current_student_answers(student)
+                data = get_current_student_answers(student, pending)
                 return Response({"data": data, 'success': True}, status=200)
             else:
                 return Response({'success': False, "error": "student not found"}, status=422)
         else:
-            rest_branch = validate_restaurant_branch_to_pk(request.query_params.get('restaurant_branch'))
+            rest_branch = validate_staff_restaurant_branch(staff, request.query_params.get('restaurant_branch'))
             if rest_branch:
-                data = get_all_students_answers(rest_branch)
-                return Response({"data": data, 'success': True}, status=200)
+                try:
+                    cursor, limit = get_page_params(request)
+                    page = get_all_students_answers(rest_branch, pending, cursor, limit)
+                except PageError as err:
+                    return Response({"success": False, "error": str(err)}, status=422)
+                return Response({"data": page['data'], "next": page['next'], 'success': True}, status=200)
             else:
                 return Response({"error": "invalid query param `restaurant_branch`", 'success': False}, status=200)
 
@@ -144,6 +280,7 @@ class TopicListView(APIView):
     Api view for all topics in staff's restaurant
     """
 
+    @versioned(TOPICS, variant=lambda request: str(request.user.pk))
     def get(self, request: Request) -> Response:
         response = get_all_course(request)
         return Response(response, status=200)